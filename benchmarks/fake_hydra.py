@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""A local stand-in for the parts of the Hydra API that nixpkgs-broken uses.
+
+All data is synthetic and derived from the build ID, so every run serves the
+same responses. Every eval has `num_builds` builds (one per job and system),
+and between two consecutive evals a `churn` fraction of them is rebuilt with a
+new build ID.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SYSTEMS = ["x86_64-linux", "aarch64-linux", "x86_64-darwin", "aarch64-darwin"]
+FIRST_BUILD_ID = 200000000
+FIRST_EVAL_ID = 1800000
+FIRST_TIMESTAMP = 1670000000
+EVAL_INTERVAL = 6 * 60 * 60
+
+def stable_fraction(*values):
+    """A number in [0, 1) that only depends on `values`."""
+    return zlib.crc32(repr(values).encode()) / 2**32
+
+class FakeHydra:
+    def __init__(self, num_builds=250000, num_evals=3, churn=0.1, latency=0.0, error_rate=0.0, seed=0):
+        self.num_builds = num_builds
+        self.num_evals = num_evals
+        self.churn = churn
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.server = None
+
+    def eval_id(self, eval_index):
+        return FIRST_EVAL_ID + eval_index
+
+    def eval_timestamp(self, eval_index):
+        return FIRST_TIMESTAMP + eval_index * EVAL_INTERVAL
+
+    def rebuilt(self, index, eval_index):
+        return eval_index == 0 or stable_fraction(self.seed, index, eval_index) < self.churn
+
+    def build_id(self, index, eval_index):
+        """The build ID of job `index` in eval `eval_index`, which is the one of the last eval that rebuilt it."""
+        while not self.rebuilt(index, eval_index):
+            eval_index -= 1
+        return FIRST_BUILD_ID + eval_index * self.num_builds + index
+
+    def build_ids(self, eval_index):
+        return [self.build_id(index, eval_index) for index in range(self.num_builds)]
+
+    def job(self, index):
+        return f"pkg{index // len(SYSTEMS)}", SYSTEMS[index % len(SYSTEMS)]
+
+    def build_status(self, build_id):
+        fraction = stable_fraction(self.seed, build_id)
+        if fraction < 0.85:
+            return 0
+        if fraction < 0.95:
+            return 1
+        if fraction < 0.99:
+            return 2
+        return None
+
+    def build(self, build_id):
+        eval_index, index = divmod(build_id - FIRST_BUILD_ID, self.num_builds)
+        if build_id < FIRST_BUILD_ID or eval_index >= self.num_evals:
+            return None
+        jobname, system = self.job(index)
+        status = self.build_status(build_id)
+        jobsetevals = [self.eval_id(e) for e in range(self.num_evals - 1, eval_index - 1, -1) if self.build_id(index, e) == build_id]
+        return {
+            "id": build_id,
+            "job": f"{jobname}.{system}",
+            "system": system,
+            "buildstatus": status,
+            "finished": 0 if status is None else 1,
+            "timestamp": self.eval_timestamp(eval_index),
+            "jobsetevals": jobsetevals,
+            "project": "nixpkgs",
+            "jobset": "trunk",
+        }
+
+    def latest_success(self, jobname, system):
+        try:
+            index = int(jobname.removeprefix("pkg")) * len(SYSTEMS) + SYSTEMS.index(system)
+        except ValueError:
+            return None
+        for eval_index in range(self.num_evals - 1, -1, -1):
+            build_id = self.build_id(index, eval_index)
+            if self.build_status(build_id) == 0:
+                return self.build(build_id)
+        return None
+
+    def evals(self):
+        return {
+            "evals": [
+                {"id": self.eval_id(e), "timestamp": self.eval_timestamp(e), "hasnewbuilds": 1}
+                for e in range(self.num_evals - 1, -1, -1)
+            ],
+            "first": "?page=1",
+            "last": "?page=1",
+        }
+
+    def eval(self, eval_id):
+        eval_index = eval_id - FIRST_EVAL_ID
+        if not 0 <= eval_index < self.num_evals:
+            return None
+        return {"id": eval_id, "timestamp": self.eval_timestamp(eval_index), "builds": self.build_ids(eval_index)}
+
+    def eval_page(self, eval_id):
+        """The HTML overview page of an eval, laid out like Hydra's build list."""
+        eval_index = eval_id - FIRST_EVAL_ID
+        if not 0 <= eval_index < self.num_evals:
+            return None
+        titles = {0: "Succeeded", 1: "Failed", 2: "Dependency failed", None: "Scheduled to be built"}
+        lines = ["<html><body><table class=\"table\"><thead><tr><th></th><th>#</th><th>Job</th><th>Finished at</th><th>Package/release name</th><th>System</th></tr></thead><tbody>"]
+        for build_id in self.build_ids(eval_index):
+            build = self.build(build_id)
+            title = titles[build["buildstatus"]]
+            lines.append(
+                f'<tr><td><img src="/static/images/status.svg" height="16" width="16" title="{title}" alt="{title}" class="build-status" /></td>'
+                f'<td><a class="row-link" href="/build/{build_id}">{build_id}</a></td>'
+                f'<td><a href="/job/nixpkgs/trunk/{build["job"]}">{build["job"]}</a></td>'
+                f'<td class="nowrap"><time datetime="{build["timestamp"]}">{build["timestamp"]}</time></td>'
+                f'<td>{build["job"].rsplit(".", 1)[0]}-1.0</td>'
+                f'<td><tt>{build["system"]}</tt></td></tr>')
+        lines.append("</tbody></table></body></html>")
+        return "\n".join(lines)
+
+    def start(self, port=0):
+        """Serve in a background thread and return the base URL."""
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def make_handler(hydra):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, code, value):
+            body = json.dumps(value).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if hydra.latency:
+                time.sleep(hydra.latency)
+            if hydra.error_rate and hydra.random.random() < hydra.error_rate:
+                return self.send_json(500, {"error": "injected error"})
+            path = self.path.split("?")[0]
+            if "text/html" in self.headers.get("Accept", "") and (m := re.fullmatch(r"/eval/(\d+)", path)):
+                page = hydra.eval_page(int(m.group(1)))
+                if page is None:
+                    return self.send_json(404, {"error": "not found"})
+                body = page.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if m := re.fullmatch(r"/build/(\d+)", path):
+                value = hydra.build(int(m.group(1)))
+            elif re.fullmatch(r"/jobset/[^/]+/[^/]+/evals", path):
+                value = hydra.evals()
+            elif m := re.fullmatch(r"/eval/(\d+)", path):
+                value = hydra.eval(int(m.group(1)))
+            elif m := re.fullmatch(r"/job/[^/]+/[^/]+/(.+)\.([^.]+)/latest", path):
+                value = hydra.latest_success(m.group(1), m.group(2))
+            else:
+                value = None
+            if value is None:
+                return self.send_json(404, {"error": "not found"})
+            self.send_json(200, value)
+
+    return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a synthetic Hydra API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--builds", type=int, default=250000)
+    parser.add_argument("--evals", type=int, default=3)
+    parser.add_argument("--churn", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with HTTP 500")
+    args = parser.parse_args()
+    hydra = FakeHydra(args.builds, args.evals, args.churn, args.latency, args.error_rate)
+    print(f"Serving on {hydra.start(args.port)}")
+    threading.Event().wait()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Benchmark suite for nixpkgs-broken.
+
+Runs against a local fake Hydra (fake_hydra.py) and a stub nix-instantiate
+(bin/nix-instantiate), so the results only depend on this machine. The
+results are written as JSON; pass an earlier result file with --compare to
+spot regressions.
+
+    python benchmarks/run.py --builds 20000 --output bench.json
+    python benchmarks/run.py --builds 20000 --compare bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(benchmarks_dir)
+sys.path.insert(0, os.path.join(repo_dir, "src"))
+
+from fake_hydra import FakeHydra, SYSTEMS
+from nixpkgs_broken import broken
+from nixpkgs_broken import cache
+from nixpkgs_broken import mark_broken_v2
+from nixpkgs_broken import nixeval
+from nixpkgs_broken import snapshot
+
+def environment():
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(benchmarks_dir, "bin") + os.pathsep + env["PATH"]
+    env["PYTHONPATH"] = os.path.join(repo_dir, "src") + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+def bench_ingest(args, hydra_url, workdir, backend="json"):
+    """Run the `broken` CLI for the latest eval of the fake Hydra."""
+    db_path = os.path.join(workdir, f"ingest-{backend}.db")
+    start = time.monotonic()
+    subprocess.run(
+        [sys.executable, "-m", "nixpkgs_broken.broken", "--baseurl", hydra_url, "--db-path", db_path, "--concurrency", str(args.concurrency), "--backend", backend],
+        cwd=workdir, env=environment(), stdout=subprocess.DEVNULL, check=True)
+    duration = time.monotonic() - start
+    database = broken.Database(db_path)
+    stored = database.cursor.execute("SELECT count(*) FROM build_results").fetchone()[0]
+    return {"seconds": duration, "builds": stored, "builds_per_second": stored / duration}
+
+def populate_history(database, hydra, hydra_url):
+    """Fill the database with every eval of the fake Hydra, without going through HTTP."""
+    for eval_index in range(hydra.num_evals):
+        rows = []
+        for build_id in hydra.build_ids(eval_index):
+            build_info = hydra.build(build_id)
+            jobname, system = build_info["job"].rsplit(".", maxsplit=1)
+            rows.append((build_id, hydra_url, "nixpkgs/trunk", hydra.eval_id(eval_index), build_info["timestamp"], build_info["buildstatus"], jobname, system))
+        database.insert_or_update_build_results(rows)
+
+def bench_reports(args, hydra, hydra_url, workdir):
+    database = broken.Database(os.path.join(workdir, "reports.db"))
+    populate_history(database, hydra, hydra_url)
+    results = {}
+    for [name, plan, duration, num_rows] in database.explain_report_queries():
+        results[name] = {"seconds": duration, "rows": num_rows}
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        broken.list_broken_pkgs(database, cache.BuildCache(database), args.concurrency)
+    results["list_broken_pkgs"] = {"seconds": time.monotonic() - start}
+    return results
+
+def count_build_rows(database):
+    """Return the number of rows of every table that holds builds, and their total."""
+    rows = {table: database.cursor.execute(f"SELECT count(*) FROM {table}").fetchone()[0] for table in ["build_results", "build_intervals"]}
+    rows["total"] = sum(rows.values())
+    return rows
+
+def bench_compact(args, hydra, hydra_url, workdir):
+    """Compact all but the last eval, and time the reports against the compacted history."""
+    database = broken.Database(os.path.join(workdir, "compact.db"))
+    populate_history(database, hydra, hydra_url)
+    rows_before = count_build_rows(database)
+    start = time.monotonic()
+    num_builds, num_intervals = database.compact_build_results(hydra.eval_timestamp(hydra.num_evals - 1))
+    duration = time.monotonic() - start
+    results = {"seconds": duration, "rows_before": rows_before, "rows_after": count_build_rows(database), "builds_compacted": num_builds}
+    for [name, plan, duration, num_rows] in database.explain_report_queries():
+        results[name] = {"seconds": duration, "rows": num_rows}
+    return results
+
+def bench_snapshot(args, hydra, hydra_url, workdir):
+    """Export the full history to a snapshot and import it into an empty database."""
+    database = broken.Database(os.path.join(workdir, "snapshot-source.db"))
+    populate_history(database, hydra, hydra_url)
+    path = os.path.join(workdir, "snapshot.ndjson.gz")
+    start = time.monotonic()
+    num_records = snapshot.export_snapshot(database, path)
+    export_duration = time.monotonic() - start
+    start = time.monotonic()
+    header, counts = snapshot.import_snapshot(broken.Database(os.path.join(workdir, "snapshot-target.db")), path)
+    import_duration = time.monotonic() - start
+    return {"export_seconds": export_duration, "import_seconds": import_duration, "records": num_records, "bytes": os.path.getsize(path), "builds_per_second": counts["build"] / import_duration}
+
+def write_package(nixpkgs, attr, broken_line=None):
+    os.makedirs(os.path.join(nixpkgs, "pkgs", attr), exist_ok=True)
+    with open(os.path.join(nixpkgs, "pkgs", attr, "default.nix"), "w") as nix_file:
+        print("{ lib, stdenv }:", file=nix_file)
+        print("stdenv.mkDerivation {", file=nix_file)
+        print(f'  pname = "{attr}";', file=nix_file)
+        print("  meta = {", file=nix_file)
+        print(f'    description = "The {attr} package";', file=nix_file)
+        if broken_line:
+            print(f"    {broken_line}", file=nix_file)
+        print("  };", file=nix_file)
+        print("}", file=nix_file)
+
+def bench_list_package_paths(args, hydra, hydra_url, workdir):
+    nixpkgs = os.path.join(workdir, "nixpkgs-paths")
+    database = broken.Database(os.path.join(workdir, "paths.db"))
+    populate_history(database, hydra, hydra_url)
+    attrs = {hydra.job(index)[0] for index in range(hydra.num_builds)}
+    for attr in attrs:
+        write_package(nixpkgs, attr)
+    git(nixpkgs, "init")
+    git(nixpkgs, "add", ".")
+    git(nixpkgs, "commit", "-m", "initial")
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        broken.list_package_paths(database, nixpkgs, args.jobs)
+    duration = time.monotonic() - start
+    # A new nixpkgs revision that touches 1% of the packages.
+    for attr in sorted(attrs)[:max(1, len(attrs) // 100)]:
+        write_package(nixpkgs, attr, "broken = true;")
+    git(nixpkgs, "commit", "-am", "update")
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        broken.list_package_paths(database, nixpkgs, args.jobs)
+    refresh_duration = time.monotonic() - start
+    return {"seconds": duration, "attrs": len(attrs), "attrs_per_second": len(attrs) / duration, "refresh_seconds": refresh_duration}
+
+def git(path, *args):
+    subprocess.run(["git", "-C", path, "-c", "user.name=bench", "-c", "user.email=bench@example.org", *args], check=True, capture_output=True)
+
+def bench_mark_broken(args, workdir):
+    nixpkgs = os.path.join(workdir, "nixpkgs-mark")
+    attrs = [f"pkg{i}" for i in range(args.mark_attrs)]
+    for attr in attrs:
+        write_package(nixpkgs, attr)
+    cwd = os.getcwd()
+    os.chdir(nixpkgs)
+    try:
+        evaluator = nixeval.Evaluator(jobs=args.jobs)
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            for [i, attr] in enumerate(attrs):
+                mark_broken_v2.attemptToMarkBroken(attr, [SYSTEMS[i % len(SYSTEMS)]], evaluator=evaluator)
+        duration = time.monotonic() - start
+    finally:
+        os.chdir(cwd)
+    return {"seconds": duration, "attrs": len(attrs), "attrs_per_second": len(attrs) / duration}
+
+def bench_mark_broken_batch(args, workdir):
+    nixpkgs = os.path.join(workdir, "nixpkgs-mark-batch")
+    attrs = [f"pkg{i}" for i in range(args.mark_attrs)]
+    for attr in attrs:
+        write_package(nixpkgs, attr)
+    marks = [(attr, [SYSTEMS[i % len(SYSTEMS)]], "") for [i, attr] in enumerate(attrs)]
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        marked = mark_broken_v2.markBrokenBatch(marks, nixpkgs, args.jobs)
+    duration = time.monotonic() - start
+    return {"seconds": duration, "attrs": len(marked), "attrs_per_second": len(marked) / duration}
+
+def compare(results, baseline, threshold):
+    """Print the change against `baseline` and return the names of the measurements that got slower than `threshold`."""
+    regressions = []
+    for [benchmark, measurements] in results["results"].items():
+        for [name, value] in flatten(measurements):
+            if not name.endswith("seconds"):
+                continue
+            old_value = dict(flatten(baseline["results"].get(benchmark, {}))).get(name)
+            if not old_value:
+                continue
+            ratio = value / old_value
+            print(f"{benchmark}.{name}: {old_value:.3f}s -> {value:.3f}s ({ratio:.2f}x)")
+            if ratio > threshold:
+                regressions.append(f"{benchmark}.{name}")
+    return regressions
+
+def flatten(measurements, prefix=""):
+    for [name, value] in measurements.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{name}.")
+        else:
+            yield f"{prefix}{name}", value
+
+def version():
+    result = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=repo_dir, capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark nixpkgs-broken against a local fake Hydra")
+    parser.add_argument("--builds", type=int, default=250000, help="Number of builds per eval")
+    parser.add_argument("--evals", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake Hydra waits before every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake Hydra requests that fail")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--jobs", type=int, help="Number of parallel nix-instantiate processes")
+    parser.add_argument("--import-seconds", type=float, default=0.5, help="Time the stub nix-instantiate takes per nixpkgs import")
+    parser.add_argument("--mark-attrs", type=int, default=50, help="Number of attributes to mark broken")
+    parser.add_argument("--only", action="append", choices=["ingest", "ingest_html", "reports", "compact", "snapshot", "list_package_paths", "mark_broken", "mark_broken_batch"])
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio that counts as a regression")
+    args = parser.parse_args()
+
+    os.environ["NIX_STUB_IMPORT_SECONDS"] = str(args.import_seconds)
+    os.environ["PATH"] = environment()["PATH"]
+    selected = args.only or ["ingest", "ingest_html", "reports", "compact", "snapshot", "list_package_paths", "mark_broken", "mark_broken_batch"]
+    hydra = FakeHydra(args.builds, args.evals, latency=args.latency, error_rate=args.error_rate)
+    hydra_url = hydra.start()
+    results = {
+        "version": version(),
+        "date": datetime.datetime.now().isoformat(),
+        "parameters": vars(args),
+        "results": {},
+    }
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for name in selected:
+                print(f"Running {name}")
+                if name == "ingest":
+                    results["results"][name] = bench_ingest(args, hydra_url, workdir)
+                elif name == "ingest_html":
+                    results["results"][name] = bench_ingest(args, hydra_url, workdir, "html")
+                elif name == "reports":
+                    results["results"][name] = bench_reports(args, hydra, hydra_url, workdir)
+                elif name == "compact":
+                    results["results"][name] = bench_compact(args, hydra, hydra_url, workdir)
+                elif name == "snapshot":
+                    results["results"][name] = bench_snapshot(args, hydra, hydra_url, workdir)
+                elif name == "list_package_paths":
+                    results["results"][name] = bench_list_package_paths(args, hydra, hydra_url, workdir)
+                elif name == "mark_broken":
+                    results["results"][name] = bench_mark_broken(args, workdir)
+                elif name == "mark_broken_batch":
+                    results["results"][name] = bench_mark_broken_batch(args, workdir)
+                print(json.dumps(results["results"][name], indent=2))
+    finally:
+        hydra.stop()
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,7 @@ python3Packages.buildPythonPackage {
 
   doCheck = true;
 
-  propagatedBuildInputs = with python3Packages; [ pytest requests setuptools gnused ];
+  propagatedBuildInputs = with python3Packages; [ aiohttp pytest requests setuptools gnused ];
 
   meta = {
     mainProgram = "broken";
@@ -10,78 +10,256 @@
 
 #💡 the hydra endpoint /{project-id}/{jobset-id}/{job-id}/latest (as documented here: https://github.com/NixOS/hydra/issues/1036) will return the latest _working_ build for a job! This makes it very easy to see how long a job has been broken already.
 import argparse
+import asyncio
+import atexit
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
 import concurrent.futures
+import contextlib
 import datetime
-from functools import partial
-import hashlib
 import json
 import os
+import queue
 import requests
 import sqlite3
-import subprocess
 import sys
+import threading
+import time
+import urllib.parse
+from nixpkgs_broken import cache
+from nixpkgs_broken import git
+from nixpkgs_broken import ingest
+from nixpkgs_broken.metrics import metrics
+from nixpkgs_broken import nixeval
+from nixpkgs_broken import snapshot
 import nixpkgs_broken.mark_broken_v2
 
 class EvalFetcher:
-    def fetch(self, baseurl, jobset):
-        start = datetime.datetime.now()
-        evals = requests.get(f"{baseurl}/jobset/{jobset}/evals", headers={"Accept": "application/json", "Connection": "close"})
-        print("requesting evals took", datetime.datetime.now() - start)
-
-        baseurl_hash = hashlib.sha1(baseurl.encode()).hexdigest()[:8]
-        jobset_hash = hashlib.sha1(jobset.encode()).hexdigest()[:8]
-        filename = f"cache/evals-{baseurl_hash}-{jobset_hash}.json"
-        os.makedirs("cache")
-        print(f"Create eval cache with filename {filename}")
-        with open(filename, "w") as eval_file:
-            print(evals.text, file=eval_file)
+    def __init__(self, eval_cache):
+        self.eval_cache = eval_cache
+        self.next_page = None
 
-        # TODO(Mindavi): Handle errors
+    def fetch(self, baseurl, jobset):
+        filename = self.eval_cache.evals_path(baseurl, jobset)
+        with metrics.timed("http_fetch"), requests.get(f"{baseurl}/jobset/{jobset}/evals", headers={"Accept": "application/json"}, stream=True, timeout=(10, 60)) as evals:
+            evals.raise_for_status()
+            print(f"Create eval cache with filename {filename}")
+            self.eval_cache.store(filename, evals.iter_content(chunk_size=1 << 16))
 
-        all_evals = evals.json()["evals"]
+        all_evals = self.get_cache(baseurl, jobset)
 
         print(f"number of evals: {len(all_evals)}")
 
         return all_evals
 
+    def fetch_since(self, baseurl, jobset, eval_id, max_pages=50):
+        """Fetch the evals of the jobset, following the pagination until `eval_id` (or older) is found."""
+        all_evals = self.fetch(baseurl, jobset)
+        with requests.Session() as session:
+            next_page = self.next_page
+            for _ in range(max_pages):
+                if eval_id is None or not next_page or min(e["id"] for e in all_evals) <= eval_id:
+                    break
+                evals = session.get(f"{baseurl}/jobset/{jobset}/evals{next_page}", headers={"Accept": "application/json"}, timeout=(10, 60))
+                evals.raise_for_status()
+                page = evals.json()
+                if not page["evals"]:
+                    break
+                all_evals += page["evals"]
+                next_page = page.get("next")
+        return all_evals
+
     def get_cache(self, baseurl, jobset):
-        baseurl_hash = hashlib.sha1(baseurl.encode()).hexdigest()[:8]
-        jobset_hash = hashlib.sha1(jobset.encode()).hexdigest()[:8]
-        filename = f"cache/evals-{baseurl_hash}-{jobset_hash}.json"
+        filename = self.eval_cache.evals_path(baseurl, jobset)
         print(f"Loading cache from {filename}")
-        with open(filename, "r") as eval_file:
-            return json.load(eval_file)["evals"]
+        with self.eval_cache.open(filename) as eval_file, metrics.timed("json_decode"):
+            evals = json.load(eval_file)
+        self.next_page = evals.get("next")
+        return evals["evals"]
 
 class BuildsInEvalFetcher:
-    def fetch(self, baseurl, eval_id):
-        builds = requests.get(f"{baseurl}/eval/{last_eval_id}", headers={"Accept": "application/json"})
+    def __init__(self, eval_cache):
+        self.eval_cache = eval_cache
 
-        # TODO(Mindavi): Handle errors
+    def fetch(self, baseurl, eval_id):
+        filename = self.eval_cache.builds_path(baseurl, eval_id)
+        with metrics.timed("http_fetch"), requests.get(f"{baseurl}/eval/{eval_id}", headers={"Accept": "application/json"}, stream=True, timeout=(10, 300)) as builds:
+            builds.raise_for_status()
+            self.eval_cache.store(filename, builds.iter_content(chunk_size=1 << 16))
 
-        all_builds_in_eval = builds.json()["builds"]
+        all_builds_in_eval = self.get_cache(baseurl, eval_id)
         print(f"number of builds: {len(all_builds_in_eval)}")
 
-        baseurl_hash = hashlib.sha1(baseurl.encode()).hexdigest()[:8]
-        jobset_hash = hashlib.sha1(jobset.encode()).hexdigest()[:8]
-        os.makedirs("cache")
-        with open(f"cache/builds-{baseurl_hash}-{jobset_hash}.json", "w") as build_file:
-            print(builds.text, file=build_file)
-
         return all_builds_in_eval
 
-    def get_cache(self, baseurl, jobset):
-        baseurl_hash = hashlib.sha1(baseurl.encode()).hexdigest()[:8]
-        jobset_hash = hashlib.sha1(jobset.encode()).hexdigest()[:8]
-        with open(f"cache/builds-{baseurl_hash}-{jobset_hash}.json", "r") as build_file:
-            return json.load(build_file)["builds"]
+    def get_cache(self, baseurl, eval_id):
+        filename = self.eval_cache.builds_path(baseurl, eval_id)
+        with self.eval_cache.open(filename) as build_file, metrics.timed("json_decode"):
+            return list(cache.iter_array_items(build_file, "builds"))
+
+# Connection settings, see https://www.sqlite.org/pragma.html.
+DEFAULT_BUSY_TIMEOUT = 30.0
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+# In KiB.
+DEFAULT_CACHE_SIZE = 64 * 1024
+DEFAULT_READ_CONNECTIONS = 4
+
+def configure_connection(connection):
+    connection.execute(f"PRAGMA mmap_size = {DEFAULT_MMAP_SIZE}")
+    connection.execute(f"PRAGMA cache_size = -{DEFAULT_CACHE_SIZE}")
+
+class ReadConnectionPool:
+    """Read-only connections to a database file, for the reports.
+
+    A connection is opened whenever none is idle, so any number of queries can
+    be open at the same time; up to `size` idle connections are kept for reuse.
+    In WAL mode they read the last committed state, without waiting for the
+    writer and without making it wait.
+    """
+    def __init__(self, path, size=DEFAULT_READ_CONNECTIONS):
+        self.uri = f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro"
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        # Generators that stream from a connection may be finished on another thread.
+        connection = sqlite3.connect(self.uri, uri=True, timeout=DEFAULT_BUSY_TIMEOUT, check_same_thread=False)
+        configure_connection(connection)
+        return connection
+
+    def release(self, connection):
+        if connection.in_transaction:
+            connection.rollback()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for connection in idle:
+            connection.close()
 
 class Database:
-    def __init__(self, path):
-        self.connection = sqlite3.connect(path)
+    known_builds_query = "SELECT build_id, status FROM build_results WHERE eval_id = ?"
+    # Builds without status and the latest build of every failing job.system, newest builds first.
+    # A page of at most ?3 builds below the build ID ?2, see get_builds_to_recheck.
+    builds_to_recheck_query = """SELECT build_id, url, jobset, status FROM (
+        SELECT build_id, jobset_id, status FROM build_results WHERE status IS NULL AND build_id < ?2
+        UNION
+        SELECT build_id, jobset_id, status FROM job_streaks WHERE status != 0 AND ?1 AND build_id < ?2
+        ) rechecks INNER JOIN jobsets ON jobsets.jobset_id == rechecks.jobset_id
+        ORDER BY build_id DESC LIMIT ?3"""
+
+    # Breakage streaks in a single pass over the history: per job.system the latest build, the
+    # last successful build, the first failing build after it and how many failing builds
+    # followed. Builds are ordered by (eval_timestamp, build_id).
+    streaks_window_query = """WITH history AS (
+        SELECT build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id, num_evals,
+            first_value(CASE WHEN status = 0 THEN build_id END) OVER successes AS last_success_build_id,
+            first_value(CASE WHEN status = 0 THEN eval_timestamp END) OVER successes AS last_success_timestamp
+        FROM build_history WHERE status IS NOT NULL AND jobset_id IS NOT NULL {filter}
+        WINDOW successes AS (PARTITION BY job_id, system_id ORDER BY status = 0 DESC, eval_timestamp DESC, build_id DESC)
+    ), streaks AS (
+        SELECT *, status != 0 AND (last_success_build_id IS NULL OR (eval_timestamp, build_id) > (last_success_timestamp, last_success_build_id)) AS in_streak
+        FROM history
+    ), ranked AS (
+        SELECT *,
+            row_number() OVER (job ORDER BY eval_timestamp DESC, build_id DESC) AS recency,
+            first_value(CASE WHEN in_streak THEN eval_id END) OVER (job ORDER BY in_streak DESC, eval_timestamp, build_id) AS first_failure_eval_id,
+            first_value(CASE WHEN in_streak THEN eval_timestamp END) OVER (job ORDER BY in_streak DESC, eval_timestamp, build_id) AS first_failure_timestamp,
+            sum(CASE WHEN in_streak THEN num_evals ELSE 0 END) OVER job AS streak_evals
+        FROM streaks
+        WINDOW job AS (PARTITION BY job_id, system_id)
+    )
+    SELECT job_id, system_id, jobset_id, build_id, eval_id, eval_timestamp, status,
+        last_success_build_id, last_success_timestamp, first_failure_eval_id, first_failure_timestamp, streak_evals
+    FROM ranked WHERE recency = 1"""
+    # Hydra lists a build in every eval until its job is rebuilt, but it is stored only once, so
+    # streak_evals above counts failing builds. A streak counts the ingested evals of the jobset
+    # from the first failure on (at least one per failing build), and lasts until the latest one.
+    streak_columns = """max(streaks.streak_evals, (SELECT count(*) FROM ingested_evals
+            WHERE ingested_evals.jobset_id == streaks.jobset_id AND ingested_evals.eval_id >= streaks.first_failure_eval_id)) AS streak_evals,
+        (max(streaks.eval_timestamp, coalesce((SELECT max(eval_timestamp) FROM ingested_evals
+            WHERE ingested_evals.jobset_id == streaks.jobset_id), 0)) - streaks.first_failure_timestamp) / 86400.0 AS streak_days"""
+    streak_report_query = """SELECT build_id, url, jobset, eval_id, eval_timestamp, status, job, system,
+        last_success_build_id, last_success_timestamp, first_failure_eval_id, first_failure_timestamp,
+        {streak_columns}
+        FROM ({source}) streaks
+        INNER JOIN jobsets ON jobsets.jobset_id == streaks.jobset_id
+        INNER JOIN jobs ON jobs.job_id == streaks.job_id
+        INNER JOIN systems ON systems.system_id == streaks.system_id
+        WHERE status != 0
+        ORDER BY job, system"""
+    broken_report_query = streak_report_query.format(source="SELECT * FROM job_streaks", streak_columns=streak_columns)
+    broken_report_from_history_query = streak_report_query.format(source=streaks_window_query.format(filter=""), streak_columns=streak_columns)
+    # Every job that has a build with a known status, each name once.
+    completed_jobs_query = "SELECT job FROM jobs WHERE job_id IN (SELECT job_id FROM job_streaks) ORDER BY job"
+    # Failing jobs (status 1) with the last success we know of, locally or from Hydra (in last_successes).
+    # Jobs that succeeded come first, from the oldest success on.
+    failing_jobs_query = f"""SELECT streaks.build_id, url, jobset, status, jobs.job, systems.system,
+        coalesce(last_success_timestamp, last_successes.timestamp) AS last_success,
+        last_success_build_id IS NULL AND last_successes.checked_at IS NOT NULL AND last_successes.build_id IS NULL AS never_succeeded,
+        last_success_build_id IS NULL AND last_successes.checked_at IS NULL AS unknown,
+        {streak_columns}
+        FROM job_streaks streaks
+        INNER JOIN jobsets ON jobsets.jobset_id == streaks.jobset_id
+        INNER JOIN jobs ON jobs.job_id == streaks.job_id
+        INNER JOIN systems ON systems.system_id == streaks.system_id
+        LEFT JOIN last_successes ON last_successes.jobset_id == streaks.jobset_id
+            AND last_successes.job == jobs.job AND last_successes.system == systems.system
+        WHERE status = 1
+        ORDER BY last_success IS NULL, last_success, jobs.job, systems.system"""
+
+    build_results_schema = """CREATE TABLE IF NOT EXISTS {name}(
+        build_id        INTEGER PRIMARY KEY NOT NULL,
+        jobset_id       INTEGER,
+        eval_id         INTEGER             NOT NULL,
+        eval_timestamp  INTEGER             NOT NULL,
+        status          INTEGER,
+        job_id          INTEGER             NOT NULL,
+        system_id       INTEGER             NOT NULL,
+        FOREIGN KEY(jobset_id) REFERENCES jobsets(jobset_id),
+        FOREIGN KEY(job_id) REFERENCES jobs(job_id),
+        FOREIGN KEY(system_id) REFERENCES systems(system_id)
+        );
+        """
+
+    def __init__(self, path, wal=True, read_connections=DEFAULT_READ_CONNECTIONS):
+        """Open the database at `path`, creating and migrating the schema as needed.
+
+        With `wal`, a database file is switched to write-ahead logging, so reports
+        can read while an ingest writes. Reports then stream from a pool of
+        `read_connections` read-only connections, this connection is only used for
+        writes and small lookups. Without WAL, a reader would block the writer, so
+        everything goes through this connection.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=DEFAULT_BUSY_TIMEOUT)
         self.cursor = self.connection.cursor()
         self.cursor.execute("""PRAGMA foreign_keys = ON;""")
+        configure_connection(self.connection)
+        self.readers = None
+        # Stays in the rollback journal mode for in-memory databases, or if the file system doesn't support WAL.
+        if wal and path not in (":memory:", "") and self.cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0] == "wal":
+            # With NORMAL, commits in WAL mode survive a crash of the process, only a power loss can undo the last ones.
+            self.cursor.execute("PRAGMA synchronous = NORMAL")
+            if read_connections:
+                self.readers = ReadConnectionPool(path, read_connections)
         self.connection.commit()
 
         self.cursor.execute("""CREATE TABLE IF NOT EXISTS jobsets(
@@ -92,27 +270,552 @@ class Database:
         """)
         self.connection.commit()
 
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS build_results(
-        build_id        INTEGER PRIMARY KEY NOT NULL,
-        jobset_id       INTEGER,
-        eval_id         INTEGER             NOT NULL,
-        eval_timestamp  INTEGER             NOT NULL,
-        status          INTEGER,
-        job             TEXT            NOT NULL,
-        system          TEXT            NOT NULL,
-        FOREIGN KEY(jobset_id) REFERENCES jobsets(jobset_id)
+        # Job and system names are stored once, build_results refers to them by ID.
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS jobs(
+        job_id          INTEGER PRIMARY KEY NOT NULL,
+        job             TEXT                NOT NULL UNIQUE
+        );
+        """)
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS systems(
+        system_id       INTEGER PRIMARY KEY NOT NULL,
+        system          TEXT                NOT NULL UNIQUE
         );
         """)
         self.connection.commit()
 
+        self.cursor.execute(self.build_results_schema.format(name="build_results"))
+        self.connection.commit()
+        self.normalize_build_results()
+
+        # revision is the nixpkgs commit the file was resolved against, NULL if unknown.
         self.cursor.execute("""CREATE TABLE IF NOT EXISTS attr_files(
         attr_files_id   INTEGER PRIMARY KEY NOT NULL,
         attribute       TEXT                NOT NULL,
-        file            TEXT                NOT NULL
+        file            TEXT                NOT NULL,
+        revision        TEXT
+        );
+        """)
+        self.connection.commit()
+        self.add_attr_files_revision_column()
+
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS build_cache(
+        url             TEXT                NOT NULL,
+        build_id        INTEGER             NOT NULL,
+        finished        INTEGER             NOT NULL,
+        job             TEXT                NOT NULL,
+        system          TEXT                NOT NULL,
+        buildstatus     INTEGER,
+        timestamp       INTEGER             NOT NULL,
+        eval_id         INTEGER             NOT NULL,
+        etag            TEXT,
+        last_modified   TEXT,
+        fetched_at      INTEGER             NOT NULL,
+        PRIMARY KEY (url, build_id)
+        );
+        """)
+        self.connection.commit()
+
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS ingested_evals(
+        jobset_id       INTEGER             NOT NULL,
+        eval_id         INTEGER             NOT NULL,
+        eval_timestamp  INTEGER,
+        num_builds      INTEGER             NOT NULL,
+        ingested_at     INTEGER             NOT NULL,
+        PRIMARY KEY (jobset_id, eval_id),
+        FOREIGN KEY(jobset_id) REFERENCES jobsets(jobset_id)
+        );
+        """)
+        self.connection.commit()
+
+        # Evals whose builds were put in the work queue, but that aren't ingested yet.
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS queued_evals(
+        jobset_id       INTEGER             NOT NULL,
+        eval_id         INTEGER             NOT NULL,
+        eval_timestamp  INTEGER,
+        num_builds      INTEGER             NOT NULL,
+        queued_at       INTEGER             NOT NULL,
+        PRIMARY KEY (jobset_id, eval_id),
+        FOREIGN KEY(jobset_id) REFERENCES jobsets(jobset_id)
+        );
+        """)
+        self.connection.commit()
+
+        # The builds of a queued eval that still have to be fetched. A build that failed
+        # `attempts` times is retried at next_attempt_at, or is parked after too many attempts.
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS work_queue(
+        jobset_id       INTEGER             NOT NULL,
+        eval_id         INTEGER             NOT NULL,
+        build_id        INTEGER             NOT NULL,
+        attempts        INTEGER             NOT NULL DEFAULT 0,
+        next_attempt_at INTEGER             NOT NULL DEFAULT 0,
+        parked          INTEGER             NOT NULL DEFAULT 0,
+        last_error      TEXT,
+        PRIMARY KEY (jobset_id, eval_id, build_id),
+        FOREIGN KEY(jobset_id, eval_id) REFERENCES queued_evals(jobset_id, eval_id) ON DELETE CASCADE
+        );
+        """)
+        self.connection.commit()
+
+        # The latest successful build of a job according to Hydra, build_id is NULL if it never succeeded.
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS last_successes(
+        jobset_id       INTEGER             NOT NULL,
+        job             TEXT                NOT NULL,
+        system          TEXT                NOT NULL,
+        build_id        INTEGER,
+        timestamp       INTEGER,
+        checked_at      INTEGER             NOT NULL,
+        PRIMARY KEY (jobset_id, job, system),
+        FOREIGN KEY(jobset_id) REFERENCES jobsets(jobset_id)
         );
         """)
         self.connection.commit()
 
+        # Runs of builds older than the retention window with the same status, see compact_build_results.
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS build_intervals(
+        jobset_id       INTEGER             NOT NULL,
+        job_id          INTEGER             NOT NULL,
+        system_id       INTEGER             NOT NULL,
+        status          INTEGER             NOT NULL,
+        first_build_id  INTEGER             NOT NULL,
+        first_eval_id   INTEGER             NOT NULL,
+        first_timestamp INTEGER             NOT NULL,
+        last_build_id   INTEGER             NOT NULL,
+        last_eval_id    INTEGER             NOT NULL,
+        last_timestamp  INTEGER             NOT NULL,
+        num_evals       INTEGER             NOT NULL,
+        FOREIGN KEY(jobset_id) REFERENCES jobsets(jobset_id),
+        FOREIGN KEY(job_id) REFERENCES jobs(job_id),
+        FOREIGN KEY(system_id) REFERENCES systems(system_id)
+        );
+        """)
+        self.cursor.execute("""CREATE INDEX IF NOT EXISTS build_intervals_job_system
+            ON build_intervals (job_id, system_id, jobset_id)""")
+        # Compaction keeps the builds that later evals can still list, so their IDs don't have to be.
+        self.cursor.execute("DROP TABLE IF EXISTS compacted_builds")
+        # build_results plus the first and last build of every interval. num_evals is the number
+        # of builds a row stands for, so the builds in between are still counted.
+        self.cursor.execute("""CREATE VIEW IF NOT EXISTS build_history AS
+            SELECT build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id, 1 AS num_evals FROM build_results
+            UNION ALL
+            SELECT first_build_id, jobset_id, first_eval_id, first_timestamp, status, job_id, system_id, 1 FROM build_intervals
+            UNION ALL
+            SELECT last_build_id, jobset_id, last_eval_id, last_timestamp, status, job_id, system_id, num_evals - 1 FROM build_intervals WHERE num_evals > 1
+        """)
+        self.connection.commit()
+
+        self.create_jobsets_unique_index()
+        self.create_build_results_indexes()
+        self.create_job_streaks()
+        self.create_attr_files_unique_index()
+        # (url, jobset) -> jobset_id
+        self.jobset_ids = {}
+        # job -> job_id and system -> system_id
+        self.job_ids = {}
+        self.system_ids = {}
+
+    def create_jobsets_unique_index(self):
+        exists = self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'jobsets_unique'").fetchone()
+        if exists:
+            return
+        # Databases created before this index existed got a new jobsets row for every
+        # inserted build, so point all builds at the first row and drop the duplicates.
+        self.cursor.execute("""UPDATE build_results SET jobset_id = (
+            SELECT min(duplicate.jobset_id) FROM jobsets original
+            INNER JOIN jobsets duplicate ON duplicate.url = original.url AND duplicate.jobset = original.jobset
+            WHERE original.jobset_id = build_results.jobset_id)
+            WHERE jobset_id IS NOT NULL""")
+        self.cursor.execute("DELETE FROM jobsets WHERE jobset_id NOT IN (SELECT min(jobset_id) FROM jobsets GROUP BY url, jobset)")
+        self.cursor.execute("CREATE UNIQUE INDEX jobsets_unique ON jobsets (url, jobset)")
+        self.connection.commit()
+
+    def normalize_build_results(self):
+        columns = [row[1] for row in self.cursor.execute("PRAGMA table_info(build_results)")]
+        if "job" not in columns:
+            return
+        # Databases created before the jobs and systems tables existed store the names on every row.
+        print("Moving job and system names out of build_results, this only happens once")
+        with self.connection:
+            self.cursor.execute("INSERT OR IGNORE INTO jobs (job) SELECT DISTINCT job FROM build_results")
+            self.cursor.execute("INSERT OR IGNORE INTO systems (system) SELECT DISTINCT system FROM build_results")
+            self.cursor.execute(self.build_results_schema.format(name="build_results_normalized"))
+            self.cursor.execute("""INSERT INTO build_results_normalized
+                (build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id)
+                SELECT build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id FROM build_results
+                INNER JOIN jobs ON jobs.job == build_results.job
+                INNER JOIN systems ON systems.system == build_results.system""")
+            self.cursor.execute("DROP TABLE build_results")
+            self.cursor.execute("ALTER TABLE build_results_normalized RENAME TO build_results")
+        # Give the space of the old table back.
+        self.cursor.execute("VACUUM")
+
+    def create_job_streaks(self):
+        # streaks_window_query, kept up to date on every write to build_results.
+        exists = self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'job_streaks'").fetchone()
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS job_streaks(
+        job_id                  INTEGER     NOT NULL,
+        system_id               INTEGER     NOT NULL,
+        jobset_id               INTEGER     NOT NULL,
+        build_id                INTEGER     NOT NULL,
+        eval_id                 INTEGER     NOT NULL,
+        eval_timestamp          INTEGER     NOT NULL,
+        status                  INTEGER     NOT NULL,
+        last_success_build_id   INTEGER,
+        last_success_timestamp  INTEGER,
+        first_failure_eval_id   INTEGER,
+        first_failure_timestamp INTEGER,
+        streak_evals            INTEGER     NOT NULL,
+        PRIMARY KEY (job_id, system_id),
+        FOREIGN KEY(jobset_id) REFERENCES jobsets(jobset_id),
+        FOREIGN KEY(job_id) REFERENCES jobs(job_id),
+        FOREIGN KEY(system_id) REFERENCES systems(system_id)
+        );
+        """)
+        self.cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS stale_streaks(
+        job_id                  INTEGER     NOT NULL,
+        system_id               INTEGER     NOT NULL,
+        PRIMARY KEY (job_id, system_id)
+        );
+        """)
+        if not exists:
+            self.rebuild_job_streaks()
+        self.connection.commit()
+
+    def rebuild_job_streaks(self):
+        self.cursor.execute("DELETE FROM job_streaks")
+        self.cursor.execute(f"INSERT INTO job_streaks {self.streaks_window_query.format(filter='')}")
+
+    def update_job_streaks(self, rows):
+        """Apply newly written build_results rows to job_streaks.
+
+        Builds that are newer than the latest one of their job.system extend or
+        end its streak in place. For a job.system that got an older build, or
+        a new status for a build that was already counted, the streak is
+        computed again from its history.
+        """
+        latest = {}
+        stale = set()
+        updates = []
+        rows = sorted((row for row in rows if row[4] is not None), key=lambda row: (row[3], row[0]))
+        for row in rows:
+            [build_id, jobset_id, eval_id, timestamp, status, job_id, system_id] = row
+            pair = (job_id, system_id)
+            if pair in stale:
+                continue
+            if pair not in latest:
+                latest[pair] = self.cursor.execute("SELECT eval_timestamp, build_id, status FROM job_streaks WHERE job_id = ? AND system_id = ?", pair).fetchone()
+            if latest[pair] is None or (timestamp, build_id) > latest[pair][:2]:
+                latest[pair] = (timestamp, build_id, status)
+                updates.append(row)
+            elif latest[pair] != (timestamp, build_id, status):
+                stale.add(pair)
+        self.cursor.executemany("""INSERT INTO job_streaks
+            (build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id,
+            last_success_build_id, last_success_timestamp, first_failure_eval_id, first_failure_timestamp, streak_evals)
+            VALUES(?1, ?2, ?3, ?4, ?5, ?6, ?7,
+            CASE WHEN ?5 = 0 THEN ?1 END, CASE WHEN ?5 = 0 THEN ?4 END,
+            CASE WHEN ?5 != 0 THEN ?3 END, CASE WHEN ?5 != 0 THEN ?4 END, ?5 != 0)
+            ON CONFLICT(job_id, system_id) DO UPDATE SET
+            jobset_id = excluded.jobset_id,
+            build_id = excluded.build_id,
+            eval_id = excluded.eval_id,
+            eval_timestamp = excluded.eval_timestamp,
+            status = excluded.status,
+            last_success_build_id = coalesce(excluded.last_success_build_id, job_streaks.last_success_build_id),
+            last_success_timestamp = coalesce(excluded.last_success_timestamp, job_streaks.last_success_timestamp),
+            first_failure_eval_id = CASE WHEN excluded.status = 0 OR job_streaks.streak_evals = 0 THEN excluded.first_failure_eval_id ELSE job_streaks.first_failure_eval_id END,
+            first_failure_timestamp = CASE WHEN excluded.status = 0 OR job_streaks.streak_evals = 0 THEN excluded.first_failure_timestamp ELSE job_streaks.first_failure_timestamp END,
+            streak_evals = CASE WHEN excluded.status = 0 THEN 0 ELSE job_streaks.streak_evals + 1 END""",
+            [row for row in updates if (row[5], row[6]) not in stale])
+        if stale:
+            self.recompute_job_streaks(stale)
+
+    def recompute_job_streaks(self, pairs):
+        self.cursor.executemany("INSERT OR IGNORE INTO stale_streaks (job_id, system_id) VALUES(?, ?)", pairs)
+        self.cursor.execute("DELETE FROM job_streaks WHERE (job_id, system_id) IN (SELECT job_id, system_id FROM stale_streaks)")
+        self.cursor.execute("INSERT INTO job_streaks " + self.streaks_window_query.format(
+            filter="AND (job_id, system_id) IN (SELECT job_id, system_id FROM stale_streaks)"))
+        self.cursor.execute("DELETE FROM stale_streaks")
+
+    def add_attr_files_revision_column(self):
+        columns = [row[1] for row in self.cursor.execute("PRAGMA table_info(attr_files)")]
+        if "revision" not in columns:
+            self.cursor.execute("ALTER TABLE attr_files ADD COLUMN revision TEXT")
+            self.connection.commit()
+
+    def create_attr_files_unique_index(self):
+        exists = self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'attr_files_unique'").fetchone()
+        if exists:
+            return
+        # Keep the most recently added file for an attribute.
+        self.cursor.execute("DELETE FROM attr_files WHERE attr_files_id NOT IN (SELECT max(attr_files_id) FROM attr_files GROUP BY attribute)")
+        self.cursor.execute("CREATE UNIQUE INDEX attr_files_unique ON attr_files (attribute)")
+        self.connection.commit()
+
+    def create_build_results_indexes(self):
+        # The streaks of a job.system, see recompute_job_streaks.
+        self.cursor.execute("""CREATE INDEX IF NOT EXISTS build_results_job_system
+            ON build_results (job_id, system_id, eval_timestamp)""")
+        # get_known_builds
+        self.cursor.execute("""CREATE INDEX IF NOT EXISTS build_results_eval
+            ON build_results (eval_id)""")
+        # Was only used by the estimated last working build, which job_streaks replaced.
+        self.cursor.execute("DROP INDEX IF EXISTS build_results_successful")
+        # get_builds_to_recheck
+        self.cursor.execute("""CREATE INDEX IF NOT EXISTS build_results_without_status
+            ON build_results (build_id) WHERE status IS NULL""")
+        self.connection.commit()
+
+    def get_or_create_jobset_id(self, url, jobset):
+        jobset_id = self.jobset_ids.get((url, jobset))
+        if jobset_id is None:
+            self.cursor.execute("""INSERT OR IGNORE INTO jobsets (jobset_id, url, jobset) VALUES(NULL, ?, ?)""", (url, jobset))
+            jobset_id = self.get_jobset_id(url, jobset)
+            self.jobset_ids[(url, jobset)] = jobset_id
+        return jobset_id
+
+    def intern(self, table, column, ids, names):
+        """Add the `names` that aren't in `ids` to the lookup table, and return `ids` with all of them."""
+        missing = {name for name in names if name not in ids}
+        if missing:
+            self.cursor.executemany(f"INSERT OR IGNORE INTO {table} ({column}) VALUES(?)", ((name,) for name in missing))
+            for name in missing:
+                ids[name] = self.cursor.execute(f"SELECT {column}_id FROM {table} WHERE {column} = ?", (name,)).fetchone()[0]
+        return ids
+
+    def get_or_create_job_id(self, job):
+        return self.intern("jobs", "job", self.job_ids, [job])[job]
+
+    def get_or_create_system_id(self, system):
+        return self.intern("systems", "system", self.system_ids, [system])[system]
+
+    def insert_or_update_build_results(self, build_results):
+        """Insert or update many build results in a single transaction.
+
+        `build_results` is an iterable of (build_id, baseurl, jobset, eval_id, timestamp, status, jobname, system).
+        Existing rows only get their status updated, and only if the new status is known.
+        """
+        build_results = list(build_results)
+        stored = self.get_stored_builds([build_id for [build_id, *_] in build_results])
+        job_ids = self.intern("jobs", "job", self.job_ids, [jobname for [_, _, _, _, _, _, jobname, _] in build_results])
+        system_ids = self.intern("systems", "system", self.system_ids, [system for [_, _, _, _, _, _, _, system] in build_results])
+        rows = [
+            (build_id, self.get_or_create_jobset_id(baseurl, jobset), eval_id, timestamp, status, job_ids[jobname], system_ids[system])
+            for (build_id, baseurl, jobset, eval_id, timestamp, status, jobname, system) in build_results
+        ]
+        with metrics.timed("db_write"), self.connection:
+            self.cursor.executemany("""INSERT INTO build_results
+                (build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(build_id) DO UPDATE SET status = excluded.status
+                WHERE excluded.status IS NOT NULL""",
+                rows)
+            # job_streaks has to follow what is stored: an existing row keeps its eval, even if
+            # the build is now seen in a later one (e.g. by a recheck or on an eval page).
+            written = []
+            for row in rows:
+                [build_id, _, _, _, status, _, _] = row
+                previous = stored.get(build_id)
+                if previous is None:
+                    stored[build_id] = row
+                    written.append(row)
+                elif status is not None and status != previous[4]:
+                    stored[build_id] = (*previous[:4], status, *previous[5:])
+                    written.append(stored[build_id])
+            self.update_job_streaks(written)
+        metrics.increment("build_results_written", len(rows))
+        return len(rows)
+
+    def compact_build_results(self, before):
+        """Replace the finished builds of evals older than the timestamp `before` by intervals.
+
+        Consecutive builds of a job.system with the same status become one
+        build_intervals row, across jobsets like the streaks, and the interval
+        belongs to the jobset of its last build. Intervals from earlier compactions are merged
+        with the new ones. The latest build of a job.system in every jobset is
+        kept, as later evals list it until the job is rebuilt, and the intervals
+        end at it. Returns the number of removed builds and the number of
+        intervals they (and the intervals they were merged with) became.
+        """
+        with self.connection:
+            self.cursor.execute("""CREATE TEMP TABLE compacting AS SELECT * FROM (
+                SELECT jobset_id, job_id, system_id, status,
+                build_id AS first_build_id, eval_id AS first_eval_id, eval_timestamp AS first_timestamp,
+                build_id AS last_build_id, eval_id AS last_eval_id, eval_timestamp AS last_timestamp, 1 AS num_evals,
+                row_number() OVER (PARTITION BY jobset_id, job_id, system_id ORDER BY eval_timestamp DESC, build_id DESC) = 1 AS kept
+                FROM build_results WHERE jobset_id IS NOT NULL
+            ) WHERE first_timestamp < ? AND status IS NOT NULL""", (before,))
+            num_builds = self.cursor.execute("SELECT count(*) FROM compacting WHERE NOT kept").fetchone()[0]
+            self.cursor.execute("DELETE FROM build_results WHERE build_id IN (SELECT first_build_id FROM compacting WHERE NOT kept)")
+            self.cursor.execute("""CREATE TEMP TABLE compacting_keys AS
+                SELECT DISTINCT job_id, system_id FROM compacting""")
+            self.cursor.execute("""INSERT INTO compacting SELECT *, 0 FROM build_intervals
+                WHERE (job_id, system_id) IN (SELECT job_id, system_id FROM compacting_keys)""")
+            self.cursor.execute("""DELETE FROM build_intervals
+                WHERE (job_id, system_id) IN (SELECT job_id, system_id FROM compacting_keys)""")
+            # A run is a group of consecutive rows with the same status (gaps and islands). The kept
+            # builds take part, so that a run ends at them, but they don't become intervals.
+            self.cursor.execute("""INSERT INTO build_intervals WITH islands AS (
+                SELECT *, row_number() OVER (PARTITION BY job_id, system_id ORDER BY first_timestamp, first_build_id)
+                    - row_number() OVER (PARTITION BY job_id, system_id, status, kept ORDER BY first_timestamp, first_build_id) AS island
+                FROM compacting
+            ), runs AS (
+                SELECT last_value(jobset_id) OVER run AS jobset_id, job_id, system_id, status, kept,
+                    first_value(first_build_id) OVER run AS first_build_id,
+                    first_value(first_eval_id) OVER run AS first_eval_id,
+                    first_value(first_timestamp) OVER run AS first_timestamp,
+                    last_value(last_build_id) OVER run AS last_build_id,
+                    last_value(last_eval_id) OVER run AS last_eval_id,
+                    last_value(last_timestamp) OVER run AS last_timestamp,
+                    sum(num_evals) OVER run AS num_evals,
+                    row_number() OVER run AS position
+                FROM islands
+                WINDOW run AS (PARTITION BY job_id, system_id, status, kept, island ORDER BY first_timestamp, first_build_id
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+            )
+            SELECT jobset_id, job_id, system_id, status, first_build_id, first_eval_id, first_timestamp,
+                last_build_id, last_eval_id, last_timestamp, num_evals
+            FROM runs WHERE position = 1 AND NOT kept""")
+            num_intervals = self.cursor.rowcount
+            self.cursor.execute("DROP TABLE compacting")
+            self.cursor.execute("DROP TABLE compacting_keys")
+        return num_builds, num_intervals
+
+    @contextlib.contextmanager
+    def read_transaction(self):
+        """Yield a connection for `stream` on which all queries see the same state of the database."""
+        if self.readers is None:
+            yield self.connection
+            return
+        with self.readers.connection() as connection:
+            connection.execute("BEGIN")
+            yield connection
+
+    def get_snapshot_records(self, first_eval_id=None, last_eval_id=None):
+        """Yield everything a snapshot holds as (kind, *columns) records, for the evals in the given range.
+
+        jobsets, jobs and systems come first, as the other records refer to them by ID.
+        """
+        evals = (first_eval_id, last_eval_id)
+        with self.read_transaction() as connection:
+            for row in self.stream("SELECT jobset_id, url, jobset FROM jobsets", connection=connection):
+                yield ("jobset", *row)
+            for row in self.stream("SELECT job_id, job FROM jobs", connection=connection):
+                yield ("job", *row)
+            for row in self.stream("SELECT system_id, system FROM systems", connection=connection):
+                yield ("system", *row)
+            for row in self.stream("""SELECT build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id FROM build_results
+                    WHERE jobset_id IS NOT NULL AND eval_id >= coalesce(?1, eval_id) AND eval_id <= coalesce(?2, eval_id)""", evals, connection=connection):
+                yield ("build", *row)
+            for row in self.stream("""SELECT jobset_id, job_id, system_id, status, first_build_id, first_eval_id, first_timestamp,
+                    last_build_id, last_eval_id, last_timestamp, num_evals FROM build_intervals
+                    WHERE last_eval_id >= coalesce(?1, last_eval_id) AND first_eval_id <= coalesce(?2, first_eval_id)""", evals, connection=connection):
+                yield ("interval", *row)
+            for row in self.stream("""SELECT jobset_id, eval_id, eval_timestamp, num_builds, ingested_at FROM ingested_evals
+                    WHERE eval_id >= coalesce(?1, eval_id) AND eval_id <= coalesce(?2, eval_id)""", evals, connection=connection):
+                yield ("ingested_eval", *row)
+            for row in self.stream("SELECT jobset_id, job, system, build_id, timestamp, checked_at FROM last_successes", connection=connection):
+                yield ("last_success", *row)
+            for row in self.stream("SELECT attribute, file, revision FROM attr_files", connection=connection):
+                yield ("attr_file", *row)
+
+    def load_snapshot_records(self, records, batch_size=10000):
+        """Bulk load records of get_snapshot_records, possibly from another database, and return how many of each kind were read.
+
+        IDs are mapped to the ones of this database by URL and name, and rows
+        are merged like they would be by ingesting them. The build_results indexes
+        are dropped while loading and synchronous writes are turned off, so a
+        failed load can leave a corrupt database behind if the machine crashes.
+        """
+        jobset_ids = {}
+        job_ids = {}
+        system_ids = {}
+        counts = defaultdict(int)
+        synchronous = self.cursor.execute("PRAGMA synchronous").fetchone()[0]
+        self.cursor.execute("PRAGMA synchronous = OFF")
+        batch_kind = None
+        batch = []
+        def flush():
+            if batch_kind == "job":
+                ids = self.intern("jobs", "job", self.job_ids, [job for [_, job] in batch])
+                job_ids.update((job_id, ids[job]) for [job_id, job] in batch)
+            elif batch_kind == "system":
+                ids = self.intern("systems", "system", self.system_ids, [system for [_, system] in batch])
+                system_ids.update((system_id, ids[system]) for [system_id, system] in batch)
+            elif batch_kind == "compacted_build":
+                # Written by older versions, the builds they list are kept by compaction now.
+                pass
+            elif batch_kind == "build":
+                self.cursor.executemany("""INSERT INTO build_results
+                    (build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id)
+                    VALUES(?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(build_id) DO UPDATE SET status = excluded.status
+                    WHERE excluded.status IS NOT NULL""",
+                    ((build_id, jobset_ids[jobset_id], eval_id, timestamp, status, job_ids[job_id], system_ids[system_id])
+                    for [build_id, jobset_id, eval_id, timestamp, status, job_id, system_id] in batch))
+            elif batch_kind == "interval":
+                self.cursor.executemany("""INSERT INTO build_intervals
+                    (jobset_id, job_id, system_id, status, first_build_id, first_eval_id, first_timestamp,
+                    last_build_id, last_eval_id, last_timestamp, num_evals)
+                    SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, ?11
+                    WHERE NOT EXISTS (SELECT 1 FROM build_intervals WHERE job_id = ?2 AND system_id = ?3 AND first_build_id = ?5)""",
+                    ((jobset_ids[jobset_id], job_ids[job_id], system_ids[system_id], *rest)
+                    for [jobset_id, job_id, system_id, *rest] in batch))
+            elif batch_kind == "ingested_eval":
+                self.cursor.executemany("""INSERT OR REPLACE INTO ingested_evals
+                    (jobset_id, eval_id, eval_timestamp, num_builds, ingested_at)
+                    VALUES(?, ?, ?, ?, ?)""",
+                    ((jobset_ids[jobset_id], *rest) for [jobset_id, *rest] in batch))
+            elif batch_kind == "last_success":
+                self.cursor.executemany("""INSERT INTO last_successes
+                    (jobset_id, job, system, build_id, timestamp, checked_at)
+                    VALUES(?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(jobset_id, job, system) DO UPDATE SET
+                    build_id = excluded.build_id, timestamp = excluded.timestamp, checked_at = excluded.checked_at
+                    WHERE excluded.checked_at > last_successes.checked_at""",
+                    ((jobset_ids[jobset_id], *rest) for [jobset_id, *rest] in batch))
+            elif batch_kind == "attr_file":
+                self.cursor.executemany("""INSERT INTO attr_files
+                    (attribute, file, revision)
+                    VALUES(?, ?, ?)
+                    ON CONFLICT(attribute) DO UPDATE SET file = excluded.file, revision = excluded.revision""",
+                    batch)
+            batch.clear()
+        try:
+            with metrics.timed("db_write"), self.connection:
+                indexes = [name for [name] in self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'build_results' AND sql IS NOT NULL")]
+                for name in indexes:
+                    self.cursor.execute(f"DROP INDEX {name}")
+                for [kind, *columns] in records:
+                    counts[kind] += 1
+                    if kind == "jobset":
+                        [jobset_id, url, jobset] = columns
+                        jobset_ids[jobset_id] = self.get_or_create_jobset_id(url, jobset)
+                        continue
+                    if kind != batch_kind or len(batch) >= batch_size:
+                        flush()
+                        batch_kind = kind
+                    batch.append(columns)
+                flush()
+                self.rebuild_job_streaks()
+            self.create_build_results_indexes()
+        except BaseException:
+            # The rows behind these IDs may have been rolled back.
+            self.jobset_ids.clear()
+            self.job_ids.clear()
+            self.system_ids.clear()
+            raise
+        finally:
+            self.cursor.execute(f"PRAGMA synchronous = {synchronous}")
+        return dict(counts)
+
+    def close(self):
+        if self.readers is not None:
+            self.readers.close()
+        self.connection.close()
+
+    def build_result_writer(self, max_rows=1000, max_age=5.0):
+        return BuildResultWriter(self, max_rows, max_age)
+
     def insert_or_update_build_result(
         self,
         build_id,
@@ -124,51 +827,205 @@ class Database:
         jobname,
         system
     ):
-        self.cursor.execute("""INSERT OR IGNORE INTO jobsets (jobset_id, url, jobset) VALUES(NULL, ?, ?)""", (baseurl, jobset))
-        jobset_id = self.get_jobset_id(baseurl, jobset)
-        self.connection.commit()
-        if self.get_build_id(build_id) != None:
-            # Status is still none, no need to update DB row.
-            if status == None:
-                return
-            else:
-                self.update_build_status(build_id, status)
-                return
-        self.cursor.execute("""INSERT INTO build_results
-            (build_id, jobset_id, eval_id, eval_timestamp, status, job, system)
-            VALUES(?, ?, ?, ?, ?, ?, ?)""",
-            (build_id, jobset_id, eval_id, timestamp, status, jobname, system))
-        self.connection.commit()
+        self.insert_or_update_build_results([(build_id, baseurl, jobset, eval_id, timestamp, status, jobname, system)])
 
-    def insert_or_update_attr_file(
-        self,
-        attribute,
-        file
-    ):
-        if self.get_attr_file(attribute) != None:
-            self.update_attr_file(attribute, file)
-            return
-        self.cursor.execute("""INSERT INTO attr_files
-            (attribute, file)
-            VALUES(?, ?)""",
-            (attribute, file,))
-        self.connection.commit()
+    def insert_or_update_attr_files(self, attr_files, revision=None):
+        """Insert or update many (attribute, file) rows, resolved against nixpkgs `revision`, in a single transaction."""
+        with self.connection:
+            self.cursor.executemany("""INSERT INTO attr_files
+                (attribute, file, revision)
+                VALUES(?, ?, ?)
+                ON CONFLICT(attribute) DO UPDATE SET file = excluded.file, revision = excluded.revision""",
+                ((attribute, file, revision) for [attribute, file] in attr_files))
 
-    def remove_attr_file(self, attribute):
-        if self.get_attr_file(attribute) == None:
-            # Not present?
-            return
-        self.cursor.execute("""DELETE FROM attr_files
-            WHERE attribute = ?""", (attribute,))
-        self.connection.commit()
+    def get_attr_file_revisions(self):
+        res = self.cursor.execute("SELECT DISTINCT revision FROM attr_files WHERE revision IS NOT NULL")
+        return [revision for [revision] in res]
+
+    def carry_over_attr_files(self, old_revision, new_revision, changed_files):
+        """Move the attr_files rows of `old_revision` to `new_revision`, except those whose file is in `changed_files`.
+
+        Returns the number of rows that were carried over.
+        """
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS changed_files(file TEXT PRIMARY KEY NOT NULL)")
+        with self.connection:
+            self.cursor.execute("DELETE FROM temp.changed_files")
+            self.cursor.executemany("INSERT OR IGNORE INTO temp.changed_files (file) VALUES(?)", ((file,) for file in changed_files))
+            res = self.cursor.execute("""UPDATE attr_files SET revision = ?
+                WHERE revision = ? AND file NOT IN (SELECT file FROM temp.changed_files)""",
+                (new_revision, old_revision))
+            self.cursor.execute("DELETE FROM temp.changed_files")
+        return res.rowcount
+
+    def remove_attr_files(self, attributes):
+        with self.connection:
+            self.cursor.executemany("""DELETE FROM attr_files
+                WHERE attribute = ?""", ((attribute,) for attribute in attributes))
+
+    def insert_or_update_cached_builds(self, cached_builds):
+        """Store many (url, build_id, finished, job, system, buildstatus, timestamp, eval_id, etag, last_modified, fetched_at) rows."""
+        with self.connection:
+            self.cursor.executemany("""INSERT OR REPLACE INTO build_cache
+                (url, build_id, finished, job, system, buildstatus, timestamp, eval_id, etag, last_modified, fetched_at)
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                cached_builds)
+
+    def touch_cached_builds(self, builds, fetched_at):
+        with self.connection:
+            self.cursor.executemany("UPDATE build_cache SET fetched_at = ? WHERE url = ? AND build_id = ?",
+                ((fetched_at, url, build_id) for [url, build_id] in builds))
+
+    def get_cached_build(self, url, build_id):
+        res = self.cursor.execute("""SELECT finished, job, system, buildstatus, timestamp, eval_id, etag, last_modified, fetched_at
+            FROM build_cache WHERE url = ? AND build_id = ?""", (url, build_id))
+        return res.fetchone()
+
+    def mark_eval_ingested(self, url, jobset, eval_id, eval_timestamp, num_builds):
+        """Record the eval as ingested. It stays queued as long as it has parked builds."""
+        jobset_id = self.get_or_create_jobset_id(url, jobset)
+        with self.connection:
+            self.cursor.execute("""INSERT OR REPLACE INTO ingested_evals
+                (jobset_id, eval_id, eval_timestamp, num_builds, ingested_at)
+                VALUES(?, ?, ?, ?, ?)""",
+                (jobset_id, eval_id, eval_timestamp, num_builds, int(time.time())))
+            self.cursor.execute("""DELETE FROM queued_evals WHERE jobset_id = ? AND eval_id = ?
+                AND NOT EXISTS (SELECT 1 FROM work_queue WHERE work_queue.jobset_id = queued_evals.jobset_id AND work_queue.eval_id = queued_evals.eval_id)""",
+                (jobset_id, eval_id))
+
+    def enqueue_eval(self, url, jobset, eval_id, eval_timestamp, num_builds, build_ids):
+        """Put the builds of an eval that still have to be fetched in the work queue, in one transaction."""
+        jobset_id = self.get_or_create_jobset_id(url, jobset)
+        with self.connection:
+            # Not INSERT OR REPLACE, that would delete the work queue of the eval along with the old row.
+            self.cursor.execute("""INSERT INTO queued_evals
+                (jobset_id, eval_id, eval_timestamp, num_builds, queued_at)
+                VALUES(?, ?, ?, ?, ?)
+                ON CONFLICT(jobset_id, eval_id) DO UPDATE SET queued_at = excluded.queued_at""",
+                (jobset_id, eval_id, eval_timestamp, num_builds, int(time.time())))
+            self.cursor.executemany("""INSERT OR IGNORE INTO work_queue (jobset_id, eval_id, build_id)
+                VALUES(?, ?, ?)""", ((jobset_id, eval_id, build_id) for build_id in build_ids))
+
+    def get_queued_evals(self, url, jobset):
+        """Return (eval_id, eval_timestamp, num_builds) for the queued evals that have work left to do, oldest first.
+
+        That's every eval that isn't ingested yet, and every eval with builds that are waiting to be retried.
+        """
+        res = self.cursor.execute("""SELECT eval_id, eval_timestamp, num_builds FROM queued_evals
+            INNER JOIN jobsets ON jobsets.jobset_id == queued_evals.jobset_id
+            WHERE url = ? AND jobset = ? AND (
+                NOT EXISTS (SELECT 1 FROM ingested_evals WHERE ingested_evals.jobset_id = queued_evals.jobset_id AND ingested_evals.eval_id = queued_evals.eval_id)
+                OR EXISTS (SELECT 1 FROM work_queue WHERE work_queue.jobset_id = queued_evals.jobset_id AND work_queue.eval_id = queued_evals.eval_id AND NOT parked))
+            ORDER BY eval_id""", (url, jobset))
+        return res.fetchall()
+
+    def get_due_work(self, url, jobset, eval_id, now):
+        res = self.cursor.execute("""SELECT build_id FROM work_queue
+            INNER JOIN jobsets ON jobsets.jobset_id == work_queue.jobset_id
+            WHERE url = ? AND jobset = ? AND eval_id = ? AND NOT parked AND next_attempt_at <= ?""", (url, jobset, eval_id, now))
+        return [build_id for [build_id] in res]
+
+    def get_work_summary(self, url, jobset, eval_id):
+        """Return the number of waiting builds, the earliest time one of them may be retried, and the number of parked builds."""
+        res = self.cursor.execute("""SELECT
+            count(*) FILTER (WHERE NOT parked), min(next_attempt_at) FILTER (WHERE NOT parked), count(*) FILTER (WHERE parked)
+            FROM work_queue
+            INNER JOIN jobsets ON jobsets.jobset_id == work_queue.jobset_id
+            WHERE url = ? AND jobset = ? AND eval_id = ?""", (url, jobset, eval_id))
+        return res.fetchone()
+
+    def remove_work(self, url, jobset, eval_id, build_ids):
+        jobset_id = self.get_or_create_jobset_id(url, jobset)
+        with self.connection:
+            self.cursor.executemany("DELETE FROM work_queue WHERE jobset_id = ? AND eval_id = ? AND build_id = ?",
+                ((jobset_id, eval_id, build_id) for build_id in build_ids))
+
+    def record_work_failures(self, url, jobset, eval_id, failures, now, backoff, max_attempts):
+        """Count a failed attempt for every (build_id, error) in `failures`.
+
+        The next attempt is postponed by `backoff` seconds, doubling with every
+        attempt. After `max_attempts` attempts the build is parked.
+        """
+        jobset_id = self.get_or_create_jobset_id(url, jobset)
+        with self.connection:
+            self.cursor.executemany("""UPDATE work_queue SET
+                attempts = attempts + 1,
+                next_attempt_at = ? + ? * (1 << attempts),
+                parked = attempts + 1 >= ?,
+                last_error = ?
+                WHERE jobset_id = ? AND eval_id = ? AND build_id = ?""",
+                ((now, backoff, max_attempts, error, jobset_id, eval_id, build_id) for [build_id, error] in failures))
+
+    def unpark_work(self):
+        """Give all parked builds a new set of attempts, returns the number of builds."""
+        with self.connection:
+            res = self.cursor.execute("UPDATE work_queue SET attempts = 0, next_attempt_at = 0, parked = 0 WHERE parked")
+        return res.rowcount
+
+    def get_last_ingested_eval(self, url, jobset):
+        res = self.cursor.execute("""SELECT max(eval_id) FROM ingested_evals
+            INNER JOIN jobsets ON jobsets.jobset_id == ingested_evals.jobset_id
+            WHERE url = ? AND jobset = ?""", (url, jobset))
+        return res.fetchone()[0]
+
+    def insert_or_update_last_successes(self, last_successes):
+        """Store many (url, jobset, job, system, build_id, timestamp) rows, build_id is None if the job never succeeded."""
+        checked_at = int(time.time())
+        rows = [
+            (self.get_or_create_jobset_id(url, jobset), job, system, build_id, timestamp, checked_at)
+            for [url, jobset, job, system, build_id, timestamp] in last_successes
+        ]
+        with self.connection:
+            self.cursor.executemany("""INSERT OR REPLACE INTO last_successes
+                (jobset_id, job, system, build_id, timestamp, checked_at)
+                VALUES(?, ?, ?, ?, ?, ?)""",
+                rows)
 
     def get_known_builds(self, eval_id):
-        known_builds = self.cursor.execute("SELECT build_id, status FROM build_results WHERE eval_id = ?", (eval_id,))
+        known_builds = self.cursor.execute(self.known_builds_query, (eval_id,))
         found_builds = []
         for [build_id, status] in known_builds:
             found_builds.append((build_id, status))
         return found_builds
 
+    def get_unknown_builds(self, build_ids):
+        """Split `build_ids` into builds that are not in the database and builds that are stored without a status.
+
+        Builds that are stored with a status are left out. Returns a tuple of two lists.
+        """
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS candidate_builds(build_id INTEGER PRIMARY KEY NOT NULL)")
+        self.cursor.execute("DELETE FROM temp.candidate_builds")
+        self.cursor.executemany("INSERT OR IGNORE INTO temp.candidate_builds (build_id) VALUES(?)", ((build_id,) for build_id in build_ids))
+        res = self.cursor.execute("""SELECT candidate_builds.build_id, build_results.build_id IS NULL
+            FROM temp.candidate_builds
+            LEFT JOIN build_results ON build_results.build_id = candidate_builds.build_id
+            WHERE build_results.build_id IS NULL OR build_results.status IS NULL""")
+        unknown_builds = []
+        builds_without_status = []
+        for [build_id, unknown] in res:
+            if unknown:
+                unknown_builds.append(build_id)
+            else:
+                builds_without_status.append(build_id)
+        self.cursor.execute("DELETE FROM temp.candidate_builds")
+        self.connection.commit()
+        return unknown_builds, builds_without_status
+
+    def get_stored_builds(self, build_ids):
+        """Look up `build_ids` in the database.
+
+        Returns a dict from the stored ones to their build_results row
+        (build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id).
+        """
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS candidate_builds(build_id INTEGER PRIMARY KEY NOT NULL)")
+        self.cursor.execute("DELETE FROM temp.candidate_builds")
+        self.cursor.executemany("INSERT OR IGNORE INTO temp.candidate_builds (build_id) VALUES(?)", ((build_id,) for build_id in build_ids))
+        res = self.cursor.execute("""SELECT build_results.build_id, jobset_id, eval_id, eval_timestamp, status, job_id, system_id
+            FROM temp.candidate_builds
+            INNER JOIN build_results ON build_results.build_id = candidate_builds.build_id""")
+        stored = {row[0]: row for row in res}
+        self.cursor.execute("DELETE FROM temp.candidate_builds")
+        return stored
+
     def get_build_id(self, build_id):
         res = self.cursor.execute("SELECT build_id, status FROM build_results WHERE build_id = ?", (build_id,))
         return res.fetchone()
@@ -177,79 +1034,227 @@ class Database:
         res = self.cursor.execute("""SELECT jobset_id FROM jobsets WHERE url = ? and jobset = ?""", (url, jobset,))
         return res.fetchone()[0]
 
-    def get_attr_file(self, attribute):
-        res = self.cursor.execute("SELECT file FROM attr_files WHERE attribute = ?", (attribute,))
-        return res.fetchone()
+    def get_attr_files(self):
+        """Return a dict from attribute to (file, revision)."""
+        res = self.cursor.execute("SELECT attribute, file, revision FROM attr_files")
+        return {attribute: (file, revision) for [attribute, file, revision] in res}
 
     def update_build_status(self, build_id, new_status):
-        self.cursor.execute("UPDATE build_results SET status = ? WHERE build_id = ?", (new_status, build_id))
-        self.connection.commit()
+        with self.connection:
+            self.cursor.execute("UPDATE build_results SET status = ? WHERE build_id = ?", (new_status, build_id))
+            pairs = self.cursor.execute("SELECT job_id, system_id FROM build_results WHERE build_id = ?", (build_id,)).fetchall()
+            self.recompute_job_streaks(pairs)
 
-    def update_attr_file(self, attribute, file):
-        self.cursor.execute("UPDATE attr_files SET file = ? WHERE attribute = ?", (file, attribute,))
-        self.connection.commit()
+    def stream(self, query, params=(), batch_size=1000, connection=None):
+        """Yield the rows of `query` in batches of `batch_size`, without reading all of them into memory.
 
-    def get_broken_builds(self):
-        # Select only latest builds (highest timestamp per job.system combination)
-        # TODO(Mindavi): only use the latest eval(s) per jobset, because packages might be marked broken or removed
-        res = self.cursor.execute(
-            "SELECT * FROM (SELECT build_id, url, jobset, eval_id, max(eval_timestamp), status, job, system FROM build_results INNER JOIN jobsets ON jobsets.jobset_id == build_results.jobset_id WHERE status IS NOT NULL GROUP BY job, system) WHERE status != 0")
-        return res.fetchall()
+        The query runs on its own cursor of `connection`, by default a read-only
+        connection from the pool, so other queries and writes can run while iterating.
+        Only committed writes are visible to a read-only connection.
+        """
+        if connection is None and self.readers is not None:
+            with self.readers.connection() as connection:
+                yield from self.stream(query, params, batch_size, connection)
+            return
+        cursor = (connection or self.connection).cursor()
+        try:
+            cursor.execute(query, params)
+            while rows := cursor.fetchmany(batch_size):
+                yield from rows
+        finally:
+            cursor.close()
 
-    def get_builds_without_status(self):
-        res = self.cursor.execute("SELECT build_id, status, job, system, url, jobset, eval_id FROM build_results INNER JOIN jobsets ON jobsets.jobset_id == build_results.jobset_id WHERE status IS NULL")
-        return res.fetchall()
+    def get_broken_report(self):
+        """Return the latest build of every failing job.system with its breakage streak.
 
-    def get_estimated_last_working_build(self, jobname, system):
-        res = self.cursor.execute("SELECT build_id, status, max(eval_timestamp) FROM build_results WHERE status = 0 AND job = ? AND system = ?", (jobname, system))
-        return res.fetchone()
+        Rows are (build_id, url, jobset, eval_id, eval_timestamp, status, job, system,
+        last_success_build_id, last_success_timestamp, first_failure_eval_id,
+        first_failure_timestamp, streak_evals, streak_days). The last success is
+        None if the job never succeeded in the local history.
+        """
+        return self.stream(self.broken_report_query)
 
-    def get_all_last_completed_builds(self):
-        res = self.cursor.execute("SELECT build_id, status, job, system, url, jobset FROM (SELECT build_id, status, job, system, url, jobset, max(eval_timestamp) over (partition by job, system) max_eval_timestamp FROM build_results INNER JOIN jobsets ON jobsets.jobset_id == build_results.jobset_id WHERE status IS NOT NULL) GROUP by job,system")
-        return res.fetchall()
+    def get_broken_report_from_history(self):
+        """Same as get_broken_report, but computed from build_results instead of job_streaks."""
+        return self.stream(self.broken_report_from_history_query)
 
-def get_build_result(baseurl, build_id):
-    build_result = requests.get(f"{baseurl}/build/{build_id}", headers={"Accept": "application/json"}, timeout=(10, 30))
-    try:
-        job = build_result.json()["job"]
-        status = build_result.json()["buildstatus"]
-        timestamp = build_result.json()["timestamp"]
-        build_system = build_result.json()["system"]
-        # Assumes ordering from high to low.
-        last_eval_id = build_result.json()["jobsetevals"][0]
-    except:
-        print(f"build {build_id} unknown status, {build_result}", file=sys.stderr)
-        return None
-    # status can be:
-    #   None: not built yet
-    #   0: success
-    #   1: Build returned a non-zero exit code
-    #   2: dependency failed
-    #   3: aborted
-    #   4: canceled by the user
-    #   6: failed with output
-    #   7: timed out
-    #   9: aborted
-    #   10: log size limit exceeded
-    #   11: output limit exceeded
-    if "." in job:
-        jobname, system = job.rsplit(".", maxsplit=1)
-        # Sanity check for system name.
-        known_system = system in ["aarch64-linux", "x86_64-linux", "x86_64-darwin", "aarch64-darwin"]
-        # e.g. stdenvBootstrapTools.x86_64-darwin.test, or stdenvBootstrapTools.x86_64-darwin.dist
-        # let's just skip em for now.
-        host_is_not_build = system != build_system
-        if not known_system:
-            print(f"Unknown system {system} in job {job} with id {build_id}, skipping")
-        elif host_is_not_build:
-            print(f"Host system {system} is not equal to build system {build_system}")
-        else:
-            # For now, make this a hard assumption. We can always relax later.
-            assert(system == build_system)
-            return (build_id, baseurl, last_eval_id, timestamp, status, jobname, system)
-    else:
-        print(f"Job without system (job: {job}, id: {build_id}, status: {status}), skipping")
-    return None
+    def get_builds_to_recheck(self, include_failed=False, page_size=1000):
+        """Yield (build_id, url, jobset, status) of the builds that may have a new status, newest first.
+
+        These are the builds without status, and with `include_failed` also the
+        latest build of every failing job.system, in case Hydra restarted it.
+        They are read in pages of `page_size` builds, each in its own short read,
+        so a long recheck doesn't hold back WAL checkpoints or block the writer.
+        """
+        before = sys.maxsize
+        while True:
+            page = list(self.stream(self.builds_to_recheck_query, (include_failed, before, page_size)))
+            yield from page
+            if len(page) < page_size:
+                return
+            before = page[-1][0]
+
+    def count_builds_to_recheck(self, include_failed=False):
+        return self.cursor.execute(f"SELECT count(*) FROM ({self.builds_to_recheck_query})", (include_failed, sys.maxsize, -1)).fetchone()[0]
+
+    def get_completed_jobs(self):
+        for [job] in self.stream(self.completed_jobs_query):
+            yield job
+
+    def get_failing_jobs(self):
+        """Yield (build_id, url, jobset, status, job, system, last_success, never_succeeded, unknown, streak_evals, streak_days) for every failing job.system.
+
+        last_success is the timestamp of the last successful build, from the local
+        history or from Hydra. If there is none, never_succeeded tells that Hydra
+        said there was none, and unknown that Hydra wasn't asked yet.
+        """
+        return self.stream(self.failing_jobs_query)
+
+    def explain_report_queries(self):
+        """Run the report queries and return (name, query plan, duration, number of rows) for each."""
+        queries = [
+            ("get_broken_report", self.broken_report_query, ()),
+            ("get_broken_report_from_history", self.broken_report_from_history_query, ()),
+            ("get_builds_to_recheck", self.builds_to_recheck_query, (True, sys.maxsize, -1)),
+            ("get_completed_jobs", self.completed_jobs_query, ()),
+            ("get_failing_jobs", self.failing_jobs_query, ()),
+            ("get_known_builds", self.known_builds_query, (0,)),
+        ]
+        explained = []
+        for [name, query, params] in queries:
+            depths = {0: 0}
+            plan = []
+            for [node_id, parent, _, detail] in self.cursor.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall():
+                depths[node_id] = depths.get(parent, 0) + 1
+                plan.append(f"{'  ' * (depths[node_id] - 1)}{detail}")
+            start = time.monotonic()
+            num_rows = len(self.cursor.execute(query, params).fetchall())
+            explained.append((name, plan, time.monotonic() - start, num_rows))
+        return explained
+
+class BuildResultWriter:
+    """Buffers build results and writes them to the database in batches.
+
+    A batch is written when it holds `max_rows` results, or when a result is added
+    more than `max_age` seconds after the oldest buffered one. Use as a context
+    manager to make sure the last batch is written as well.
+    """
+    def __init__(self, database, max_rows=1000, max_age=5.0):
+        self.database = database
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.pending = []
+        self.oldest = None
+        self.written = 0
+
+    def add(self, build_result):
+        if not self.pending:
+            self.oldest = time.monotonic()
+        self.pending.append(build_result)
+        if len(self.pending) >= self.max_rows or time.monotonic() - self.oldest >= self.max_age:
+            self.flush()
+
+    async def add_async(self, build_result):
+        self.add(build_result)
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.written += self.database.insert_or_update_build_results(self.pending)
+        self.pending = []
+        self.oldest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+class DatabaseWriter:
+    """Owns the only connection that writes to the database while several jobsets are ingested at once.
+
+    Build results are handed over with `add`, other writes with `submit`. Both go
+    through one queue that a dedicated thread drains, so a submitted write runs
+    after every build result that was added before it has been written. The
+    queue is bounded, which slows down the producers if the writes can't keep up.
+    `add` and `submit` block while the queue is full, on the event loop use
+    `add_async` and `submit_async` instead.
+    """
+    def __init__(self, path, max_rows=1000, max_age=5.0, max_queued=10000):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.queue = queue.Queue(max_queued)
+        self.thread = threading.Thread(target=self.run, name="database-writer")
+        self.error = None
+
+    def add(self, build_result):
+        self.queue.put((None, build_result))
+
+    async def add_async(self, build_result):
+        await self.put_async((None, build_result))
+
+    def submit(self, function):
+        """Run `function(database)` on the writer thread, returns a concurrent.futures.Future of its result."""
+        future = concurrent.futures.Future()
+        self.queue.put((function, future))
+        return future
+
+    async def submit_async(self, function):
+        """Like `submit`, but waits for room in the queue without blocking the event loop."""
+        future = concurrent.futures.Future()
+        await self.put_async((function, future))
+        return future
+
+    async def put_async(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            await asyncio.to_thread(self.queue.put, item)
+
+    def run(self):
+        database = Database(self.path)
+        try:
+            self.drain(database)
+        finally:
+            database.close()
+
+    def drain(self, database):
+        with database.build_result_writer(self.max_rows, self.max_age) as writer:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.max_age)
+                except queue.Empty:
+                    writer.flush()
+                    continue
+                if item is None:
+                    break
+                [function, value] = item
+                if self.error is not None:
+                    # Keep draining, so the producers don't block on a full queue.
+                    if function is not None:
+                        value.set_exception(self.error)
+                    continue
+                try:
+                    if function is None:
+                        writer.add(value)
+                    else:
+                        writer.flush()
+                        value.set_result(function(database))
+                except Exception as e:
+                    self.error = e
+                    if function is not None:
+                        value.set_exception(e)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None and exc_type is None:
+            raise self.error
 
 problematicAttrsListPaths = [
     'darwin.',
@@ -275,21 +1280,40 @@ problematicAttrsListPaths = [
     'xorg.',
 ]
 
-def list_package_paths(database, nixpkgs_path):
+def refresh_attr_files(database, nixpkgs_path):
+    """Carry the attr_files rows of earlier nixpkgs revisions over to the checked out one.
+
+    Rows whose file changed since their revision (according to git) stay behind,
+    so they are resolved again. Returns the checked out revision, or None if
+    nixpkgs_path isn't a git checkout.
+    """
+    revision = git.head_revision(nixpkgs_path) if nixpkgs_path else None
+    if revision is None:
+        return None
+    for old_revision in database.get_attr_file_revisions():
+        if old_revision == revision:
+            continue
+        changed_files = git.changed_files(nixpkgs_path, old_revision)
+        if changed_files is None:
+            continue
+        # The files are stored relative to the CWD, see list_package_paths.
+        number = database.carry_over_attr_files(old_revision, revision, [os.path.relpath(file) for file in changed_files])
+        print(f"{number} attribute files carried over from {old_revision[:12]}, {len(changed_files)} files changed since")
+    return revision
+
+def list_package_paths(database, nixpkgs_path, eval_jobs=None, chunk_size=nixeval.DEFAULT_CHUNK_SIZE):
     """List all packages that have multiple attribute names."""
     # TODO(Mindavi): what was this needed for? To filter duplicate attributes?
     paths_with_attrs = defaultdict(set)
-    res = database.get_all_last_completed_builds()
-    assert(len(res) > 0)
+    revision = refresh_attr_files(database, nixpkgs_path)
+    known_attr_files = database.get_attr_files()
     counter = 0
-    done = set()
-    for [build_id, status, jobname, system, url, jobset] in res:
+    stale_attrs = []
+    unresolved_attrs = []
+    for jobname in database.get_completed_jobs():
         counter += 1
         if counter % 500 == 0 and counter != 0:
-            print(f"Processing... {counter}/{len(res)}")
-        if jobname in done:
-            continue
-        done.add(jobname)
+            print(f"Processing... {counter}")
         # Skip some problematic packages / package sets.
         skip = False
         for problematicAttr in problematicAttrsListPaths:
@@ -300,234 +1324,468 @@ def list_package_paths(database, nixpkgs_path):
             continue
 
         # NOTE(Mindavi): assume the same file will be returned for all systems.
-        file = database.get_attr_file(jobname)
-        if file:
-            nixFile = file[0]
-            if not os.path.exists(nixFile):
-                print(f"fallback for {jobname}: {nixFile} does not exist anymore")
-                # This entry is stale, so remove it.
-                database.remove_attr_file(jobname)
-                file = None
-        if not file:
-            assert nixpkgs_path, "nixpkgs_path argument is required"
-            assert jobname, "missing job name"
-            nixInstantiate = subprocess.run([ "nix-instantiate", "--eval", "--json", "-E", f"with import {nixpkgs_path} {{}}; (builtins.unsafeGetAttrPos \"description\" {jobname}.meta).file" ], capture_output=True)
-            if nixInstantiate.returncode != 0:
-                errorMessage = nixInstantiate.stderr.decode('utf-8')
-                errorLine = ", ".join(list(map(lambda y: y.strip(), filter(lambda x: "error: " in x, errorMessage.splitlines()))))
-                # TODO(Mindavi): Do something with the error message, e.g. these are somewhat actionable:
-                # - error: attribute 'volume-scroller' missing (in case it was an attribute of a package set)
-                # - error: undefined variable 'graalvm11-ce' (in case it was a top-level attribute)
-                # - error: expected a set but found null: null (not sure when this happens?)
-                print(f"error during nix-instantiate for attr {jobname}:", errorLine)
+        nixFile, nixFileRevision = known_attr_files.get(jobname, (None, None))
+        if nixFile and revision is not None and nixFileRevision != revision:
+            # Its file changed since it was resolved, or we don't know against which revision it was resolved.
+            nixFile = None
+        elif nixFile and not os.path.exists(nixFile):
+            print(f"fallback for {jobname}: {nixFile} does not exist anymore")
+            # This entry is stale, so remove it.
+            stale_attrs.append(jobname)
+            nixFile = None
+        if not nixFile:
+            unresolved_attrs.append(jobname)
+            continue
+        paths_with_attrs[nixFile].add(jobname)
+    assert(counter > 0)
+    database.remove_attr_files(stale_attrs)
+
+    if unresolved_attrs:
+        assert nixpkgs_path, "nixpkgs_path argument is required"
+        print(f"Resolving files for {len(unresolved_attrs)} attributes")
+        resolved_attr_files = []
+        for [jobname, nixFile] in nixeval.resolve_attr_files(nixpkgs_path, unresolved_attrs, chunk_size, eval_jobs).items():
+            if nixFile is None:
+                # TODO(Mindavi): Find out why, e.g. the attribute is missing, or it is not a derivation.
+                print(f"could not resolve file for attr {jobname}")
                 continue
             # TODO(Mindavi): normalize to a path relative to the nixpkgs root directory
-            nixFile = json.loads(nixInstantiate.stdout.decode('utf-8'))
             # Make relative to CWD (which is assumed to be nixpkgs).
             nixFile = os.path.relpath(nixFile)
-            database.insert_or_update_attr_file(jobname, nixFile)
-        paths_with_attrs[nixFile].add(jobname)
+            resolved_attr_files.append((jobname, nixFile))
+            paths_with_attrs[nixFile].add(jobname)
+        database.insert_or_update_attr_files(resolved_attr_files, revision)
     for [path, jobs] in paths_with_attrs.items():
         if not isinstance(path, str):
             print("path is not str: {path}")
         if len(jobs) > 1:
             print(f"{path}: {', '.join(jobs)}")
 
-def list_broken_pkgs(database):
-    print("Listing broken pkgs")
-    broken_builds = database.get_broken_builds()
-    already_done_jobs = []
-    never_built_ok = []
-    previously_successful = []
-    print(f"There are {len(broken_builds)} builds to consider")
-    # build_id, url, jobset, eval_id, max(eval_timestamp), status, job, system
-    broken_builds.sort(key=lambda k:k[6])
-    counter = 0
-    for [build_id, baseurl, jobset, eval_id, eval_timestamp, status, jobname, system] in broken_builds:
-        if counter % 100 == 0 and counter != 0:
-            print(f"Checked {counter}/{len(broken_builds)} packages")
-        counter += 1
-        if status != 1:
-            continue
-        if 'Packages.' in jobname or 'Packages_' in jobname or 'linuxKernel.' in jobname or 'linuxPackages_' in jobname or 'tests.' in jobname:
-            continue
-        # FIXME(Mindavi): Prevent this from being an issue.
-        # See:
-        # - https://github.com/NixOS/nixpkgs/pull/206348
-        # - https://github.com/NixOS/nixpkgs/pull/203997#issuecomment-1352674741
-        if 'subunit' in jobname:
+def skip_broken_job(jobname, build_id=None):
+    """Return whether the job is left out of the report. With `build_id`, skipped subunit jobs are printed."""
+    if 'Packages.' in jobname or 'Packages_' in jobname or 'linuxKernel.' in jobname or 'linuxPackages_' in jobname or 'tests.' in jobname:
+        return True
+    # FIXME(Mindavi): Prevent this from being an issue.
+    # See:
+    # - https://github.com/NixOS/nixpkgs/pull/206348
+    # - https://github.com/NixOS/nixpkgs/pull/203997#issuecomment-1352674741
+    if 'subunit' in jobname:
+        if build_id is not None:
             print(f"Skipping subunit package with jobname {jobname} and build id {build_id}")
-            continue
-        if (jobname, system, status) in already_done_jobs:
-            #print(f"Skip duplicate job {job}.{system}")
-            continue
-        lwb_id, lwb_status, lwb_timestamp = database.get_estimated_last_working_build(jobname, system)
-        if lwb_id != None:
-            #lwb_human_time = datetime.datetime.fromtimestamp(lwb_timestamp)
-            #print(f"last working build: {jobname}.{system}, status: {lwb_status}, timestamp: {lwb_human_time}, id: {lwb_id}")
-            previously_successful.append((build_id, status, jobname, system, lwb_timestamp, baseurl, jobset))
-            continue
-        already_done_jobs.append((jobname, system, status))
-        url = f"{baseurl}/job/{jobset}/{jobname}.{system}/latest"
-        overview_url = f"{baseurl}/job/{jobset}/{jobname}.{system}"
-        res = requests.get(url, headers={"Accept": "application/json"}).json()
-        if 'error' in res:
-            never_built_ok.append((build_id, status, jobname, system, baseurl, jobset))
-        else:
-            res_timestamp = res["timestamp"]
-            human_time = datetime.datetime.fromtimestamp(res_timestamp)
-            previously_successful.append((build_id, status, jobname, system, res_timestamp, baseurl, jobset))
-            # Insert into database
+        return True
+    return False
+
+def list_broken_pkgs(database, build_cache, concurrency=ingest.DEFAULT_CONCURRENCY):
+    print("Listing broken pkgs")
+    # Ask Hydra for the last successful build of the jobs we didn't see succeed ourselves,
+    # unless an earlier report already did.
+    jobs_to_look_up = (
+        (baseurl, jobset, jobname, system)
+        for [_, baseurl, jobset, _, jobname, system, _, _, unknown, _, _] in database.get_failing_jobs()
+        if unknown and not skip_broken_job(jobname)
+    )
+    found_last_successes = ingest.fetch_latest_successes(jobs_to_look_up, concurrency)
+    print(f"Looked up the last successful build of {len(found_last_successes)} jobs")
+    last_successes = []
+    with database.build_result_writer() as writer:
+        for [[baseurl, jobset, jobname, system], res] in found_last_successes.items():
+            if res is None:
+                last_successes.append((baseurl, jobset, jobname, system, None, None))
+                continue
             res_build_id = res["id"]
+            res_timestamp = res["timestamp"]
+            last_successes.append((baseurl, jobset, jobname, system, res_build_id, res_timestamp))
             # Just grab the latest, it shouldn't matter too much for now.
             res_eval_id = res["jobsetevals"][0]
             res_status = res["buildstatus"]
-            database.insert_or_update_build_result(
-              res_build_id,
-              baseurl,
-              jobset,
-              res_eval_id,
-              res_timestamp,
-              res_status,
-              jobname,
-              system)
-
-
-    previously_successful.sort(key=lambda k: k[4])
-    for [id, status, jobname, system, timestamp, baseurl, jobset] in previously_successful:
+            build_cache.store(baseurl, res_build_id, res)
+            writer.add((res_build_id, baseurl, jobset, res_eval_id, res_timestamp, res_status, jobname, system))
+    database.insert_or_update_last_successes(last_successes)
+
+    # build_id, url, jobset, status, job, system, last success timestamp (local or from Hydra), whether
+    # Hydra said it never succeeded, whether that is unknown, streak length in evals and in days
+    never_built_ok = []
+    for [id, baseurl, jobset, status, jobname, system, timestamp, never_succeeded, unknown, streak_evals, streak_days] in database.get_failing_jobs():
+        if skip_broken_job(jobname, id):
+            continue
         overview_url = f"{baseurl}/job/{jobset}/{jobname}.{system}"
-        human_time = datetime.datetime.fromtimestamp(timestamp)
-        print(f"build {id} was last successful at {human_time} (status {status}): {jobname}.{system}, overview {overview_url}")
-    never_built_ok.sort(key=lambda k: k[2])
-    #mark_broken_list = defaultdict(list)
+        if timestamp is not None:
+            human_time = datetime.datetime.fromtimestamp(timestamp)
+            print(f"build {id} was last successful at {human_time} (status {status}, failing in {streak_evals} evals over {streak_days:.1f} days): {jobname}.{system}, overview {overview_url}")
+        elif never_succeeded:
+            print(f"build {id}: {jobname}.{system} was never successful, overview {overview_url}")
+            never_built_ok.append((id, status, jobname, system, baseurl, jobset))
+        else:
+            print(f"Couldn't find out if {jobname}.{system} was ever successful", file=sys.stderr)
+    return never_built_ok
+
+def mark_never_built_broken(never_built_ok, nixpkgs_path, eval_jobs=None):
+    mark_broken_list = defaultdict(set)
     for [id, status, jobname, system, baseurl, jobset] in never_built_ok:
-        overview_url = f"{baseurl}/job/{jobset}/{jobname}.{system}"
-        print(f"build {id}: {jobname}.{system} was never successful, overview {overview_url}")
-    #    mark_broken_list[jobname].append(system)
-    #for [pkgname, platforms] in mark_broken_list.items():
-    #    platforms_text = ", ".join(platforms)
-    #    mark_broken_v2.attemptToMarkBroken(pkgname, platforms, extraText=f"never built on {platforms_text} since first introduction in nixpkgs")
-
-def update_missing_statuses(database):
-    builds_without_status = database.get_builds_without_status()
-    print(f"There are {len(builds_without_status)} builds without status")
-    for i in range(len(builds_without_status)):
-        build = builds_without_status[i]
-        prev_build_id, prev_status, prev_jobname, prev_system, prev_url, prev_jobset, prev_eval_id = build
-        new_build_info = get_build_result(prev_url, prev_build_id)
-        build_id, baseurl, eval_id, timestamp, status, jobname, system = new_build_info
-        print(f"{i+1}/{len(builds_without_status)}: build id {prev_build_id}, status {status}, jobset {prev_jobset}, name {prev_jobname}")
-        database.insert_or_update_build_result(
-            build_id,
-            baseurl,
-            prev_jobset,
-            eval_id,
-            timestamp,
-            status,
-            jobname,
-            system)
+        mark_broken_list[jobname].add(system)
+    marks = []
+    for [pkgname, platforms] in mark_broken_list.items():
+        platforms_text = ", ".join(sorted(platforms))
+        marks.append((pkgname, sorted(platforms), f"never built on {platforms_text} since first introduction in nixpkgs"))
+    print(f"Marking {len(marks)} packages broken")
+    marked = nixpkgs_broken.mark_broken_v2.markBrokenBatch(marks, nixpkgs_path, eval_jobs)
+    print(f"Marked {len(marked)}/{len(marks)} packages broken")
+
+async def _update_missing_statuses(writer, builds, total, build_cache, concurrency, window):
+    async with ingest.create_session(concurrency) as session:
+        return await ingest.recheck_builds(session, writer, builds, window, build_cache, total=total)
+
+def update_missing_statuses(database, build_cache, include_failed=False, concurrency=ingest.DEFAULT_CONCURRENCY, window=None):
+    """Fetch the builds without status again, and with `include_failed` also the latest failed builds.
+
+    The newest builds are asked for first, and builds whose status changed
+    are written in batches through a DatabaseWriter.
+    """
+    if window is None:
+        window = 4 * concurrency
+    total = database.count_builds_to_recheck(include_failed)
+    print(f"There are {total} builds to recheck")
+    builds = database.get_builds_to_recheck(include_failed)
+    with DatabaseWriter(database.path) as writer:
+        build_cache.writer = writer
+        try:
+            changed, failed = asyncio.run(_update_missing_statuses(writer, builds, total, build_cache, concurrency, window))
+        finally:
+            build_cache.flush()
+            build_cache.writer = None
+    print(f"{changed} builds have a new status, {failed} builds could not be fetched")
+    return changed, failed
+
+# Seconds before the first retry of a build that failed to fetch, doubling with every attempt.
+RETRY_BACKOFF = 10
+# Retries that are due within this many seconds are waited for, later ones are left for the next run.
+MAX_RETRY_WAIT = 60
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETENTION_DAYS = 30
+
+class WorkQueueUpdater:
+    """Removes fetched builds from the work queue and records failed attempts, in batches through `writer`.
+
+    As the batches are queued behind the build results, a build only leaves the
+    work queue once its result is written, so an interrupted run never loses work.
+    """
+    def __init__(self, writer, baseurl, jobset, eval_id, max_attempts, batch_size=1000):
+        self.writer = writer
+        self.baseurl = baseurl
+        self.jobset = jobset
+        self.eval_id = eval_id
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.done = []
+        self.failures = []
+
+    async def __call__(self, build_id, error):
+        if error is None:
+            self.done.append(build_id)
+        else:
+            self.failures.append((build_id, error))
+        if len(self.done) + len(self.failures) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Hand the batch to the writer, returns a concurrent.futures.Future that resolves once it's written."""
+        done = self.done
+        failures = self.failures
+        self.done = []
+        self.failures = []
+        def update(database):
+            database.remove_work(self.baseurl, self.jobset, self.eval_id, done)
+            database.record_work_failures(self.baseurl, self.jobset, self.eval_id, failures, int(time.time()), RETRY_BACKOFF, self.max_attempts)
+        return await self.writer.submit_async(update)
+
+async def ingest_queued_eval(database, writer, session, build_cache, baseurl, jobset, eval_id, eval_timestamp, num_builds, window, max_attempts):
+    """Fetch the builds of an eval that are in the work queue, until none are left or the next retry is too far away.
+
+    The eval is recorded as ingested once no builds are waiting anymore. Builds
+    that failed `max_attempts` times are parked and don't hold it back.
+    Returns the number of builds that are still waiting.
+    """
+    updater = WorkQueueUpdater(writer, baseurl, jobset, eval_id, max_attempts)
+    while True:
+        build_ids = database.get_due_work(baseurl, jobset, eval_id, int(time.time()))
+        if build_ids:
+            number, failed = await ingest.ingest_builds(session, writer, baseurl, jobset, build_ids, window, build_cache, f"{jobset}: fetched builds", updater)
+            await asyncio.wrap_future(await updater.flush())
+            print(f"{jobset}: stored {number}/{len(build_ids)} build results, {failed} failed")
+        waiting, next_attempt_at, parked = database.get_work_summary(baseurl, jobset, eval_id)
+        if not waiting:
+            break
+        wait = next_attempt_at - time.time()
+        if wait > MAX_RETRY_WAIT:
+            print(f"{jobset}: {waiting} builds of eval {eval_id} will be retried in a later run", file=sys.stderr)
+            return waiting
+        await asyncio.sleep(max(wait, 0))
+    if parked:
+        print(f"{jobset}: {parked} builds of eval {eval_id} failed too often and are parked", file=sys.stderr)
+    # Queued behind the build results of this eval, so it's only recorded once they are written.
+    await asyncio.wrap_future(await writer.submit_async(lambda database: database.mark_eval_ingested(baseurl, jobset, eval_id, eval_timestamp, num_builds)))
+    return 0
+
+async def ingest_eval(database, writer, session, build_cache, baseurl, jobset, eval_id, eval_timestamp, all_builds_in_eval, window, max_attempts, backend="json"):
+    """Put all builds of an eval that we don't have a status for yet in the work queue, and fetch them.
+
+    With the "html" backend, the statuses are first taken from the overview page
+    of the eval, and only the builds that it doesn't describe are fetched.
+    """
+    print(f"{jobset}: eval {eval_id} has {len(all_builds_in_eval)} builds")
+    # Skip all builds we already have a status for, no matter which eval they were stored for.
+    unknown_builds, builds_without_status = database.get_unknown_builds(all_builds_in_eval)
+    print(f"{jobset}: unknown: {len(unknown_builds)}, known without status: {len(builds_without_status)}")
+    build_ids_to_check = unknown_builds + builds_without_status
+    await asyncio.wrap_future(await writer.submit_async(lambda database: database.enqueue_eval(baseurl, jobset, eval_id, eval_timestamp, len(all_builds_in_eval), build_ids_to_check)))
+    # The eval timestamp is stored for the builds from the page, so it has to be known.
+    if backend == "html" and build_ids_to_check and eval_timestamp is not None:
+        updater = WorkQueueUpdater(writer, baseurl, jobset, eval_id, max_attempts)
+        handled = await ingest.ingest_eval_page(session, writer, baseurl, jobset, eval_id, eval_timestamp, build_ids_to_check, updater)
+        await asyncio.wrap_future(await updater.flush())
+        print(f"{jobset}: {handled} of {len(build_ids_to_check)} builds came from the eval page")
+    return await ingest_queued_eval(database, writer, session, build_cache, baseurl, jobset, eval_id, eval_timestamp, len(all_builds_in_eval), window, max_attempts)
+
+async def update_jobset(database, writer, session, eval_cache, build_cache, baseurl, jobset, use_cached, update, eval_id, window, max_attempts, backend="json"):
+    """Ingest the evals of one jobset and return the number of builds that are still waiting to be fetched.
+
+    Evals that an earlier run left in the work queue are finished first. Then,
+    with `update`, every eval that is newer than the newest fully ingested one is
+    ingested (or only the latest eval, if none was ingested yet). Otherwise
+    `eval_id` is ingested, or the latest eval if it is None.
+    """
+    for [queued_eval_id, queued_eval_timestamp, num_builds] in database.get_queued_evals(baseurl, jobset):
+        print(f"{jobset}: resuming eval {queued_eval_id}")
+        waiting = await ingest_queued_eval(database, writer, session, build_cache, baseurl, jobset, queued_eval_id, queued_eval_timestamp, num_builds, window, max_attempts)
+        if waiting != 0:
+            # Don't skip over this eval next time.
+            print(f"{jobset}: eval {queued_eval_id} is incomplete, stopping", file=sys.stderr)
+            return waiting
+
+    evalfetcher = EvalFetcher(eval_cache)
+    last_ingested_eval_id = database.get_last_ingested_eval(baseurl, jobset) if update else None
+    if eval_id is not None:
+        new_evals = [{"id": eval_id}]
+    else:
+        if use_cached:
+            all_evals = await asyncio.to_thread(evalfetcher.get_cache, baseurl, jobset)
+        elif update:
+            all_evals = await asyncio.to_thread(evalfetcher.fetch_since, baseurl, jobset, last_ingested_eval_id)
+        else:
+            all_evals = await asyncio.to_thread(evalfetcher.fetch, baseurl, jobset)
+        if last_ingested_eval_id is None:
+            # typically the last eval?
+            new_evals = all_evals[:1]
+        else:
+            new_evals = [e for e in all_evals if e["id"] > last_ingested_eval_id]
+    new_evals.sort(key=lambda e: e["id"])
+    if update:
+        print(f"{jobset}: last ingested eval: {last_ingested_eval_id}, evals to ingest: {[e['id'] for e in new_evals]}")
+
+    buildsinevalfetcher = BuildsInEvalFetcher(eval_cache)
+    previous_builds = None
+    if last_ingested_eval_id is not None:
+        try:
+            previous_builds = set(buildsinevalfetcher.get_cache(baseurl, last_ingested_eval_id))
+        except FileNotFoundError:
+            pass
+    for new_eval in new_evals:
+        if use_cached:
+            all_builds_in_eval = await asyncio.to_thread(buildsinevalfetcher.get_cache, baseurl, new_eval["id"])
+        else:
+            all_builds_in_eval = await asyncio.to_thread(buildsinevalfetcher.fetch, baseurl, new_eval["id"])
+        if previous_builds is not None:
+            new_builds = len(set(all_builds_in_eval) - previous_builds)
+            print(f"{jobset}: eval {new_eval['id']}: {new_builds} of {len(all_builds_in_eval)} builds are new since the previous eval")
+        waiting = await ingest_eval(database, writer, session, build_cache, baseurl, jobset, new_eval["id"], new_eval.get("timestamp"), all_builds_in_eval, window, max_attempts, backend)
+        if waiting != 0:
+            # Don't skip over this eval next time.
+            print(f"{jobset}: eval {new_eval['id']} is incomplete, stopping", file=sys.stderr)
+            return waiting
+        previous_builds = set(all_builds_in_eval)
+    return 0
+
+async def _ingest_jobsets(database, writer, eval_cache, build_cache, targets, use_cached, update, eval_id, concurrency, window, max_attempts, backend):
+    async with ingest.create_session(concurrency) as session:
+        return await asyncio.gather(
+            *(update_jobset(database, writer, session, eval_cache, build_cache, baseurl, jobset, use_cached, update, eval_id, window, max_attempts, backend) for [baseurl, jobset] in targets),
+            return_exceptions=True)
+
+def ingest_jobsets(database, eval_cache, build_cache, targets, use_cached=False, update=False, eval_id=None, concurrency=ingest.DEFAULT_CONCURRENCY, window=None, max_attempts=DEFAULT_MAX_ATTEMPTS, backend="json"):
+    """Ingest every (baseurl, jobset) in `targets` at the same time.
+
+    All jobsets share one pool of `concurrency` connections, and all writes go
+    through a single DatabaseWriter, so the jobsets don't lock each other out of
+    the database. The builds to fetch are kept in a work queue in the database,
+    so an interrupted run is resumed by the next one.
+    Returns True if every jobset was ingested completely.
+    """
+    if window is None:
+        window = 4 * concurrency
+    with DatabaseWriter(database.path) as writer:
+        build_cache.writer = writer
+        try:
+            results = asyncio.run(_ingest_jobsets(database, writer, eval_cache, build_cache, targets, use_cached, update, eval_id, concurrency, window, max_attempts, backend))
+        finally:
+            build_cache.flush()
+            build_cache.writer = None
+    complete = True
+    for [[baseurl, jobset], result] in zip(targets, results):
+        if isinstance(result, FileNotFoundError):
+            print(f"{jobset}: not cached: {result.filename}", file=sys.stderr)
+            complete = False
+        elif isinstance(result, Exception):
+            print(f"{jobset}: ingesting from {baseurl} failed: {result!r}", file=sys.stderr)
+            complete = False
+        elif result != 0:
+            complete = False
+    return complete
+
+def compact_build_results(database, retention_days=DEFAULT_RETENTION_DAYS):
+    before = int(time.time()) - retention_days * 24 * 60 * 60
+    print(f"Compacting the builds of evals before {datetime.datetime.fromtimestamp(before)}")
+    with metrics.timed("db_write"):
+        num_builds, num_intervals = database.compact_build_results(before)
+    metrics.increment("builds_compacted", num_builds)
+    print(f"Compacted {num_builds} builds into {num_intervals} intervals")
+
+def write_metrics(metrics_json, metrics_prom):
+    metrics.print_summary()
+    if metrics_json:
+        metrics.write_json(metrics_json)
+    if metrics_prom:
+        metrics.write_prometheus(metrics_prom)
 
 def cli():
     parser = argparse.ArgumentParser(
         prog = 'nixpkgs-broken',
         description = 'Tool to identify and mark packages in nixpkgs as broken',
     )
-    parser.add_argument('--baseurl', default='https://hydra.nixos.org', required=False)
-    parser.add_argument('--jobset', default='nixpkgs/trunk', required=False, help="The jobset to use (e.g. nixpkgs/trunk, nixpkgs/nixpkgs-unstable-aarch64-darwin)")
+    parser.add_argument('--baseurl', action='append', required=False, help="The Hydra instance to use (default: https://hydra.nixos.org), can be given multiple times")
+    parser.add_argument('--jobset', action='append', required=False, help="The jobset to use (e.g. nixpkgs/trunk, nixpkgs/nixpkgs-unstable-aarch64-darwin, default: nixpkgs/trunk), can be given multiple times to ingest the jobsets of every baseurl at once")
     parser.add_argument('--use-cached', action='store_true')
+    parser.add_argument('--update', action='store_true', help="Ingest all evals since the last fully ingested eval of the jobset")
+    parser.add_argument('--eval', type=int, help="The eval to use instead of the latest eval of the jobset")
+    parser.add_argument('--cache-dir', default=cache.DEFAULT_CACHE_DIR, required=False)
+    parser.add_argument('--cache-max-size', type=int, default=cache.DEFAULT_MAX_SIZE // (1024 * 1024), help="Maximum size of the eval cache in MiB")
     parser.add_argument('--list-broken-pkgs', action='store_true')
+    parser.add_argument('--mark-broken', action='store_true', help="Mark the packages that never built as broken in the nixpkgs checkout at --nixpkgs-path")
     parser.add_argument('--db-path', default='hydra2.db', required=False)
     parser.add_argument('--list-pkg-paths', action='store_true')
     parser.add_argument('--update-missing-status', action='store_true')
+    parser.add_argument('--recheck-broken-status', action='store_true', help="Like --update-missing-status, but also recheck the latest failed build of every job, in case it was restarted")
     parser.add_argument('--nixpkgs-path', type=str)
+    parser.add_argument('--build-cache-ttl', type=int, default=cache.DEFAULT_BUILD_TTL, help="Seconds before a cached unfinished build is revalidated")
+    parser.add_argument('--eval-jobs', type=int, help="Number of nix-instantiate processes to run in parallel (default: number of CPUs)")
+    parser.add_argument('--eval-chunk-size', type=int, default=nixeval.DEFAULT_CHUNK_SIZE, help="Number of attributes to evaluate per nix-instantiate call")
+    parser.add_argument('--metrics-json', help="Write counters and per-phase timings as JSON to this file")
+    parser.add_argument('--metrics-prom', help="Write counters and per-phase timings as a Prometheus textfile to this file")
+    parser.add_argument('--explain', action='store_true', help="Print the query plan and timing of the report queries")
+    parser.add_argument('--concurrency', type=int, default=ingest.DEFAULT_CONCURRENCY, help="Maximum number of concurrent connections to Hydra")
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS, help="Number of times a build is fetched before it is parked")
+    parser.add_argument('--retry-parked', action='store_true', help="Give builds that were parked after failing too often another try")
+    parser.add_argument('--compact', action='store_true', help="Compact the builds of evals older than --retention-days into intervals of unchanged status")
+    parser.add_argument('--retention-days', type=int, default=DEFAULT_RETENTION_DAYS, help="Number of days of evals that --compact keeps every build of")
+    parser.add_argument('--export-snapshot', metavar='PATH', help="Write the build database to a compressed snapshot file")
+    parser.add_argument('--import-snapshot', metavar='PATH', help="Load a snapshot file written by --export-snapshot into the build database")
+    parser.add_argument('--first-eval', type=int, help="The first eval that --export-snapshot includes")
+    parser.add_argument('--last-eval', type=int, help="The last eval that --export-snapshot includes")
+    parser.add_argument('--backend', choices=['json', 'html'], default='json', help="Where build statuses come from: one JSON request per build, or the overview page of the eval (builds it doesn't describe are still fetched as JSON)")
+    parser.add_argument('--window', type=int, help="Maximum number of build requests in flight (default: 4 times the concurrency)")
 
     args = parser.parse_args()
-    baseurl = args.baseurl
-    jobset = args.jobset
+    baseurls = args.baseurl or ['https://hydra.nixos.org']
+    jobsets = args.jobset or ['nixpkgs/trunk']
     use_cached = args.use_cached
+    update = args.update
+    eval_id = args.eval
+    cache_dir = args.cache_dir
+    cache_max_size = args.cache_max_size
     list_broken = args.list_broken_pkgs
+    mark_broken = args.mark_broken
     db_path = args.db_path
     list_pkg_paths = args.list_pkg_paths
     update_missing_status = args.update_missing_status
+    recheck_broken_status = args.recheck_broken_status
     nixpkgs = args.nixpkgs_path
+    build_cache_ttl = args.build_cache_ttl
+    eval_jobs = args.eval_jobs
+    eval_chunk_size = args.eval_chunk_size
+    explain = args.explain
+    metrics_json = args.metrics_json
+    metrics_prom = args.metrics_prom
+    concurrency = args.concurrency
+    window = args.window
+    max_attempts = args.max_attempts
+    retry_parked = args.retry_parked
+    backend = args.backend
+    export_snapshot = args.export_snapshot
+    import_snapshot = args.import_snapshot
+    first_eval = args.first_eval
+    last_eval = args.last_eval
+    compact = args.compact
+    retention_days = args.retention_days
+
+    atexit.register(write_metrics, metrics_json, metrics_prom)
 
     print("Initializing database")
     database = Database(db_path)
 
-    if list_broken:
-        list_broken_pkgs(database)
+    build_cache = cache.BuildCache(database, build_cache_ttl)
+
+    if explain:
+        for [name, plan, duration, num_rows] in database.explain_report_queries():
+            print(f"{name}: {num_rows} rows in {duration:.3f}s")
+            for line in plan:
+                print(f"  {line}")
+        sys.exit(0)
+    if list_broken or mark_broken:
+        if mark_broken and not nixpkgs:
+            parser.error("--mark-broken requires --nixpkgs-path")
+        with build_cache:
+            never_built_ok = list_broken_pkgs(database, build_cache, concurrency)
+        if mark_broken:
+            mark_never_built_broken(never_built_ok, nixpkgs, eval_jobs)
         sys.exit(0)
     if list_pkg_paths:
-        list_package_paths(database, nixpkgs)
+        list_package_paths(database, nixpkgs, eval_jobs, eval_chunk_size)
         sys.exit(0)
-    if update_missing_status:
-        update_missing_statuses(database)
+    if update_missing_status or recheck_broken_status:
+        update_missing_statuses(database, build_cache, recheck_broken_status, concurrency, window)
+        sys.exit(0)
+    if compact:
+        compact_build_results(database, retention_days)
+        sys.exit(0)
+    if export_snapshot:
+        number = snapshot.export_snapshot(database, export_snapshot, first_eval, last_eval)
+        print(f"Wrote {number} records to {export_snapshot}")
+        sys.exit(0)
+    if import_snapshot:
+        try:
+            header, counts = snapshot.import_snapshot(database, import_snapshot)
+        except snapshot.SnapshotError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        print(f"Loaded evals {header['first_eval_id']} to {header['last_eval_id']} from {import_snapshot}: {', '.join(f'{number} {kind}' for [kind, number] in sorted(counts.items()))}")
         sys.exit(0)
 
-    print(f"listing packages with build status from {baseurl}, jobset {jobset}")
-
-    evalfetcher = EvalFetcher()
-    if use_cached:
-        all_evals = evalfetcher.get_cache(baseurl, jobset)
-    else:
-        all_evals = evalfetcher.fetch(baseurl, jobset)
-
-    # typically the last eval?
-    last_eval_id = all_evals[0]["id"]
-    print(f"using eval {last_eval_id}")
-
-    buildsinevalfetcher = BuildsInEvalFetcher()
-    if use_cached:
-        all_builds_in_eval = buildsinevalfetcher.get_cache(baseurl, jobset)
-    else:
-        all_builds_in_eval = buildsinevalfetcher.fetch(baseurl, last_eval_id)
-
-    print(f"total build ids: {len(all_builds_in_eval)}")
-    already_known_builds = database.get_known_builds(last_eval_id)
-    to_remove = []
-    # Skip all builds that were in the same eval and which we already stored data for.
-    for [build_id, status] in already_known_builds:
-        to_remove.append(build_id)
-    # Skip all builds we already have data for from a different eval.
-    for build_id in all_builds_in_eval:
-        found_item = database.get_build_id(build_id)
-        if found_item != None:
-            build_id, status = found_item
-            # We want to update the status for this build, so don't put it in the remove list.
-            if status == None:
-                continue
-            to_remove.append(build_id)
-    build_ids_to_check = list(set(all_builds_in_eval) - set(to_remove))
-    print(f"to check: {len(build_ids_to_check)}")
-
-    start_retrieve_build_results = datetime.datetime.now()
+    targets = [(baseurl, jobset) for baseurl in baseurls for jobset in jobsets]
+    if eval_id is not None and len(targets) > 1:
+        parser.error("--eval can only be used with a single baseurl and jobset")
+    for [baseurl, jobset] in targets:
+        print(f"listing packages with build status from {baseurl}, jobset {jobset}")
 
-    num_processes = 10
+    if retry_parked:
+        print(f"retrying {database.unpark_work()} parked builds")
 
-    get_build_result_for_url = partial(get_build_result, baseurl)
-    with ThreadPoolExecutor(max_workers=num_processes) as pool:
-        futures = {pool.submit(get_build_result_for_url, build_id): build_id for build_id in build_ids_to_check}
-        number = 0
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            if result == None:
-                continue
-            build_id, baseurl, eval_id, timestamp, status, jobname, system = result
-            database.insert_or_update_build_result(
-                build_id,
-                baseurl,
-                jobset,
-                eval_id,
-                timestamp,
-                status,
-                jobname,
-                system)
-            number += 1
-            runtime = datetime.datetime.now() - start_retrieve_build_results
-            print(f"({runtime}) {number}/{len(build_ids_to_check)}: status {status}, id {build_id}, job {jobname}, system {system}")
-
-    print("retrieving build results took", datetime.datetime.now() - start_retrieve_build_results)
+    eval_cache = cache.EvalCache(cache_dir, cache_max_size * 1024 * 1024)
+    try:
+        complete = ingest_jobsets(database, eval_cache, build_cache, targets, use_cached, update, eval_id, concurrency, window, max_attempts, backend)
+    except KeyboardInterrupt:
+        print("Interrupted, the next run continues with the builds that are left in the work queue", file=sys.stderr)
+        sys.exit(130)
+    if not complete:
+        sys.exit(1)
 
 if __name__ == "__main__":
     cli()
-
@@ -0,0 +1,257 @@
+"""Caches for Hydra responses.
+
+EvalCache streams eval payloads into gzip compressed files, so a payload is
+never held in memory as a whole. The builds of an eval are keyed by eval ID,
+the list of evals by baseurl and jobset. Once the cache grows beyond its size
+limit, the least recently used files are removed.
+
+BuildCache keeps the fields we need from /build/{id} responses in the database.
+"""
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+DEFAULT_CACHE_DIR = "cache"
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+def short_hash(value):
+    return hashlib.sha1(value.encode()).hexdigest()[:8]
+
+class EvalCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def evals_path(self, baseurl, jobset):
+        return os.path.join(self.directory, f"evals-{short_hash(baseurl)}-{short_hash(jobset)}.json.gz")
+
+    def builds_path(self, baseurl, eval_id):
+        return os.path.join(self.directory, f"eval-{short_hash(baseurl)}-{eval_id}.json.gz")
+
+    def store(self, path, chunks):
+        """Compress the byte strings in `chunks` into `path`.
+
+        The file is written under a temporary name first, so an interrupted
+        download never leaves a truncated payload behind.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw_file, gzip.GzipFile(fileobj=raw_file, mode="wb") as cache_file:
+                for chunk in chunks:
+                    cache_file.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.evict()
+
+    def open(self, path):
+        """Open a cached payload for reading, raises FileNotFoundError if it is not cached."""
+        cache_file = gzip.open(path, "rb")
+        # The modification time doubles as the last time the file was used.
+        os.utime(path)
+        return cache_file
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json.gz"):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total_size = sum(size for [_, size, _] in entries)
+        # Always keep the most recently used file, even if it is larger than the limit on its own.
+        for [_, size, path] in entries[:-1]:
+            if total_size <= self.max_size:
+                break
+            print(f"Evicting {path} from cache")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Evicted by another thread storing a payload at the same time.
+                pass
+            total_size -= size
+
+number_pattern = re.compile(rb"-?\d+")
+
+def iter_array_items(stream, key, chunk_size=1 << 16):
+    """Yield the integers in the array stored under the top-level `key` of the JSON object in `stream`.
+
+    Only the structure of the document is tracked while looking for the key,
+    and the numbers are read straight from the byte chunks, so the document is
+    never parsed as a whole.
+    """
+    target = key.encode()
+    depth = 0
+    in_string = False
+    escaped = False
+    string = bytearray()
+    last_key = None
+    expect_value = False
+    chunk = stream.read(chunk_size)
+    while chunk:
+        i = 0
+        while i < len(chunk):
+            c = chunk[i]
+            i += 1
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == ord('\\'):
+                    escaped = True
+                elif c == ord('"'):
+                    in_string = False
+                    if depth == 1:
+                        last_key = bytes(string)
+                    continue
+                string.append(c)
+            elif c == ord('"'):
+                in_string = True
+                string.clear()
+                expect_value = False
+            elif c == ord(':'):
+                expect_value = depth == 1 and last_key == target
+            elif c in b" \t\r\n":
+                pass
+            elif c == ord('[') and expect_value:
+                yield from _iter_numbers(stream, chunk[i:], chunk_size)
+                return
+            else:
+                expect_value = False
+                last_key = None
+                if c in b"{[":
+                    depth += 1
+                elif c in b"}]":
+                    depth -= 1
+        chunk = stream.read(chunk_size)
+
+def _iter_numbers(stream, chunk, chunk_size):
+    carry = b""
+    while True:
+        end = chunk.find(b"]")
+        if end != -1:
+            for number in number_pattern.findall(carry + chunk[:end]):
+                yield int(number)
+            return
+        data = carry + chunk
+        # The last number might continue in the next chunk.
+        split = data.rfind(b",") + 1
+        for number in number_pattern.findall(data[:split]):
+            yield int(number)
+        carry = data[split:]
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            raise ValueError("unterminated array")
+
+DEFAULT_BUILD_TTL = 15 * 60
+
+class BuildCache:
+    """Cache of the fields of /build/{id} responses that are stored in build_results.
+
+    Finished builds never change on Hydra, so once cached they are never
+    fetched again. Unfinished builds are reused for `ttl` seconds and then
+    revalidated with the ETag and Last-Modified headers of the last response.
+    The cache is keyed by baseurl and build ID, so it is shared between jobsets.
+    Writes are buffered, call `flush` (or use it as a context manager) to store them.
+    While `writer` is set, flushed writes are handed to it instead of being
+    written on the connection of `database`; full buffers are then only
+    flushed by `flush_if_full`, which doesn't block the event loop.
+    """
+    def __init__(self, database, ttl=DEFAULT_BUILD_TTL, max_pending=1000):
+        self.database = database
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.pending = {}
+        self.revalidated = set()
+        self.writer = None
+
+    def lookup(self, baseurl, build_id):
+        """Return (build_info, fresh, revalidation headers) for a cached build, or None if it isn't cached."""
+        cached = self.pending.get((baseurl, build_id)) or self.database.get_cached_build(baseurl, build_id)
+        if cached is None:
+            return None
+        [finished, job, system, buildstatus, timestamp, eval_id, etag, last_modified, fetched_at] = cached
+        build_info = {
+            "finished": finished,
+            "job": job,
+            "system": system,
+            "buildstatus": buildstatus,
+            "timestamp": timestamp,
+            "jobsetevals": [eval_id],
+        }
+        fresh = bool(finished) or time.time() - fetched_at < self.ttl
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return build_info, fresh, headers
+
+    def store(self, baseurl, build_id, build_info, etag=None, last_modified=None):
+        try:
+            row = (
+                1 if build_info["finished"] else 0,
+                build_info["job"],
+                build_info["system"],
+                build_info["buildstatus"],
+                build_info["timestamp"],
+                build_info["jobsetevals"][0],
+                etag,
+                last_modified,
+                int(time.time()),
+            )
+        except (KeyError, IndexError, TypeError):
+            # Not a build, don't cache it.
+            return
+        self.pending[(baseurl, build_id)] = row
+        if self.writer is None and self.full():
+            self.flush()
+
+    def mark_revalidated(self, baseurl, build_id):
+        self.revalidated.add((baseurl, build_id))
+        if self.writer is None and self.full():
+            self.flush()
+
+    def full(self):
+        return len(self.pending) + len(self.revalidated) >= self.max_pending
+
+    def take(self):
+        cached_builds = [(baseurl, build_id) + row for [(baseurl, build_id), row] in self.pending.items()]
+        revalidated = self.revalidated
+        self.pending = {}
+        self.revalidated = set()
+        return cached_builds, revalidated
+
+    def flush(self):
+        cached_builds, revalidated = self.take()
+        if self.writer is not None:
+            self.writer.submit(lambda database: store_cached_builds(database, cached_builds, revalidated))
+        else:
+            store_cached_builds(self.database, cached_builds, revalidated)
+
+    async def flush_if_full(self):
+        if not self.full():
+            return
+        if self.writer is None:
+            self.flush()
+            return
+        cached_builds, revalidated = self.take()
+        await self.writer.submit_async(lambda database: store_cached_builds(database, cached_builds, revalidated))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+def store_cached_builds(database, cached_builds, revalidated):
+    if cached_builds:
+        database.insert_or_update_cached_builds(cached_builds)
+    if revalidated:
+        database.touch_cached_builds(revalidated, int(time.time()))
@@ -0,0 +1,91 @@
+"""Build statuses from the HTML overview page of a Hydra eval.
+
+One page (`/eval/{id}?full=1`) lists every build of the eval with its status
+icon, so reading it replaces a /build/{id} request per build. The parser is
+fed the response body chunk by chunk and hands out every table row as soon
+as it is complete, so the page is never held in memory as a whole.
+"""
+from html.parser import HTMLParser
+import re
+from typing import NamedTuple
+
+# The title of the status icon, see renderBuildStatusIcon in Hydra's common.tt.
+# Builds with a title that isn't listed here are left to be fetched as JSON.
+statuses = {
+    "Succeeded": 0,
+    "Failed": 1,
+    "Dependency failed": 2,
+    "Aborted": 3,
+    "Cancelled": 4,
+    "Failed with output": 6,
+    "Timed out": 7,
+    "Cached failure": 8,
+    "Log limit exceeded": 10,
+    "Output limit exceeded": 11,
+    "Scheduled to be built": None,
+    "Queued": None,
+    "Building": None,
+}
+
+build_link = re.compile(r"/build/(\d+)$")
+
+class Row(NamedTuple):
+    build_id: int
+    # Title of the status icon, e.g. "Succeeded".
+    status: str
+    # Full job name, e.g. hello.x86_64-linux.
+    job: str
+    # None if the page doesn't have a system column.
+    system: str
+
+class EvalPageParser(HTMLParser):
+    """Collects the rows of the build tables, in the columns status icon, build, job, time, name and system."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.in_table = False
+        self.start_row()
+
+    def start_row(self):
+        self.column = -1
+        self.status = None
+        self.build_id = None
+        self.cells = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tbody":
+            self.in_table = True
+        if not self.in_table:
+            return
+        if tag == "tr":
+            self.start_row()
+        elif tag == "td":
+            self.column += 1
+            self.cells.append("")
+        attrs = dict(attrs)
+        if tag == "img" and "build-status" in (attrs.get("class") or "").split():
+            self.status = attrs.get("title")
+        elif tag == "a" and self.build_id is None:
+            m = build_link.search(attrs.get("href") or "")
+            if m:
+                self.build_id = int(m.group(1))
+
+    def handle_endtag(self, tag):
+        if tag == "tbody":
+            self.in_table = False
+        elif tag == "tr" and self.in_table:
+            # Other tables (e.g. of removed jobs) don't have a status icon and a build.
+            if self.status is not None and self.build_id is not None and len(self.cells) > 2 and self.cells[2]:
+                system = self.cells[5] if len(self.cells) > 5 and self.cells[5] else None
+                self.rows.append(Row(self.build_id, self.status, self.cells[2], system))
+            self.start_row()
+
+    def handle_data(self, data):
+        if self.in_table and self.cells:
+            self.cells[-1] += data.strip()
+
+    def take_rows(self):
+        """Return the rows that were completed since the last call."""
+        rows = self.rows
+        self.rows = []
+        return rows
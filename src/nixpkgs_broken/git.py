@@ -0,0 +1,34 @@
+"""Just enough git to tell which files of a nixpkgs checkout changed between revisions."""
+import os
+import subprocess
+import sys
+
+def run(path, *args):
+    """Run git in `path` and return its output, or None if it failed."""
+    result = subprocess.run(["git", "-C", path, *args], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"git {' '.join(args)} failed: {result.stderr.strip()}", file=sys.stderr)
+        return None
+    return result.stdout
+
+def head_revision(path):
+    """The commit that is checked out in `path`, or None if it is not a git checkout."""
+    if not os.path.exists(os.path.join(path, ".git")):
+        return None
+    output = run(path, "rev-parse", "HEAD")
+    return output.strip() if output else None
+
+def changed_files(path, revision):
+    """The files that differ between `revision` and the working tree of `path`, as absolute paths.
+
+    Both sides of a rename are included. Returns None if the difference is
+    unknown, e.g. because `revision` isn't in the repository anymore.
+    """
+    root = run(path, "rev-parse", "--show-toplevel")
+    if root is None:
+        return None
+    output = run(path, "diff", "--name-only", "--no-renames", "-z", revision)
+    if output is None:
+        return None
+    root = root.strip()
+    return {os.path.join(root, name) for name in output.split("\0") if name}
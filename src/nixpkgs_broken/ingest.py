@@ -0,0 +1,310 @@
+"""Asyncio ingestion engine for Hydra build results.
+
+All build requests share one pooled connector, and at most `window` requests
+are in flight at any time, so memory use does not depend on the size of the
+eval. Results are handed back to the caller one by one, which keeps all
+database writes on a single writer.
+"""
+import asyncio
+import codecs
+import json
+import sys
+
+import aiohttp
+
+from nixpkgs_broken import evalpage
+from nixpkgs_broken.metrics import metrics, Progress
+
+DEFAULT_CONCURRENCY = 20
+
+known_systems = ["aarch64-linux", "x86_64-linux", "x86_64-darwin", "aarch64-darwin"]
+
+def parse_build_result(baseurl, build_id, build_info):
+    """Turn the JSON of /build/{id} into a build_results row, or None if it should be skipped."""
+    try:
+        job = build_info["job"]
+        status = build_info["buildstatus"]
+        timestamp = build_info["timestamp"]
+        build_system = build_info["system"]
+        # Assumes ordering from high to low.
+        last_eval_id = build_info["jobsetevals"][0]
+    except (KeyError, IndexError, TypeError):
+        print(f"build {build_id} unknown status, {build_info}", file=sys.stderr)
+        return None
+    # status can be:
+    #   None: not built yet
+    #   0: success
+    #   1: Build returned a non-zero exit code
+    #   2: dependency failed
+    #   3: aborted
+    #   4: canceled by the user
+    #   6: failed with output
+    #   7: timed out
+    #   9: aborted
+    #   10: log size limit exceeded
+    #   11: output limit exceeded
+    if "." in job:
+        jobname, system = job.rsplit(".", maxsplit=1)
+        # Sanity check for system name.
+        known_system = system in known_systems
+        # e.g. stdenvBootstrapTools.x86_64-darwin.test, or stdenvBootstrapTools.x86_64-darwin.dist
+        # let's just skip em for now.
+        host_is_not_build = system != build_system
+        if not known_system:
+            print(f"Unknown system {system} in job {job} with id {build_id}, skipping")
+        elif host_is_not_build:
+            print(f"Host system {system} is not equal to build system {build_system}")
+        else:
+            # For now, make this a hard assumption. We can always relax later.
+            assert(system == build_system)
+            return (build_id, baseurl, last_eval_id, timestamp, status, jobname, system)
+    else:
+        print(f"Job without system (job: {job}, id: {build_id}, status: {status}), skipping")
+    return None
+
+def create_session(concurrency=DEFAULT_CONCURRENCY):
+    """Create a client session whose connector keeps up to `concurrency` connections alive."""
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=60, connect=10, sock_read=30)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+class FetchError(Exception):
+    pass
+
+async def fetch_build_result(session, baseurl, build_id, build_cache=None, revalidate=False):
+    """Fetch and parse a build, raises FetchError if Hydra couldn't be asked or didn't answer.
+
+    With `revalidate`, a cached build is always checked with Hydra, even if it finished.
+    """
+    headers = {"Accept": "application/json"}
+    cached = build_cache.lookup(baseurl, build_id) if build_cache else None
+    if cached:
+        cached_build_info, fresh, revalidation_headers = cached
+        if fresh and not revalidate:
+            metrics.increment("build_cache_hits")
+            return parse_build_result(baseurl, build_id, cached_build_info)
+        headers.update(revalidation_headers)
+    try:
+        with metrics.timed("http_fetch"):
+            async with session.get(f"{baseurl}/build/{build_id}", headers=headers) as resp:
+                body = await resp.read()
+        if resp.status == 304 and cached:
+            metrics.increment("build_cache_revalidated")
+            build_cache.mark_revalidated(baseurl, build_id)
+            await build_cache.flush_if_full()
+            return parse_build_result(baseurl, build_id, cached_build_info)
+        if resp.status != 200:
+            raise FetchError(f"HTTP {resp.status}")
+        with metrics.timed("json_decode"):
+            build_info = json.loads(body)
+        if build_cache:
+            build_cache.store(baseurl, build_id, build_info, resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+            await build_cache.flush_if_full()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise FetchError(repr(e)) from e
+    return parse_build_result(baseurl, build_id, build_info)
+
+async def _fetch_build_result(session, baseurl, build_id, build_cache, revalidate=False):
+    try:
+        return build_id, await fetch_build_result(session, baseurl, build_id, build_cache, revalidate), None
+    except FetchError as e:
+        metrics.increment("builds_failed")
+        print(f"build {build_id} could not be fetched: {e}", file=sys.stderr)
+        return build_id, None, str(e)
+
+async def run_bounded(coroutines, window):
+    """Run the coroutines with at most `window` of them in flight, yielding their results as they complete.
+
+    `coroutines` is consumed lazily, so it can be any iterable (including a generator).
+    """
+    coroutines = iter(coroutines)
+    pending = set()
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < window:
+            coroutine = next(coroutines, None)
+            if coroutine is None:
+                exhausted = True
+                break
+            pending.add(asyncio.ensure_future(coroutine))
+        if not pending:
+            return
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+async def fetch_build_results(session, baseurl, build_ids, window, build_cache=None):
+    """Yield (build_id, build result, error) as builds complete, with at most `window` requests in flight.
+
+    The build result is None for builds that are skipped by parse_build_result or
+    that could not be fetched; in the latter case error describes why.
+    Builds in `build_cache` are only requested if they could have changed.
+    """
+    coroutines = (_fetch_build_result(session, baseurl, build_id, build_cache) for build_id in build_ids)
+    async for result in run_bounded(coroutines, window):
+        yield result
+
+async def ingest_builds(session, writer, baseurl, jobset, build_ids, window, build_cache=None, label="fetched builds", on_done=None):
+    """Fetch the given builds and hand their build results to `writer.add_async`.
+
+    `on_done(build_id, error)` is awaited for every build once its result (if any)
+    was handed to the writer, with error None unless it could not be fetched.
+    Returns the number of build results that were added and the number of builds that could not be fetched.
+    """
+    progress = Progress(label, len(build_ids))
+    number = 0
+    failed = 0
+    async for [build_id, result, error] in fetch_build_results(session, baseurl, build_ids, window, build_cache):
+        progress.update(failed=0 if error is None else 1)
+        if error is not None:
+            failed += 1
+        if result is not None:
+            build_id, baseurl, eval_id, timestamp, status, jobname, system = result
+            await writer.add_async((build_id, baseurl, jobset, eval_id, timestamp, status, jobname, system))
+            number += 1
+        if on_done is not None:
+            await on_done(build_id, error)
+    progress.print()
+    return number, failed
+
+async def recheck_builds(session, writer, builds, window, build_cache=None, label="rechecked builds", total=None):
+    """Fetch the given builds again and hand the ones whose status changed to `writer.add_async`.
+
+    `builds` is an iterable of (build_id, baseurl, jobset, status), requested in that
+    order, and `total` its length if known. Cached builds are always revalidated, as Hydra may have restarted them.
+    Returns the number of builds whose status changed and the number of builds that could not be fetched.
+    """
+    async def recheck(build_id, baseurl, jobset, status):
+        return await _fetch_build_result(session, baseurl, build_id, build_cache, revalidate=True), jobset, status
+    progress = Progress(label, total)
+    changed = 0
+    failed = 0
+    coroutines = (recheck(*build) for build in builds)
+    async for [[build_id, result, error], jobset, previous_status] in run_bounded(coroutines, window):
+        progress.update(failed=0 if error is None else 1)
+        if error is not None:
+            failed += 1
+        if result is None:
+            continue
+        build_id, baseurl, eval_id, timestamp, status, jobname, system = result
+        # A restarted build that hasn't finished yet has no status, keep the one we know.
+        if status is not None and status != previous_status:
+            await writer.add_async((build_id, baseurl, jobset, eval_id, timestamp, status, jobname, system))
+            changed += 1
+    progress.print()
+    metrics.increment("builds_rechecked", progress.count)
+    metrics.increment("build_status_changes", changed)
+    return changed, failed
+
+def parse_eval_page_row(row):
+    """Turn a row of an eval page into (status, jobname, system), or None if the page doesn't say enough."""
+    if row.status not in evalpage.statuses or "." not in row.job:
+        return None
+    jobname, system = row.job.rsplit(".", maxsplit=1)
+    if system not in known_systems or (row.system is not None and row.system != system):
+        return None
+    return evalpage.statuses[row.status], jobname, system
+
+async def fetch_eval_page(session, baseurl, eval_id):
+    """Yield the rows of the overview page of an eval while it is downloaded, raises FetchError if it can't be fetched."""
+    parser = evalpage.EvalPageParser()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    # The page of a full eval is large, only give up if it stops coming in.
+    timeout = aiohttp.ClientTimeout(total=None, connect=10, sock_read=60)
+    try:
+        async with session.get(f"{baseurl}/eval/{eval_id}?full=1", headers={"Accept": "text/html"}, timeout=timeout) as resp:
+            if resp.status != 200:
+                raise FetchError(f"HTTP {resp.status}")
+            async for chunk in resp.content.iter_chunked(1 << 16):
+                parser.feed(decoder.decode(chunk))
+                for row in parser.take_rows():
+                    yield row
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise FetchError(repr(e)) from e
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    for row in parser.take_rows():
+        yield row
+
+async def ingest_eval_page(session, writer, baseurl, jobset, eval_id, eval_timestamp, build_ids, on_done=None):
+    """Take the status of `build_ids` from the overview page of the eval instead of fetching every build.
+
+    The eval's timestamp is stored for these builds, as the page doesn't show
+    when they were queued. Builds that the page describes completely are handed
+    to `writer.add_async` and to `on_done(build_id, None)`, the others still have to
+    be fetched one by one. Returns the number of builds that were handled.
+    """
+    build_ids = set(build_ids)
+    handled = set()
+    progress = Progress(f"{jobset}: builds from the eval page", len(build_ids))
+    try:
+        with metrics.timed("eval_page"):
+            async for row in fetch_eval_page(session, baseurl, eval_id):
+                if row.build_id not in build_ids or row.build_id in handled:
+                    continue
+                parsed = parse_eval_page_row(row)
+                if parsed is None:
+                    continue
+                status, jobname, system = parsed
+                await writer.add_async((row.build_id, baseurl, jobset, eval_id, eval_timestamp, status, jobname, system))
+                handled.add(row.build_id)
+                progress.update()
+                if on_done is not None:
+                    await on_done(row.build_id, None)
+    except FetchError as e:
+        print(f"{jobset}: the page of eval {eval_id} could not be fetched: {e}", file=sys.stderr)
+    progress.print()
+    metrics.increment("builds_from_eval_page", len(handled))
+    return len(handled)
+
+async def fetch_latest_success(session, baseurl, jobset, jobname, system):
+    """Fetch the latest successful build of a job, or None if it never succeeded.
+
+    Only a 404 with an error message means that there is no successful build,
+    any other answer than 200 raises FetchError, as the answer is stored.
+    """
+    try:
+        with metrics.timed("http_fetch"):
+            async with session.get(f"{baseurl}/job/{jobset}/{jobname}.{system}/latest", headers={"Accept": "application/json"}) as resp:
+                body = await resp.read()
+        if resp.status not in (200, 404):
+            raise FetchError(f"HTTP {resp.status}")
+        with metrics.timed("json_decode"):
+            build_info = json.loads(body)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise FetchError(repr(e)) from e
+    if not isinstance(build_info, dict):
+        raise FetchError(f"unexpected answer {build_info!r}")
+    if 'error' in build_info:
+        if resp.status == 404:
+            return None
+        raise FetchError(build_info['error'])
+    if resp.status == 404:
+        raise FetchError(f"HTTP {resp.status}")
+    return build_info
+
+async def _fetch_latest_success(session, job):
+    try:
+        return job, await fetch_latest_success(session, *job), None
+    except FetchError as e:
+        print(f"latest build of {job} could not be fetched: {e}", file=sys.stderr)
+        return job, None, str(e)
+
+async def _fetch_latest_successes(jobs, concurrency, window):
+    latest_successes = {}
+    async with create_session(concurrency) as session:
+        coroutines = (_fetch_latest_success(session, job) for job in jobs)
+        async for [job, build_info, error] in run_bounded(coroutines, window):
+            if error is None:
+                latest_successes[job] = build_info
+    return latest_successes
+
+def fetch_latest_successes(jobs, concurrency=DEFAULT_CONCURRENCY, window=None):
+    """Look up the latest successful build of every (baseurl, jobset, jobname, system) in `jobs`.
+
+    Returns a dict from job to the build JSON, or to None if the job never
+    succeeded. Jobs that could not be looked up are left out.
+    """
+    if window is None:
+        window = 4 * concurrency
+    return asyncio.run(_fetch_latest_successes(jobs, concurrency, window))
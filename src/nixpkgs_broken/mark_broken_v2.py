@@ -1,12 +1,14 @@
-import filecmp
-import json
 import os
-import re
 import shutil
-import subprocess
 import sys
+import tempfile
 
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+
+from nixpkgs_broken import nixindex
+from nixpkgs_broken.metrics import metrics
+from nixpkgs_broken.nixeval import Evaluator
 
 denyFileList = [
     "node-packages.nix", # node, it will mark all node packages as broken
@@ -44,179 +46,290 @@ def numLeadingSpaces(input_str):
 
     return count
 
-def insertBrokenMark(attr, file, brokenText, comment):
-    prev_line = None
-    shutil.copyfile(file, f'{file}.bak', follow_symlinks=False)
-    with open(file, "r") as input_file:
-        input_data = input_file.read()
-
-    move_broken_to_meta_bottom = True
-
-    output_lines = []
-
-    in_meta = False
-    meta_end = False
-    meta_end_marker = '};'
-    lines = input_data.splitlines()
-    broken_counter = 0
-    for linenr in range(len(lines)):
-        line = lines[linenr].rstrip()
-        # TODO(Mindavi): Decide if we want to replace the current line or move it to the bottom.
-        brokenline = re.search(r'broken\s+=', line)
-        if brokenline:
-            broken_counter += 1
-            if broken_counter > 1:
-                failMark(attr, f"the file {file} contains multiple broken lines, unclear which to mark")
-                return
-            # Assume this broken line terminates on the same line.
-            if not ';' in line:
-                failMark(attr, "broken line unterminated on this line, cannot handle multiline broken marks")
-                return
-            # TODO(Mindavi): It should be easier to filter than doing it like this...
-            if 'Static' in line or 'targetPlatform' in line or 'is32bit' in line or 'kernel' in line or 'with' in line or 'version' in line or 'meta' in line or 'python' in line or 'Support' in line:
+# An existing broken expression with any of these depends on more than the platform,
+# so replacing it with a platform check would lose information.
+specialBrokenWords = [ 'Static', 'targetPlatform', 'is32bit', 'kernel', 'with', 'version', 'meta', 'python', 'Support' ]
+
+def brokenMarkEdit(attr, text, block, brokenText, comment):
+    """Return the (start, end, replacement) edit of `text` that marks the meta block broken, or None if that can't be done automatically."""
+    commentLine = f"# {comment}" if comment else None
+    # For bindings that don't have a line of their own.
+    inlineComment = f"/* {comment} */ " if comment else ""
+    broken = block.binding("broken")
+    if broken is not None:
+        value = broken.value(text)
+        for word in specialBrokenWords:
+            if word in value:
                 failMark(attr, "broken line contains special information, cannot handle anything other than a platform")
-                return
-            # It's not really nice to move the broken line if an explanation of the brokenness is provided above it.
-            # Detect if the next line is the meta closing line '};'. In that case this is ok.
-            next_line = lines[min(linenr+1, len(lines))]
-            prev_line_is_comment = '#' in prev_line
-            next_line_is_meta_end = meta_end_marker in next_line
-            if not next_line_is_meta_end and prev_line_is_comment:
-                failMark(attr, "broken line is preceded by comment, should be moved manually together with comment")
-                return
+                return None
+        # Replace the expression in place, which keeps any explanation next to it.
+        replacement = f"broken = {brokenText};"
+        indent = nixindex.indentation(text, broken.start)
+        if commentLine and indent is not None:
+            replacement = f"{commentLine}\n{indent}{replacement}"
+        else:
+            replacement = f"{inlineComment}{replacement}"
+        return broken.start, broken.end, replacement
+    bindingIndent = nixindex.indentation(text, block.bindings[-1].start) if block.bindings else None
+    if bindingIndent is not None and nixindex.indentation(text, block.end) is not None:
+        # Add it as the last binding, on its own line.
+        lines = f"{bindingIndent}{commentLine}\n" if commentLine else ""
+        lines += f"{bindingIndent}broken = {brokenText};\n"
+        start = nixindex.line_start(text, block.end)
+        return start, start, lines
+    # The meta block is on a single line, e.g. meta = { description = "..."; };
+    return block.end, block.end, f"{inlineComment}broken = {brokenText}; "
+
+def insertBrokenMarks(file, marks):
+    """Apply every mark in `marks` to `file` in one write, given as (attr, line, brokenText, comment).
+
+    `line` is a line in the meta block to edit (e.g. the position of meta.description),
+    if it is None the file must have a single meta block. The original file is
+    kept as `{file}.bak`. Returns the marks that were applied.
+    """
+    try:
+        text, blocks = nixindex.meta_index.get(file)
+    except (OSError, nixindex.ParseError) as e:
+        for [attr, line, brokenText, comment] in marks:
+            failMark(attr, f"couldn't read the meta blocks of {file}: {e}")
+        return []
+    edits = []
+    applied = []
+    editedBlocks = set()
+    for mark in marks:
+        [attr, line, brokenText, comment] = mark
+        if line is None:
+            block = blocks[0] if len(blocks) == 1 else None
+        else:
+            block = nixindex.find_block(blocks, line)
+        if block is None:
+            failMark(attr, f"Couldn't find the meta block in {file}. Does it have a meta attribute?")
+            continue
+        if block.start in editedBlocks:
+            failMark(attr, f"the meta block in {file} is already edited for another attribute")
+            continue
+        edit = brokenMarkEdit(attr, text, block, brokenText, comment)
+        if edit is None:
             continue
-        if meta_end:
-            meta_end = False
-        if 'meta =' in line:
-            in_meta = True
-        elif in_meta and meta_end_marker in line:
-            meta_end = True
-            in_meta = False
-        elif in_meta:
-            meta_indent = numLeadingSpaces(line)
-        if not meta_end and prev_line != None:
-            output_lines.append(prev_line)
-        elif meta_end:
-            output_lines.append(prev_line)
-            if comment:
-                output_lines.append(f"{' ' * meta_indent}# {comment}")
-            output_lines.append(f"{' ' * meta_indent}broken = {brokenText};")
-        prev_line = line
-    output_lines.append(prev_line)
-
-    with open(file, 'w') as output_file:
-        for line in output_lines:
-            print(line, file=output_file)
+        editedBlocks.add(block.start)
+        edits.append(edit)
+        applied.append(mark)
+    if not edits:
+        return []
+
+    shutil.copyfile(file, f'{file}.bak', follow_symlinks=False)
+    # Apply from the end of the file, so the offsets of the other edits stay valid.
+    for [start, end, replacement] in sorted(edits, reverse=True):
+        text = text[:start] + replacement + text[end:]
+    replaceFile(file, text)
+    return applied
+
+def replaceFile(file, text):
+    """Replace the content of `file` by `text` at once.
+
+    The text is written to a temporary file next to it, which is renamed over
+    `file`, so the evaluations of other workers never read a half written file.
+    """
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(file) or ".", prefix=f".{os.path.basename(file)}.")
+    try:
+        with os.fdopen(fd, 'w') as output_file:
+            output_file.write(text)
+        shutil.copymode(file, tmpPath)
+        os.replace(tmpPath, file)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+
+def insertBrokenMark(attr, file, brokenText, comment, line=None):
+    return len(insertBrokenMarks(file, [(attr, line, brokenText, comment)])) == 1
 
 def failMark(attr, message):
     print(f"{attr}: {message}", file=sys.stderr)
     #with open("failed-marks.txt", "a+") as err_file:
     #    print(attr, file=err_file)
 
-def attemptToMarkBroken(attr: str, platforms: Iterable[str], extraText = ""):
+def brokenTextFor(platforms):
+    platforms = sorted(platforms)
+    if platforms == sorted(supportedPlatforms):
+        return "true"
+    brokenText = ""
+    for [short, combinablePlatforms] in shortPlatforms.items():
+        platformsWithoutCombinablePlatforms = set(platforms) - set(combinablePlatforms)
+        if (len(platforms) - 2 == len(platformsWithoutCombinablePlatforms)):
+            if len(brokenText) > 0:
+                brokenText += " || "
+            brokenText += short
+            # Remove the platforms from the list of platforms to be considered.
+            platforms = list(filter(lambda item: item not in combinablePlatforms, platforms))
+    multiplePlatforms = len(platforms) > 1 or len(brokenText) > 0
+    for platform in platforms:
+        if len(brokenText) > 0:
+            brokenText += " || "
+        if multiplePlatforms:
+            brokenText += "("
+        brokenText += platformsAndBrokenText[platform]
+        if multiplePlatforms:
+            brokenText += ")"
+    assert(brokenText != "")
+    return brokenText
+
+def planMark(attr: str, platforms: Iterable[str], attrInfo):
+    """Decide how to mark `attr` broken, given its answer from Evaluator.query.
+
+    Returns (file, line, platforms), where platforms are all platforms it should
+    be marked broken for (including the ones it's already marked broken for),
+    or None if it can't or doesn't need to be marked.
+    """
     if len(platforms) == 0:
-        return
+        return None
     for platform in platforms:
         if platform not in supportedPlatforms:
             print(f"{platform} is not supported", file=sys.stderr)
-            return
+            return None
 
     for badAttr in denyAttrList:
         if badAttr in attr:
             failMark(attr, f"attr contained {badAttr}, skipped.")
-            return
+            return None
 
-    nixInstantiate = subprocess.run([ "nix-instantiate", "--eval", "--json", "-E", f"with import ./. {{}}; (builtins.unsafeGetAttrPos \"description\" {attr}.meta).file" ], capture_output=True)
-    if nixInstantiate.returncode != 0:
+    if attrInfo is None or attrInfo["position"] is None:
         failMark(attr, "Couldn't locate correct file")
-        return
-    nixFile = json.loads(nixInstantiate.stdout.decode('utf-8'))
+        return None
+    nixFile = attrInfo["position"]["file"]
 
     for filename in denyFileList:
         # should use basename instead of doing this
         if filename in os.path.basename(nixFile):
             failMark(attr, f"filename matched {filename}, skipped.")
-            return
-
-    platforms.sort()
-    supportedPlatforms.sort()
+            return None
 
     alreadyMarkedPlatforms = []
-    for platform in supportedPlatforms:
-        # We'll already mark it broken for this platform.
-        #if platform in platforms:
-        #    continue
-        alreadyMarked = subprocess.run([ "nix-instantiate", "--eval", "--json",
-                                         "-E", f"with import ./. {{ localSystem = \"{platform}\"; }}; {attr}.meta.broken" ], capture_output=True)
+    for platform in sorted(supportedPlatforms):
+        isMarkedBrokenForPlatform = attrInfo["broken"].get(platform)
         # assertion (stdenv).hostPlatform.isLinux failed can sometimes occur when checking for Darwin.
         # TODO(Mindavi): handle that situation better.
-        if alreadyMarked.returncode != 0:
-            failMark(attr, "Couldn't check meta.broken: {alreadyMarked.stderr.decode('utf-8').split()[0]}")
-            return
+        if isMarkedBrokenForPlatform is None:
+            failMark(attr, f"Couldn't check meta.broken for platform {platform}")
+            return None
 
-        isMarkedBrokenForPlatform = json.loads(alreadyMarked.stdout.decode('utf-8'))
         if isMarkedBrokenForPlatform:
             #print(f"Package {attr} is already marked broken for {platform}")
             alreadyMarkedPlatforms.append(platform)
 
-    alreadyMarkedPlatforms.sort()
-    extraPlatforms = list(set(platforms) - set(alreadyMarkedPlatforms))
-    if alreadyMarkedPlatforms == platforms or len(extraPlatforms) == 0:
+    extraPlatforms = set(platforms) - set(alreadyMarkedPlatforms)
+    if len(extraPlatforms) == 0:
         print(f"Package {attr} is already marked broken for all platforms listed {alreadyMarkedPlatforms}, not doing anything")
+        return None
+
+    allPlatforms = sorted(set(platforms) | set(alreadyMarkedPlatforms))
+    assert(len(allPlatforms) <= len(supportedPlatforms))
+    return nixFile, attrInfo["position"]["line"], allPlatforms
+
+def markFile(nixFile, groups, evaluator):
+    """Mark groups of attributes broken with a single edit of `nixFile`, and validate them in a single evaluation.
+
+    `groups` holds (line, attrs, platforms, comment) for every meta block to
+    edit, where line is in the meta block that the attributes share. If some
+    groups don't validate, the file is restored and edited again with only the
+    groups that did. The file is replaced as a whole on every change, and its
+    backup is removed once the marks are validated. Returns the attributes that were marked.
+    """
+    for [line, attrs, platforms, comment] in groups:
+        assert(not "#" in comment and not "/" in comment)
+    for attempt in range(2):
+        # insert broken attribute
+        marks = [(", ".join(attrs), line, brokenTextFor(platforms), comment) for [line, attrs, platforms, comment] in groups]
+        with metrics.timed("file_edit"):
+            applied = insertBrokenMarks(nixFile, marks)
+        appliedGroups = [group for [group, mark] in zip(groups, marks) if mark in applied]
+        if not appliedGroups:
+            return []
+
+        # broken should evaluate to true now (for the given platform(s))
+        allAttrs = [attr for [line, attrs, platforms, comment] in appliedGroups for attr in attrs]
+        evaluator.invalidate(allAttrs)
+        try:
+            # Only the platforms that are marked have to be checked, which saves their nixpkgs imports.
+            attrInfos = evaluator.query(allAttrs, {platform for [line, attrs, platforms, comment] in appliedGroups for platform in platforms})
+        except BaseException:
+            os.replace(f"{nixFile}.bak", nixFile)
+            raise
+        validGroups = [group for group in appliedGroups if validateMark(group[1], group[2], attrInfos)]
+        if len(validGroups) == len(appliedGroups):
+            os.remove(f"{nixFile}.bak")
+            return allAttrs
+        os.replace(f"{nixFile}.bak", nixFile)
+        evaluator.invalidate(allAttrs)
+        groups = validGroups
+        if not groups:
+            break
+    return []
+
+def validateMark(attrs, platforms, attrInfos):
+    for attr in attrs:
+        for platform in platforms:
+            attrInfo = attrInfos[attr]
+            markedSuccessfully = attrInfo["broken"].get(platform) if attrInfo else None
+            if markedSuccessfully is None:
+                failMark(attr, f"Failed to check {attr}.meta.broken for platform {platform}")
+                return False
+            if not markedSuccessfully:
+                failMark(attr, f"{attr}.meta.broken doesn't evaluate to true for {platform}.")
+                return False
+    return True
+
+def attemptToMarkBroken(attr: str, platforms: Iterable[str], extraText = "", evaluator: Evaluator = None):
+    # Assumes the current working directory is nixpkgs.
+    if evaluator is None:
+        evaluator = Evaluator()
+    if len(platforms) == 0:
         return
-
-    platforms = list(set(platforms + alreadyMarkedPlatforms))
-    platforms.sort()
-
-    assert(len(platforms) <= len(supportedPlatforms))
-
-    brokenText = ""
-    for [short, combinablePlatforms] in shortPlatforms.items():
-        platformsWithoutCombinablePlatforms = set(platforms) - set(combinablePlatforms)
-        if (len(platforms) - 2 == len(platformsWithoutCombinablePlatforms)):
-            if len(brokenText) > 0:
-                brokenText += " || "
-            brokenText += short
-            # Remove the platforms from the list of platforms to be considered.
-            platforms = list(filter(lambda item: item not in combinablePlatforms, platforms))
-    multiplePlatforms = len(platforms) > 1 or len(brokenText) > 0
-    for platform in platforms:
-        if len(brokenText) > 0:
-            brokenText += " || "
-        if multiplePlatforms:
-            brokenText += "("
-        brokenText += platformsAndBrokenText[platform]
-        if multiplePlatforms:
-            brokenText += ")"
-
-    if platforms == supportedPlatforms:
-        brokenText = "true"
-
-    assert(brokenText != "")
-    assert(not "#" in extraText and not "/" in extraText)
-
-    # insert broken attribute
-    insertBrokenMark(attr, nixFile, brokenText, extraText)
-
-    if filecmp.cmp(nixFile, f"{nixFile}.bak", shallow=False):
-        shutil.move(f"{nixFile}.bak", nixFile)
-        failMark(attr, "Does it have a meta attribute?")
+    plan = planMark(attr, platforms, evaluator.query([attr])[attr])
+    if plan is None:
         return
-
-    # broken should evaluate to true now (for the given platform(s))
-    for platform in platforms:
-        nixMarkedCheck = subprocess.run([ "nix-instantiate", "--eval", "--json", "-E", f"with import ./. {{ localSystem = \"{platform}\"; }}; {attr}.meta.broken" ], capture_output=True)
-        if nixMarkedCheck.returncode != 0:
-            shutil.move(f"{nixFile}.bak", nixFile)
-            failMark(attr, f"Failed to check {attr}.meta.broken for platform {platform}: {nixMarkedCheck.stderr.decode('utf-8').split()[0]}")
-            return
-        markedSuccessfully = json.loads(nixMarkedCheck.stdout.decode('utf-8'))
-        if not markedSuccessfully:
-            shutil.move(f"{nixFile}.bak", nixFile)
-            failMark(attr, f"{attr}.meta.broken doesn't evaluate to true for {platform}.")
-            return
-
-    os.remove(f"{nixFile}.bak")
+    nixFile, line, allPlatforms = plan
+    markFile(nixFile, [(line, [attr], allPlatforms, extraText)], evaluator)
+
+def markFileInWorker(nixpkgsPath, nixFile, groups):
+    return markFile(nixFile, groups, Evaluator(nixpkgsPath, jobs=1))
+
+def markBrokenBatch(marks: Iterable[tuple[str, Iterable[str], str]], nixpkgsPath=".", jobs=None, evaluator: Evaluator = None):
+    """Mark many attributes broken, given as (attr, platforms, extraText).
+
+    All attributes are evaluated together, then grouped by the file that
+    defines them and by meta block. Every file is edited once, for all of its
+    meta blocks, and the attributes are validated in one evaluation. Files are handled in up to `jobs`
+    worker processes at the same time.
+    Returns the attributes that were marked.
+    """
+    marks = list(marks)
+    if evaluator is None:
+        evaluator = Evaluator(nixpkgsPath, jobs=jobs)
+    attrInfos = evaluator.query([attr for [attr, platforms, extraText] in marks if len(platforms) > 0])
+
+    # file -> line -> (attrs, platforms, comments)
+    files = {}
+    for [attr, platforms, extraText] in marks:
+        plan = planMark(attr, list(platforms), attrInfos.get(attr))
+        if plan is None:
+            continue
+        nixFile, line, allPlatforms = plan
+        attrs, groupPlatforms, comments = files.setdefault(nixFile, {}).setdefault(line, ([], set(), []))
+        attrs.append(attr)
+        # Attributes that share a meta block are marked broken for all of their platforms together.
+        groupPlatforms.update(allPlatforms)
+        if extraText and extraText not in comments:
+            comments.append(extraText)
+
+    marked = []
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = []
+        for [nixFile, lines] in files.items():
+            groups = [(line, attrs, sorted(platforms), ", ".join(comments)) for [line, [attrs, platforms, comments]] in sorted(lines.items())]
+            futures.append(pool.submit(markFileInWorker, nixpkgsPath, nixFile, groups))
+        for future in futures:
+            marked += future.result()
+    return marked
 
 if __name__ == "__main__":
     if len(sys.argv) <= 2:
@@ -0,0 +1,154 @@
+"""Counters and per-phase latency histograms.
+
+The phases are the places where time goes: http_fetch, json_decode, eval_page,
+db_write, nix_eval and file_edit. Everything is recorded in the module level `metrics`
+registry, which can be written as a JSON summary or as a Prometheus textfile
+(for the node_exporter textfile collector).
+"""
+from collections import defaultdict
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Histogram:
+    def __init__(self):
+        # The last count is for values above the largest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for [i, bucket] in enumerate(buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        rank = q * self.count
+        seen = 0
+        for [i, count] in enumerate(self.counts[:-1]):
+            seen += count
+            if seen >= rank:
+                return buckets[i]
+        return self.max
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.started = time.time()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            self.histograms[phase].observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.monotonic() - start)
+
+    def summary(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "counters": dict(self.counters),
+                "phases": {
+                    phase: {
+                        "count": histogram.count,
+                        "seconds": histogram.sum,
+                        "max": histogram.max,
+                        "p50": histogram.quantile(0.5),
+                        "p99": histogram.quantile(0.99),
+                    }
+                    for [phase, histogram] in self.histograms.items()
+                },
+            }
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"finished in {summary['duration']:.1f}s")
+        for [phase, stats] in sorted(summary["phases"].items()):
+            print(f"  {phase}: {stats['count']} times, {stats['seconds']:.1f}s total, p50 <= {stats['p50']}s, p99 <= {stats['p99']}s, max {stats['max']:.3f}s")
+        for [name, value] in sorted(summary["counters"].items()):
+            print(f"  {name}: {value}")
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for [name, value] in sorted(self.counters.items()):
+                lines.append(f"# TYPE nixpkgs_broken_{name}_total counter")
+                lines.append(f"nixpkgs_broken_{name}_total {value}")
+            lines.append("# TYPE nixpkgs_broken_phase_seconds histogram")
+            for [phase, histogram] in sorted(self.histograms.items()):
+                cumulative = 0
+                for [bucket, count] in zip(buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'nixpkgs_broken_phase_seconds_bucket{{phase="{phase}",le="{bucket}"}} {cumulative}')
+                lines.append(f'nixpkgs_broken_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {histogram.count}')
+                lines.append(f'nixpkgs_broken_phase_seconds_sum{{phase="{phase}"}} {histogram.sum}')
+                lines.append(f'nixpkgs_broken_phase_seconds_count{{phase="{phase}"}} {histogram.count}')
+            lines.append("# TYPE nixpkgs_broken_last_run_timestamp_seconds gauge")
+            lines.append(f"nixpkgs_broken_last_run_timestamp_seconds {self.started}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.summary(), indent=2) + "\n")
+
+    def write_prometheus(self, path):
+        write_atomically(path, self.prometheus())
+
+def write_atomically(path, text):
+    # The textfile collector may read the file at any time, so never let it see a partial file.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w") as output_file:
+        output_file.write(text)
+    os.replace(temp_path, path)
+
+metrics = Metrics()
+
+class Progress:
+    """Prints how far along a phase is, at most once every `interval` seconds."""
+    def __init__(self, label, total=None, interval=5.0):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self.last_print = self.start
+
+    def update(self, count=1, failed=0):
+        self.count += count
+        self.failed += failed
+        now = time.monotonic()
+        if now - self.last_print >= self.interval:
+            self.last_print = now
+            self.print()
+
+    def print(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0
+        total = f"/{self.total}" if self.total is not None else ""
+        failed = f", {self.failed} failed" if self.failed else ""
+        print(f"{self.label}: {self.count}{total} ({rate:.1f}/s{failed})")
@@ -0,0 +1,166 @@
+"""Batched nix evaluation.
+
+Importing nixpkgs is the expensive part of every nix-instantiate call, so these
+helpers evaluate many attributes in one nix-instantiate invocation instead of
+starting one per attribute.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import sys
+
+from nixpkgs_broken.metrics import metrics
+
+DEFAULT_CHUNK_SIZE = 250
+
+# Every attribute is wrapped in tryEval, so an attribute that throws (e.g. an alias)
+# becomes null instead of failing the whole chunk.
+attr_files_expr = """
+{ nixpkgs, attrs }:
+let
+  pkgs = import nixpkgs { };
+  lib = pkgs.lib;
+  position = attr:
+    let
+      result = builtins.tryEval (
+        let
+          pkg = lib.attrByPath (lib.splitString "." attr) null pkgs;
+          pos = if pkg == null then null else builtins.unsafeGetAttrPos "description" (pkg.meta or { });
+        in
+          if pos == null then null else pos.file);
+    in
+      if result.success then result.value else null;
+in
+  builtins.listToAttrs (map (attr: { name = attr; value = position attr; }) (builtins.fromJSON attrs))
+"""
+
+def chunked(items, chunk_size):
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+def error_lines(stderr):
+    return ", ".join(line.strip() for line in stderr.splitlines() if "error: " in line)
+
+def evaluate(expr, args):
+    """Evaluate the function `expr` with the given string arguments and return the result as parsed JSON.
+
+    Returns None when nix-instantiate fails.
+    """
+    command = [ "nix-instantiate", "--eval", "--strict", "--json", "-E", expr ]
+    for [name, value] in args.items():
+        command += [ "--argstr", name, value ]
+    with metrics.timed("nix_eval"):
+        result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        print(f"error during nix-instantiate: {error_lines(result.stderr.decode('utf-8'))}", file=sys.stderr)
+        return None
+    return json.loads(result.stdout.decode('utf-8'))
+
+def evaluate_chunk(expr, args, attrs):
+    """Evaluate `expr` for `attrs`, splitting the chunk when an error escapes tryEval.
+
+    Attributes that still fail on their own map to None.
+    """
+    result = evaluate(expr, dict(args, attrs=json.dumps(attrs)))
+    if result is not None:
+        return result
+    if len(attrs) == 1:
+        return { attrs[0]: None }
+    middle = len(attrs) // 2
+    return evaluate_chunk(expr, args, attrs[:middle]) | evaluate_chunk(expr, args, attrs[middle:])
+
+def resolve_attr_files(nixpkgs_path, attrs, chunk_size=DEFAULT_CHUNK_SIZE, jobs=None):
+    """Resolve the file that defines meta.description for every attribute in `attrs`.
+
+    The attributes are evaluated in chunks of `chunk_size`, with up to `jobs`
+    nix-instantiate processes running at the same time. Returns a dict from
+    attribute to file, where the file is None if it could not be resolved.
+    """
+    args = { "nixpkgs": os.path.abspath(nixpkgs_path) }
+    attr_files = {}
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        for result in pool.map(lambda chunk: evaluate_chunk(attr_files_expr, args, chunk), chunked(list(attrs), chunk_size)):
+            attr_files.update(result)
+    return attr_files
+
+# Imports nixpkgs once per requested system and answers all attributes from those
+# imports. The position comes from the first system, as it's the same for all of them.
+# Looking an attribute up happens inside tryEval, so one that throws is only null itself.
+meta_broken_expr = """
+{ nixpkgs, attrs, systems }:
+let
+  lib = import (nixpkgs + "/lib");
+  systemList = builtins.fromJSON systems;
+  pkgsFor = lib.genAttrs systemList (system: import nixpkgs { localSystem = system; });
+  try = value: let result = builtins.tryEval value; in if result.success then result.value else null;
+  query = attr:
+    let
+      pkgFor = system: lib.attrByPath (lib.splitString "." attr) null pkgsFor.${system};
+      position = system:
+        let
+          pkg = pkgFor system;
+          pos = if pkg == null then null else builtins.unsafeGetAttrPos "description" (pkg.meta or { });
+        in
+          if pos == null then null else { inherit (pos) file line; };
+      brokenFor = system:
+        let
+          pkg = pkgFor system;
+        in
+          if pkg == null then null else pkg.meta.broken or false;
+    in {
+      position = try (position (builtins.head systemList));
+      broken = lib.genAttrs systemList (system: try (brokenFor system));
+    };
+in
+  builtins.listToAttrs (map (attr: { name = attr; value = query attr; }) (builtins.fromJSON attrs))
+"""
+
+class Evaluator:
+    """Answers where attributes are defined and whether they are marked broken, for all platforms at once.
+
+    nix-instantiate can't be kept running between requests, so instead every
+    request evaluates a batch of attributes for all platforms in a single
+    process, sharing the nixpkgs import per platform. A request still imports
+    nixpkgs once per platform, so querying fewer platforms is cheaper. Answers
+    are kept until `invalidate` is called, e.g. after editing the file that
+    defines them.
+    """
+    def __init__(self, nixpkgs_path=".", systems=None, chunk_size=DEFAULT_CHUNK_SIZE, jobs=None):
+        self.args = {
+            "nixpkgs": os.path.abspath(nixpkgs_path),
+            "systems": json.dumps(systems or [ "aarch64-linux", "x86_64-linux", "aarch64-darwin", "x86_64-darwin" ]),
+        }
+        self.chunk_size = chunk_size
+        self.jobs = jobs
+        self.answers = {}
+
+    def query(self, attrs, systems=None):
+        """Return a dict from attribute to {"position": {"file", "line"}, "broken": {system: bool}}.
+
+        The position is None if the attribute has no meta.description, a broken
+        value is None if it couldn't be evaluated for that system, and the whole
+        answer is None if the attribute couldn't be evaluated at all.
+        With `systems`, only those platforms are evaluated, and the answers
+        aren't kept.
+        """
+        if systems is not None:
+            return self.evaluate(list(dict.fromkeys(attrs)), dict(self.args, systems=json.dumps(sorted(systems))))
+        missing = [attr for attr in dict.fromkeys(attrs) if attr not in self.answers]
+        if missing:
+            self.answers.update(self.evaluate(missing, self.args))
+        return { attr: self.answers[attr] for attr in attrs }
+
+    def evaluate(self, attrs, args):
+        answers = {}
+        with ThreadPoolExecutor(max_workers=self.jobs or os.cpu_count()) as pool:
+            for result in pool.map(lambda chunk: evaluate_chunk(meta_broken_expr, args, chunk), chunked(attrs, self.chunk_size)):
+                answers.update(result)
+        return answers
+
+    def invalidate(self, attrs=None):
+        if attrs is None:
+            self.answers.clear()
+            return
+        for attr in attrs:
+            self.answers.pop(attr, None)
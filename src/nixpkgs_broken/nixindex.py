@@ -0,0 +1,236 @@
+"""Index of the meta attribute sets in a Nix file.
+
+A small tokenizer is enough to find `meta = { ... };` and the `broken` binding
+inside it: strings (including interpolations) and comments are skipped as a
+whole, so braces and semicolons in them don't confuse the matching. Every
+block records exact offsets, so an edit only touches the bytes it changes.
+The index of a file is cached by modification time and content hash.
+"""
+import bisect
+import hashlib
+import os
+import re
+from typing import NamedTuple
+
+class Token(NamedTuple):
+    kind: str
+    value: str
+    start: int
+    end: int
+
+class Binding(NamedTuple):
+    name: str
+    # Offset of the attribute name, of the value, and just after the terminating semicolon.
+    start: int
+    value_start: int
+    end: int
+
+    def value(self, text):
+        return text[self.value_start:self.end - 1].strip()
+
+class MetaBlock(NamedTuple):
+    # Offsets of the opening and closing brace of the attribute set.
+    start: int
+    end: int
+    start_line: int
+    end_line: int
+    bindings: list
+
+    def binding(self, name):
+        for binding in self.bindings:
+            if binding.name == name:
+                return binding
+        return None
+
+class ParseError(Exception):
+    pass
+
+token_pattern = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>\#[^\n]*|/\*.*?\*/)
+  | (?P<uri>[a-zA-Z][a-zA-Z0-9+.-]*:[a-zA-Z0-9%/?:@&=+$,_.!~*'-]+)
+  | (?P<path>[a-zA-Z0-9._+-]*(?:/[a-zA-Z0-9._+-]+)+/?|~(?:/[a-zA-Z0-9._+-]+)+/?|<[a-zA-Z0-9._+/-]+>)
+  | (?P<ident>[a-zA-Z_][a-zA-Z0-9_'-]*)
+  | (?P<number>[0-9]+(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?)
+  | (?P<ind_string>'')
+  | (?P<string>")
+  | (?P<interpolation>\$\{)
+  | (?P<op>\.\.\.|//|\+\+|&&|\|\||->|==|!=|<=|>=|[{}()\[\];=.,:?@!<>+*/-])
+""", re.VERBOSE | re.DOTALL)
+
+def tokenize(text, pos=0, in_interpolation=False):
+    """Return the tokens of `text` without whitespace and comments, and the offset where scanning stopped.
+
+    Strings are single tokens. With `in_interpolation`, scanning stops after
+    the brace that closes the interpolation.
+    """
+    tokens = []
+    depth = 0
+    while pos < len(text):
+        m = token_pattern.match(text, pos)
+        if m is None:
+            raise ParseError(f"unexpected character {text[pos]!r} at offset {pos}")
+        kind = m.lastgroup
+        start = pos
+        pos = m.end()
+        if kind in ("space", "comment"):
+            continue
+        if kind == "string":
+            pos = skip_string(text, pos)
+        elif kind == "ind_string":
+            pos = skip_ind_string(text, pos)
+        elif kind == "interpolation":
+            pos = tokenize(text, pos, in_interpolation=True)[1]
+        elif kind == "op" and m.group() == "{":
+            depth += 1
+        elif kind == "op" and m.group() == "}":
+            if in_interpolation and depth == 0:
+                return tokens, pos
+            depth -= 1
+        tokens.append(Token(kind, text[start:pos], start, pos))
+    if in_interpolation:
+        raise ParseError("unterminated interpolation")
+    return tokens, pos
+
+def skip_string(text, pos):
+    while pos < len(text):
+        c = text[pos]
+        if c == "\\":
+            pos += 2
+        elif c == '"':
+            return pos + 1
+        elif text.startswith("$${", pos):
+            pos += 3
+        elif text.startswith("${", pos):
+            pos = tokenize(text, pos + 2, in_interpolation=True)[1]
+        else:
+            pos += 1
+    raise ParseError("unterminated string")
+
+def skip_ind_string(text, pos):
+    while pos < len(text):
+        if text.startswith("'''", pos) or text.startswith("''$", pos):
+            pos += 3
+        elif text.startswith("''\\", pos):
+            pos += 4
+        elif text.startswith("''", pos):
+            return pos + 2
+        elif text.startswith("$${", pos):
+            pos += 3
+        elif text.startswith("${", pos):
+            pos = tokenize(text, pos + 2, in_interpolation=True)[1]
+        else:
+            pos += 1
+    raise ParseError("unterminated indented string")
+
+def is_op(token, value):
+    return token.kind == "op" and token.value == value
+
+def matching_brace(tokens, i):
+    """Return the index of the token that closes the brace, bracket or parenthesis at `i`."""
+    pairs = {"{": "}", "(": ")", "[": "]"}
+    stack = []
+    for j in range(i, len(tokens)):
+        token = tokens[j]
+        if token.kind != "op":
+            continue
+        if token.value in pairs:
+            stack.append(pairs[token.value])
+        elif stack and token.value == stack[-1]:
+            stack.pop()
+            if not stack:
+                return j
+    raise ParseError(f"unbalanced {tokens[i].value} at offset {tokens[i].start}")
+
+def parse_bindings(tokens, start, end):
+    """Return the `name = value;` bindings directly inside the attribute set tokens[start] ... tokens[end]."""
+    bindings = []
+    i = start + 1
+    while i < end:
+        # A binding runs up to the next semicolon that isn't nested in braces, brackets or parentheses.
+        j = i
+        while j < end and not is_op(tokens[j], ";"):
+            if tokens[j].kind == "op" and tokens[j].value in "{([":
+                j = matching_brace(tokens, j)
+            j += 1
+        if j == end:
+            break
+        if j - i >= 3 and tokens[i].kind in ("ident", "string") and is_op(tokens[i + 1], "="):
+            bindings.append(Binding(tokens[i].value.strip('"'), tokens[i].start, tokens[i + 1].end, tokens[j].end))
+        i = j + 1
+    return bindings
+
+def parse_meta_blocks(text):
+    """Find every `meta = { ... }` (optionally `meta = with lib; { ... }`) in `text`."""
+    tokens = tokenize(text)[0]
+    line_starts = [0] + [m.end() for m in re.finditer("\n", text)]
+    def line_of(offset):
+        return bisect.bisect_right(line_starts, offset)
+    blocks = []
+    for i in range(len(tokens) - 2):
+        if tokens[i].kind != "ident" or tokens[i].value != "meta" or not is_op(tokens[i + 1], "="):
+            continue
+        if i > 0 and is_op(tokens[i - 1], "."):
+            continue
+        j = i + 2
+        while j < len(tokens) and tokens[j].kind == "ident" and tokens[j].value == "with":
+            while j < len(tokens) and not is_op(tokens[j], ";"):
+                j += 1
+            j += 1
+        if j >= len(tokens) or not is_op(tokens[j], "{"):
+            continue
+        end = matching_brace(tokens, j)
+        blocks.append(MetaBlock(
+            tokens[j].start, tokens[end].start,
+            line_of(tokens[j].start), line_of(tokens[end].start),
+            parse_bindings(tokens, j, end)))
+    return blocks
+
+def find_block(blocks, line):
+    """Return the innermost meta block that spans `line`, or None."""
+    candidates = [block for block in blocks if block.start_line <= line <= block.end_line]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda block: block.end - block.start)
+
+def line_start(text, offset):
+    return text.rfind("\n", 0, offset) + 1
+
+def indentation(text, offset):
+    """The whitespace before `offset` on its line, or None if anything else precedes it."""
+    prefix = text[line_start(text, offset):offset]
+    return prefix if prefix.strip() == "" else None
+
+class MetaIndex:
+    """Caches the meta blocks of files.
+
+    An entry is reused as long as the file's modification time and size are
+    unchanged. If they changed but the content hash didn't (e.g. the file was
+    restored from a backup), the entry is reused as well.
+
+    The cache lives in the process. markBrokenBatch hands every file to a
+    single worker process, so there it only saves the parse of the retry after
+    a failed validation. Repeated marks in a single process, like
+    attemptToMarkBroken for one attribute after another, reuse it fully.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, path):
+        """Return the content of `path` and its meta blocks."""
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[2], entry[3]
+        with open(path, "r") as nix_file:
+            text = nix_file.read()
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        if entry is not None and entry[1] == digest:
+            blocks = entry[3]
+        else:
+            blocks = parse_meta_blocks(text)
+        self.entries[path] = (key, digest, text, blocks)
+        return text, blocks
+
+meta_index = MetaIndex()
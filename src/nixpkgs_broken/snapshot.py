@@ -0,0 +1,61 @@
+"""Snapshots of the build database.
+
+A snapshot is a gzip compressed file with one JSON array per line: a header
+first, then the records of Database.get_snapshot_records. One node can ingest
+from Hydra and export a snapshot, which report and mark-broken workers import
+instead of ingesting everything themselves.
+"""
+import gzip
+import json
+import os
+import tempfile
+import time
+
+FORMAT = "nixpkgs-broken-snapshot"
+VERSION = 1
+
+class SnapshotError(Exception):
+    pass
+
+def export_snapshot(database, path, first_eval_id=None, last_eval_id=None):
+    """Write the evals from `first_eval_id` up to `last_eval_id` (both optional) to `path`, returns the number of records."""
+    header = {"format": FORMAT, "version": VERSION, "created": int(time.time()), "first_eval_id": first_eval_id, "last_eval_id": last_eval_id}
+    number = 0
+    # Readers must never see a partial snapshot.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as raw_file, gzip.GzipFile(fileobj=raw_file, mode="wb", compresslevel=6) as snapshot_file:
+            snapshot_file.write(json.dumps(header).encode() + b"\n")
+            for record in database.get_snapshot_records(first_eval_id, last_eval_id):
+                snapshot_file.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+                number += 1
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return number
+
+def read_snapshot(path):
+    """Return the header of the snapshot at `path` and a generator of its records."""
+    snapshot_file = gzip.open(path, "rb")
+    try:
+        header = json.loads(snapshot_file.readline())
+    except (OSError, ValueError) as e:
+        snapshot_file.close()
+        raise SnapshotError(f"{path} is not a snapshot: {e}") from e
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        snapshot_file.close()
+        raise SnapshotError(f"{path} is not a snapshot")
+    if header.get("version") != VERSION:
+        snapshot_file.close()
+        raise SnapshotError(f"{path} has snapshot version {header.get('version')}, only version {VERSION} is supported")
+    def records():
+        with snapshot_file:
+            for line in snapshot_file:
+                yield json.loads(line)
+    return header, records()
+
+def import_snapshot(database, path):
+    """Load the snapshot at `path` into `database`, returns its header and how many records of each kind it had."""
+    header, records = read_snapshot(path)
+    return header, database.load_snapshot_records(records)
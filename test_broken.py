@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+from nixpkgs_broken import broken
+import asyncio
+import os
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import unittest
+
+class TestBulkUpsert(unittest.TestCase):
+    def setUp(self):
+        self.database = broken.Database(":memory:")
+
+    def status_of(self, build_id):
+        return self.database.get_build_id(build_id)[1]
+
+    def test_insert_many(self):
+        self.database.insert_or_update_build_results([
+            (1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "hello", "x86_64-linux"),
+            (2, "https://hydra", "nixpkgs/trunk", 10, 100, None, "world", "x86_64-linux"),
+            (3, "https://hydra", "nixpkgs/staging", 11, 100, 1, "hello", "x86_64-linux"),
+        ])
+        self.assertEqual(self.database.cursor.execute("SELECT count(*) FROM build_results").fetchone()[0], 3)
+        self.assertEqual(self.database.cursor.execute("SELECT count(*) FROM jobsets").fetchone()[0], 2, "One row per jobset")
+
+    def test_upsert_keeps_known_status(self):
+        self.database.insert_or_update_build_result(1, "https://hydra", "nixpkgs/trunk", 10, 100, 1, "hello", "x86_64-linux")
+        self.database.insert_or_update_build_results([(1, "https://hydra", "nixpkgs/trunk", 10, 100, None, "hello", "x86_64-linux")])
+        self.assertEqual(self.status_of(1), 1, "Unknown status does not overwrite a known one")
+        self.database.insert_or_update_build_results([(1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "hello", "x86_64-linux")])
+        self.assertEqual(self.status_of(1), 0, "Known status is updated")
+
+    def test_writer_flushes_on_size(self):
+        writer = self.database.build_result_writer(max_rows=2, max_age=3600)
+        writer.add((1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "a", "x86_64-linux"))
+        self.assertIsNone(self.database.get_build_id(1), "Nothing written before the batch is full")
+        writer.add((2, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "b", "x86_64-linux"))
+        self.assertIsNotNone(self.database.get_build_id(1))
+        with writer:
+            writer.add((3, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "c", "x86_64-linux"))
+        self.assertEqual(writer.written, 3)
+
+class TestUnknownBuilds(unittest.TestCase):
+    def test_split_unknown_and_without_status(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([
+            (1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "hello", "x86_64-linux"),
+            (2, "https://hydra", "nixpkgs/trunk", 10, 100, None, "world", "x86_64-linux"),
+        ])
+        unknown, without_status = database.get_unknown_builds([1, 2, 3, 3])
+        self.assertEqual(unknown, [3])
+        self.assertEqual(without_status, [2])
+        self.assertEqual(database.get_unknown_builds([4]), ([4], []), "Earlier candidates are forgotten")
+
+class TestNormalizedJobs(unittest.TestCase):
+    def test_migrate_names_to_ids(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "old.db")
+            connection = sqlite3.connect(path)
+            connection.execute("CREATE TABLE jobsets(jobset_id INTEGER PRIMARY KEY NOT NULL, url TEXT NOT NULL, jobset TEXT NOT NULL)")
+            connection.execute("INSERT INTO jobsets VALUES (1, 'https://hydra', 'nixpkgs/trunk')")
+            connection.execute("CREATE TABLE build_results(build_id INTEGER PRIMARY KEY NOT NULL, jobset_id INTEGER, eval_id INTEGER NOT NULL, eval_timestamp INTEGER NOT NULL, status INTEGER, job TEXT NOT NULL, system TEXT NOT NULL)")
+            connection.executemany("INSERT INTO build_results VALUES (?, 1, 10, ?, ?, 'hello', ?)", [(1, 100, 0, "x86_64-linux"), (2, 200, 1, "x86_64-linux"), (3, 200, 0, "aarch64-linux")])
+            connection.commit()
+            connection.close()
+            database = broken.Database(path)
+            columns = [row[1] for row in database.cursor.execute("PRAGMA table_info(build_results)")]
+            self.assertIn("job_id", columns)
+            self.assertNotIn("job", columns)
+            self.assertEqual(database.cursor.execute("SELECT count(*) FROM jobs").fetchone()[0], 1)
+            [report] = list(database.get_broken_report())
+            self.assertEqual((report[0], report[8]), (2, 1), "The failing build and the last success")
+
+    def test_names_are_stored_once(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([(build_id, "https://hydra", "nixpkgs/trunk", 10, 100, 1, "hello", "x86_64-linux") for build_id in range(5)])
+        database.insert_or_update_build_results([(5, "https://hydra", "nixpkgs/trunk", 11, 200, 0, "hello", "aarch64-linux")])
+        self.assertEqual(database.cursor.execute("SELECT count(*) FROM jobs").fetchone()[0], 1)
+        self.assertEqual(database.cursor.execute("SELECT count(*) FROM systems").fetchone()[0], 2)
+        self.assertEqual([row[6:8] for row in database.get_broken_report()], [("hello", "x86_64-linux")])
+
+class TestJobStreaks(unittest.TestCase):
+    def build(self, build_id, eval_id, status, system="x86_64-linux"):
+        return (build_id, "https://hydra", "nixpkgs/trunk", eval_id, eval_id * 86400, status, "hello", system)
+
+    def test_streak_since_last_success(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([self.build(1, 1, 1), self.build(2, 2, 0), self.build(3, 3, 1), self.build(4, 5, 1), self.build(5, 5, 0, "aarch64-linux")])
+        [report] = list(database.get_broken_report())
+        self.assertEqual(report[0], 4)
+        self.assertEqual(report[8:], (2, 2 * 86400, 3, 3 * 86400, 2, 2.0))
+        self.assertEqual(list(database.get_broken_report()), list(database.get_broken_report_from_history()))
+
+    def test_never_succeeded(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([self.build(1, 1, 1), self.build(2, 2, 1)])
+        [report] = list(database.get_broken_report())
+        self.assertEqual(report[8:13], (None, None, 1, 86400, 2))
+
+    def test_out_of_order_writes(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([self.build(3, 3, 1), self.build(4, 4, None)])
+        database.insert_or_update_build_results([self.build(1, 1, 1), self.build(2, 2, 0)])
+        database.insert_or_update_build_results([self.build(4, 4, 1)])
+        self.assertEqual(list(database.get_broken_report()), list(database.get_broken_report_from_history()))
+        self.assertEqual(list(database.get_broken_report())[0][8:13], (2, 2 * 86400, 3, 3 * 86400, 2))
+        database.update_build_status(4, 0)
+        self.assertEqual(list(database.get_broken_report()), [])
+
+    def test_streak_counts_evals_listing_the_build(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([self.build(1, 1, 0), self.build(2, 2, 1)])
+        # Build 2 is never rebuilt, so it isn't stored again for the evals that still list it.
+        for eval_id in range(1, 7):
+            database.mark_eval_ingested("https://hydra", "nixpkgs/trunk", eval_id, eval_id * 86400, 2)
+        [report] = list(database.get_broken_report())
+        self.assertEqual(report[12:], (5, 4.0))
+        self.assertEqual(list(database.get_broken_report()), list(database.get_broken_report_from_history()))
+        [failing] = list(database.get_failing_jobs())
+        self.assertEqual(failing[9:], (5, 4.0))
+
+    def test_recheck_keeps_stored_eval(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([self.build(1, 10, 0), self.build(2, 11, 1)])
+        # A recheck gets the build from Hydra, which names the newest eval that contains it.
+        database.insert_or_update_build_results([self.build(2, 15, 2)])
+        [report] = list(database.get_broken_report())
+        self.assertEqual(report[3:6], (11, 11 * 86400, 2))
+        self.assertEqual(list(database.get_broken_report()), list(database.get_broken_report_from_history()))
+
+    def test_eval_page_keeps_stored_eval(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([self.build(1, 10, 0), self.build(2, 11, None)])
+        # The page of a later eval gives the status with the timestamp of that eval.
+        database.insert_or_update_build_results([self.build(2, 12, 1)])
+        [report] = list(database.get_broken_report())
+        self.assertEqual(report[3:6], (11, 11 * 86400, 1))
+        self.assertEqual(list(database.get_broken_report()), list(database.get_broken_report_from_history()))
+
+class TestRecheck(unittest.TestCase):
+    def test_most_recent_first(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([
+            (1, "https://hydra", "nixpkgs/trunk", 10, 100, None, "a", "x86_64-linux"),
+            (2, "https://hydra", "nixpkgs/trunk", 10, 100, 1, "b", "x86_64-linux"),
+            (3, "https://hydra", "nixpkgs/trunk", 11, 200, 1, "b", "x86_64-linux"),
+            (4, "https://hydra", "nixpkgs/trunk", 11, 200, None, "c", "x86_64-linux"),
+            (5, "https://hydra", "nixpkgs/trunk", 11, 200, 0, "d", "x86_64-linux"),
+        ])
+        self.assertEqual([row[0] for row in database.get_builds_to_recheck()], [4, 1])
+        self.assertEqual([row[0] for row in database.get_builds_to_recheck(include_failed=True)], [4, 3, 1], "Only the latest failed build of a job is rechecked")
+        self.assertEqual(database.count_builds_to_recheck(include_failed=True), 3)
+        self.assertEqual([row[0] for row in database.get_builds_to_recheck(include_failed=True, page_size=2)], [4, 3, 1], "Pages continue below the last build")
+
+class TestFailingJobs(unittest.TestCase):
+    def test_last_success_from_history_or_hydra(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([
+            (1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "a", "x86_64-linux"),
+            (2, "https://hydra", "nixpkgs/trunk", 11, 200, 1, "a", "x86_64-linux"),
+            (3, "https://hydra", "nixpkgs/trunk", 11, 200, 1, "b", "x86_64-linux"),
+            (4, "https://hydra", "nixpkgs/trunk", 11, 200, 1, "c", "x86_64-linux"),
+            (5, "https://hydra", "nixpkgs/trunk", 11, 200, 1, "d", "x86_64-linux"),
+        ])
+        database.insert_or_update_last_successes([
+            ("https://hydra", "nixpkgs/trunk", "b", "x86_64-linux", 0, 50),
+            ("https://hydra", "nixpkgs/trunk", "c", "x86_64-linux", None, None),
+        ])
+        jobs = [(job, last_success, never_succeeded, unknown) for [_, _, _, _, job, _, last_success, never_succeeded, unknown, _, _] in database.get_failing_jobs()]
+        self.assertEqual(jobs, [("b", 50, 0, 0), ("a", 100, 0, 0), ("c", None, 1, 0), ("d", None, 0, 1)])
+
+    def test_queries_while_streaming(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([(build_id, "https://hydra", "nixpkgs/trunk", 10, 100, 1, f"job{build_id}", "x86_64-linux") for build_id in range(2500)])
+        jobs = []
+        for job in database.get_completed_jobs():
+            database.get_attr_files()
+            jobs.append(job)
+        self.assertEqual(len(jobs), 2500)
+
+class TestCompaction(unittest.TestCase):
+    def test_reports_survive_compaction(self):
+        database = broken.Database(":memory:")
+        statuses = [0, 0, 1, 1, 0, 1, 1, 1, 1, 1]
+        database.insert_or_update_build_results([
+            (eval_id, "https://hydra", "nixpkgs/trunk", eval_id, eval_id * 100, status, "hello", "x86_64-linux")
+            for [eval_id, status] in enumerate(statuses)
+        ])
+        report = list(database.get_broken_report_from_history())
+        self.assertEqual(database.compact_build_results(700), (7, 4))
+        self.assertEqual(list(database.get_broken_report_from_history()), report)
+        self.assertEqual(database.compact_build_results(900), (2, 4), "The new builds extend the last interval")
+        self.assertEqual(list(database.get_broken_report_from_history()), report)
+        self.assertEqual(database.cursor.execute("SELECT count(*) FROM build_results").fetchone()[0], 1)
+        self.assertEqual(list(database.get_broken_report()), list(database.get_broken_report_from_history()))
+        self.assertEqual(list(database.get_broken_report())[0][12], 5)
+
+    def test_interleaved_jobsets_survive_compaction(self):
+        database = broken.Database(":memory:")
+        # Odd evals are trunk, which always fails. staging succeeds once in eval 4.
+        statuses = [1, 1, 1, 0, 1, 1, 1, 1, 1, 1]
+        database.insert_or_update_build_results([
+            (eval_id, "https://hydra", "nixpkgs/trunk" if eval_id % 2 else "nixpkgs/staging", eval_id, eval_id * 100, status, "hello", "x86_64-linux")
+            for [eval_id, status] in enumerate(statuses, start=1)
+        ])
+        report = list(database.get_broken_report_from_history())
+        self.assertEqual(report[0][12], 6)
+        database.compact_build_results(1000)
+        self.assertEqual(list(database.get_broken_report_from_history()), report)
+        self.assertEqual(list(database.get_broken_report()), report)
+
+    def test_latest_builds_are_kept(self):
+        database = broken.Database(":memory:")
+        database.insert_or_update_build_results([
+            (1, "https://hydra", "nixpkgs/trunk", 10, 100, 1, "hello", "x86_64-linux"),
+            (2, "https://hydra", "nixpkgs/staging", 11, 200, 1, "hello", "x86_64-linux"),
+        ])
+        self.assertEqual(database.compact_build_results(1000), (0, 0))
+        # A later eval still lists the build, as its job wasn't rebuilt.
+        self.assertEqual(database.get_unknown_builds([1, 3]), ([3], []))
+        database.insert_or_update_build_results([(3, "https://hydra", "nixpkgs/trunk", 20, 2000, 1, "hello", "x86_64-linux")])
+        self.assertEqual(database.compact_build_results(3000), (1, 1))
+        self.assertEqual(database.cursor.execute("SELECT build_id FROM build_results ORDER BY build_id").fetchall(), [(2,), (3,)])
+        self.assertEqual(list(database.get_broken_report_from_history())[0][12], 3)
+
+class TestAttrFilesRevision(unittest.TestCase):
+    def git(self, *args):
+        subprocess.run(["git", "-C", self.nixpkgs, "-c", "user.name=test", "-c", "user.email=test@example.org", *args], check=True, capture_output=True)
+
+    def write(self, name, content):
+        with open(os.path.join(self.nixpkgs, name), "w") as nix_file:
+            nix_file.write(content)
+
+    def test_carry_over_unchanged_files(self):
+        with tempfile.TemporaryDirectory() as self.nixpkgs:
+            self.git("init")
+            self.write("a.nix", "{ }")
+            self.write("b.nix", "{ }")
+            self.git("add", ".")
+            self.git("commit", "-m", "first")
+            first = broken.git.head_revision(self.nixpkgs)
+            database = broken.Database(":memory:")
+            database.insert_or_update_attr_files([("a", os.path.relpath(os.path.join(self.nixpkgs, "a.nix"))), ("b", os.path.relpath(os.path.join(self.nixpkgs, "b.nix")))], first)
+            self.write("b.nix", "{ meta = { }; }")
+            self.git("commit", "-am", "second")
+            second = broken.refresh_attr_files(database, self.nixpkgs)
+            self.assertNotEqual(first, second)
+            revisions = {attribute: revision for [attribute, [file, revision]] in database.get_attr_files().items()}
+            self.assertEqual(revisions, {"a": second, "b": first}, "Only the attribute with a changed file is left behind")
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.database = broken.Database(":memory:")
+        self.database.enqueue_eval("https://hydra", "nixpkgs/trunk", 10, 100, 3, [1, 2, 3])
+
+    def test_backoff_and_parking(self):
+        self.assertEqual(sorted(self.database.get_due_work("https://hydra", "nixpkgs/trunk", 10, 0)), [1, 2, 3])
+        self.database.remove_work("https://hydra", "nixpkgs/trunk", 10, [1])
+        self.database.record_work_failures("https://hydra", "nixpkgs/trunk", 10, [(2, "HTTP 500"), (3, "HTTP 500")], 1000, 10, 2)
+        self.assertEqual(self.database.get_due_work("https://hydra", "nixpkgs/trunk", 10, 1009), [])
+        self.assertEqual(sorted(self.database.get_due_work("https://hydra", "nixpkgs/trunk", 10, 1010)), [2, 3])
+        self.database.record_work_failures("https://hydra", "nixpkgs/trunk", 10, [(3, "HTTP 500")], 2000, 10, 2)
+        self.assertEqual(self.database.get_work_summary("https://hydra", "nixpkgs/trunk", 10), (1, 1010, 1))
+        self.assertEqual(self.database.get_due_work("https://hydra", "nixpkgs/trunk", 10, 10000), [2], "Parked builds are not retried")
+        self.assertEqual(self.database.unpark_work(), 1)
+        self.assertEqual(sorted(self.database.get_due_work("https://hydra", "nixpkgs/trunk", 10, 10000)), [2, 3])
+
+    def test_queued_until_no_work_is_left(self):
+        self.assertEqual(self.database.get_queued_evals("https://hydra", "nixpkgs/trunk"), [(10, 100, 3)])
+        self.database.remove_work("https://hydra", "nixpkgs/trunk", 10, [1, 2])
+        self.database.record_work_failures("https://hydra", "nixpkgs/trunk", 10, [(3, "HTTP 500")], 1000, 10, 1)
+        self.database.mark_eval_ingested("https://hydra", "nixpkgs/trunk", 10, 100, 3)
+        self.assertEqual(self.database.get_queued_evals("https://hydra", "nixpkgs/trunk"), [], "Only parked builds are left")
+        self.database.unpark_work()
+        self.assertEqual(self.database.get_queued_evals("https://hydra", "nixpkgs/trunk"), [(10, 100, 3)])
+        self.database.enqueue_eval("https://hydra", "nixpkgs/trunk", 10, 100, 3, [])
+        self.assertEqual(self.database.get_due_work("https://hydra", "nixpkgs/trunk", 10, 0), [3], "Queueing an eval again keeps its work")
+        self.database.remove_work("https://hydra", "nixpkgs/trunk", 10, [3])
+        self.database.mark_eval_ingested("https://hydra", "nixpkgs/trunk", 10, 100, 3)
+        self.assertEqual(self.database.cursor.execute("SELECT count(*) FROM queued_evals").fetchone()[0], 0)
+
+class TestDatabaseWriter(unittest.TestCase):
+    def test_submitted_write_runs_after_added_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hydra.db")
+            database = broken.Database(path)
+            with broken.DatabaseWriter(path, max_rows=1000, max_age=3600) as writer:
+                writer.add((1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "hello", "x86_64-linux"))
+                writer.add((2, "https://hydra", "nixpkgs/staging", 11, 100, 1, "hello", "x86_64-linux"))
+                future = writer.submit(lambda database: database.get_build_id(2))
+                self.assertEqual(future.result(timeout=10), (2, 1), "Added rows are written before the submitted write runs")
+                writer.submit(lambda database: database.mark_eval_ingested("https://hydra", "nixpkgs/trunk", 10, 100, 1)).result(timeout=10)
+            self.assertEqual(database.get_last_ingested_eval("https://hydra", "nixpkgs/trunk"), 10)
+            self.assertEqual(database.cursor.execute("SELECT count(*) FROM build_results").fetchone()[0], 2)
+
+    def test_error_is_raised_on_exit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hydra.db")
+            with self.assertRaises(ZeroDivisionError):
+                with broken.DatabaseWriter(path) as writer:
+                    future = writer.submit(lambda database: 1 / 0)
+                    self.assertRaises(ZeroDivisionError, future.result, 10)
+                    writer.add((1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "hello", "x86_64-linux"))
+
+    def test_full_queue_does_not_block_the_event_loop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hydra.db")
+            database = broken.Database(path)
+            release = threading.Event()
+            async def run(writer):
+                # Keeps the writer thread busy, the next item fills the queue.
+                writer.submit(lambda database: release.wait(10))
+                await writer.add_async((1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "hello", "x86_64-linux"))
+                adding = asyncio.ensure_future(writer.add_async((2, "https://hydra", "nixpkgs/trunk", 10, 100, 1, "hello", "aarch64-linux")))
+                await asyncio.sleep(0.1)
+                self.assertFalse(adding.done(), "Waits for room in the queue")
+                release.set()
+                await adding
+                return await asyncio.wrap_future(await writer.submit_async(lambda database: database.get_build_id(2)))
+            with broken.DatabaseWriter(path, max_queued=1) as writer:
+                self.assertEqual(asyncio.run(run(writer)), (2, 1))
+            self.assertEqual(database.cursor.execute("SELECT count(*) FROM build_results").fetchone()[0], 2)
+            database.close()
+
+class TestReadConnections(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = broken.Database(os.path.join(self.directory.name, "hydra.db"))
+        self.database.insert_or_update_build_results([(1, "https://hydra", "nixpkgs/trunk", 10, 100, 1, "hello", "x86_64-linux")])
+
+    def tearDown(self):
+        self.database.close()
+        self.directory.cleanup()
+
+    def test_reports_read_during_a_write(self):
+        self.assertEqual(self.database.cursor.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.database.cursor.execute("UPDATE build_results SET status = 0 WHERE build_id = 1")
+        self.assertTrue(self.database.connection.in_transaction)
+        self.assertEqual([row[0] for row in self.database.get_broken_report_from_history()], [1], "Readers see the last committed state")
+        self.database.connection.commit()
+        self.assertEqual(list(self.database.get_broken_report_from_history()), [])
+
+    def test_connections_are_reused_and_read_only(self):
+        list(self.database.get_broken_report())
+        list(self.database.get_broken_report())
+        self.assertEqual(len(self.database.readers.idle), 1)
+        with self.database.readers.connection() as connection:
+            self.assertRaises(sqlite3.OperationalError, connection.execute, "DELETE FROM build_results")
+
+    def test_without_wal(self):
+        database = broken.Database(os.path.join(self.directory.name, "rollback.db"), wal=False)
+        self.assertIsNone(database.readers)
+        self.assertEqual(database.cursor.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        database.close()
+
+if __name__ == '__main__':
+    unittest.main()
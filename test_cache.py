@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+from nixpkgs_broken import broken
+from nixpkgs_broken import cache
+import io
+import json
+import os
+import tempfile
+import unittest
+
+class TestIterArrayItems(unittest.TestCase):
+    def items(self, document, chunk_size=1 << 16):
+        return list(cache.iter_array_items(io.BytesIO(document.encode()), "builds", chunk_size))
+
+    def test_top_level_array(self):
+        document = json.dumps({"id": 1, "builds": [10, 200, 3000], "other": [1]})
+        self.assertEqual(self.items(document), [10, 200, 3000])
+
+    def test_small_chunks(self):
+        builds = list(range(123456, 124456))
+        document = json.dumps({"builds": builds})
+        for chunk_size in [1, 2, 7, 64]:
+            self.assertEqual(self.items(document, chunk_size), builds, f"chunk size {chunk_size}")
+
+    def test_ignores_nested_and_string_matches(self):
+        document = json.dumps({"a": "\"builds\": [1]", "nested": {"builds": [2]}, "builds": [3]})
+        self.assertEqual(self.items(document), [3])
+
+    def test_missing_key(self):
+        self.assertEqual(self.items(json.dumps({"evals": []})), [])
+
+class TestEvalCache(unittest.TestCase):
+    def test_store_and_evict(self):
+        with tempfile.TemporaryDirectory() as directory:
+            eval_cache = cache.EvalCache(directory, max_size=1)
+            first = eval_cache.builds_path("https://hydra", 1)
+            second = eval_cache.builds_path("https://hydra", 2)
+            eval_cache.store(first, [b'{"builds": ', b'[1, 2]}'])
+            with eval_cache.open(first) as cache_file:
+                self.assertEqual(list(cache.iter_array_items(cache_file, "builds")), [1, 2])
+            os.utime(first, (0, 0))
+            eval_cache.store(second, [b'{"builds": [3]}'])
+            self.assertFalse(os.path.exists(first), "Least recently used file is evicted")
+            self.assertTrue(os.path.exists(second), "Most recently used file is kept")
+
+class TestBuildCache(unittest.TestCase):
+    def build_info(self, finished):
+        return {"finished": finished, "job": "hello.x86_64-linux", "system": "x86_64-linux", "buildstatus": 0 if finished else None, "timestamp": 100, "jobsetevals": [5, 4]}
+
+    def test_finished_builds_stay_fresh(self):
+        with cache.BuildCache(broken.Database(":memory:"), ttl=0) as build_cache:
+            build_cache.store("https://hydra", 1, self.build_info(1), etag='"abc"')
+            build_cache.flush()
+            build_info, fresh, headers = build_cache.lookup("https://hydra", 1)
+            self.assertTrue(fresh)
+            self.assertEqual(build_info["jobsetevals"], [5])
+
+    def test_unfinished_builds_are_revalidated(self):
+        with cache.BuildCache(broken.Database(":memory:"), ttl=0) as build_cache:
+            build_cache.store("https://hydra", 1, self.build_info(0), etag='"abc"')
+            build_info, fresh, headers = build_cache.lookup("https://hydra", 1)
+            self.assertFalse(fresh)
+            self.assertEqual(headers, {"If-None-Match": '"abc"'})
+            self.assertIsNone(build_cache.lookup("https://other-hydra", 1))
+
+if __name__ == '__main__':
+    unittest.main()
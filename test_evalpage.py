@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+from nixpkgs_broken import evalpage
+import unittest
+
+page = """<html><body>
+<table><tbody>
+<tr><td>hello</td><td>removed job</td></tr>
+</tbody></table>
+<table class="table"><tbody>
+<tr>
+  <td><img src="/static/images/checkmark.png" title="Succeeded" alt="Succeeded" class="build-status" /></td>
+  <td><a class="row-link" href="https://hydra.nixos.org/build/123">123</a></td>
+  <td><a href="https://hydra.nixos.org/job/nixpkgs/trunk/hello.x86_64-linux">hello.x86_64-linux</a></td>
+  <td class="nowrap"><time>2023-01-01</time></td>
+  <td>hello-2.12.1</td>
+  <td><tt>x86_64-linux</tt></td>
+</tr>
+<tr>
+  <td><img src="/static/images/error.png" title="Dependency failed" alt="Dependency failed" class="build-status" /></td>
+  <td><a class="row-link" href="https://hydra.nixos.org/build/124">124</a></td>
+  <td><a href="https://hydra.nixos.org/job/nixpkgs/trunk/foo&amp;bar.aarch64-linux">foo&amp;bar.aarch64-linux</a></td>
+</tr>
+</tbody></table>
+</body></html>
+"""
+
+class TestEvalPageParser(unittest.TestCase):
+    def test_rows(self):
+        parser = evalpage.EvalPageParser()
+        parser.feed(page)
+        parser.close()
+        self.assertEqual(parser.take_rows(), [
+            evalpage.Row(123, "Succeeded", "hello.x86_64-linux", "x86_64-linux"),
+            evalpage.Row(124, "Dependency failed", "foo&bar.aarch64-linux", None),
+        ])
+        self.assertEqual(parser.take_rows(), [])
+
+    def test_small_chunks(self):
+        parser = evalpage.EvalPageParser()
+        rows = []
+        for i in range(0, len(page), 7):
+            parser.feed(page[i:i + 7])
+            rows += parser.take_rows()
+        parser.close()
+        rows += parser.take_rows()
+        self.assertEqual([row.build_id for row in rows], [123, 124])
+        self.assertEqual(rows[1].job, "foo&bar.aarch64-linux")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+from nixpkgs_broken import broken
+from nixpkgs_broken import cache
+from nixpkgs_broken import ingest
+import aiohttp
+import asyncio
+import json
+import unittest
+
+class StubContent:
+    def __init__(self, body):
+        self.body = body
+
+    async def iter_chunked(self, size):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+class StubResponse:
+    """A response with `status` and `body`, or one that raises `error` when it's opened."""
+    def __init__(self, status=200, body=b"", headers=None, error=None):
+        self.status = status
+        self.body = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.headers = headers or {}
+        self.error = error
+        self.content = StubContent(self.body)
+
+    async def read(self):
+        return self.body
+
+    async def __aenter__(self):
+        if self.error is not None:
+            raise self.error
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return False
+
+class StubSession:
+    """Answers requests with the responses given per URL, in order, and records the requests."""
+    def __init__(self, responses):
+        self.responses = {url: list(answers) for [url, answers] in responses.items()}
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append((url, headers))
+        return self.responses[url].pop(0)
+
+class StubWriter:
+    def __init__(self):
+        self.rows = []
+
+    async def add_async(self, build_result):
+        self.rows.append(build_result)
+
+def build_info(status=0, finished=1, job="hello.x86_64-linux"):
+    return {"job": job, "system": "x86_64-linux", "buildstatus": status, "finished": finished, "timestamp": 100, "jobsetevals": [5, 4]}
+
+class TestRunBounded(unittest.TestCase):
+    def test_window(self):
+        running = 0
+        most_running = 0
+        started = []
+        async def work(i):
+            nonlocal running, most_running
+            started.append(i)
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.001 * (i % 3))
+            running -= 1
+            return i
+        async def run():
+            results = []
+            async for result in ingest.run_bounded((work(i) for i in range(20)), 4):
+                if not results:
+                    self.assertLessEqual(len(started), 4, "Coroutines are only started when there is room")
+                results.append(result)
+            return results
+        results = asyncio.run(run())
+        self.assertEqual(sorted(results), list(range(20)))
+        self.assertEqual(most_running, 4)
+
+class TestFetchBuildResult(unittest.TestCase):
+    url = "https://hydra/build/1"
+
+    def setUp(self):
+        self.build_cache = cache.BuildCache(broken.Database(":memory:"), ttl=3600)
+
+    def fetch(self, responses, revalidate=False):
+        session = StubSession({self.url: responses})
+        result = asyncio.run(ingest.fetch_build_result(session, "https://hydra", 1, self.build_cache, revalidate))
+        return result, session.requests
+
+    def test_stores_validators(self):
+        result, requests = self.fetch([StubResponse(200, build_info(), {"ETag": '"v1"'})])
+        self.assertEqual(result, (1, "https://hydra", 5, 100, 0, "hello", "x86_64-linux"))
+        self.assertEqual(self.build_cache.lookup("https://hydra", 1)[2], {"If-None-Match": '"v1"'})
+
+    def test_finished_build_is_not_requested_again(self):
+        self.build_cache.store("https://hydra", 1, build_info(), etag='"v1"')
+        result, requests = self.fetch([])
+        self.assertEqual(result[4], 0)
+        self.assertEqual(requests, [])
+
+    def test_unfinished_build_within_ttl(self):
+        self.build_cache.store("https://hydra", 1, build_info(None, 0), etag='"v1"')
+        result, requests = self.fetch([])
+        self.assertIsNone(result[4])
+        self.assertEqual(requests, [])
+
+    def test_not_modified(self):
+        self.build_cache.ttl = 0
+        self.build_cache.store("https://hydra", 1, build_info(None, 0), etag='"v1"', last_modified="Mon, 01 Jan 2024 00:00:00 GMT")
+        result, requests = self.fetch([StubResponse(304)])
+        self.assertIsNone(result[4])
+        self.assertEqual(requests[0][1]["If-None-Match"], '"v1"')
+        self.assertEqual(requests[0][1]["If-Modified-Since"], "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.assertEqual(self.build_cache.revalidated, {("https://hydra", 1)})
+
+    def test_revalidate_finished_build(self):
+        self.build_cache.store("https://hydra", 1, build_info(1), etag='"v1"')
+        result, requests = self.fetch([StubResponse(200, build_info(0), {"ETag": '"v2"'})], revalidate=True)
+        self.assertEqual(result[4], 0)
+        self.assertEqual(requests[0][1]["If-None-Match"], '"v1"')
+
+    def test_errors(self):
+        for response in [StubResponse(502, b"Bad Gateway"), StubResponse(200, b"<html>"), StubResponse(error=aiohttp.ClientConnectionError()), StubResponse(error=asyncio.TimeoutError())]:
+            with self.assertRaises(ingest.FetchError):
+                self.fetch([response])
+
+class TestIngestBuilds(unittest.TestCase):
+    def test_failures_are_reported(self):
+        session = StubSession({
+            "https://hydra/build/1": [StubResponse(200, build_info(1))],
+            "https://hydra/build/2": [StubResponse(500)],
+            "https://hydra/build/3": [StubResponse(error=asyncio.TimeoutError())],
+            # Skipped, so it is done without being written.
+            "https://hydra/build/4": [StubResponse(200, build_info(job="hello"))],
+        })
+        writer = StubWriter()
+        done = {}
+        async def on_done(build_id, error):
+            done[build_id] = error
+        number, failed = asyncio.run(ingest.ingest_builds(session, writer, "https://hydra", "nixpkgs/trunk", [1, 2, 3, 4], 2, on_done=on_done))
+        self.assertEqual((number, failed), (1, 2))
+        self.assertEqual(writer.rows, [(1, "https://hydra", "nixpkgs/trunk", 5, 100, 1, "hello", "x86_64-linux")])
+        self.assertEqual(done[1], None)
+        self.assertEqual(done[4], None)
+        self.assertEqual(done[2], "HTTP 500")
+        self.assertIn("TimeoutError", done[3])
+
+    def test_recheck_only_writes_changes(self):
+        session = StubSession({
+            "https://hydra/build/1": [StubResponse(200, build_info(0))],
+            "https://hydra/build/2": [StubResponse(200, build_info(1))],
+            "https://hydra/build/3": [StubResponse(200, build_info(None, 0))],
+        })
+        writer = StubWriter()
+        builds = [(1, "https://hydra", "nixpkgs/trunk", 1), (2, "https://hydra", "nixpkgs/trunk", 1), (3, "https://hydra", "nixpkgs/trunk", 1)]
+        changed, failed = asyncio.run(ingest.recheck_builds(session, writer, builds, 2))
+        self.assertEqual((changed, failed), (1, 0))
+        self.assertEqual([row[0] for row in writer.rows], [1])
+
+class TestIngestEvalPage(unittest.TestCase):
+    def test_statuses_from_the_page(self):
+        page = b"""<table><tbody>
+<tr><td><img class="build-status" title="Failed"></td><td><a href="https://hydra/build/1">1</a></td><td>hello.x86_64-linux</td><td></td><td></td><td>x86_64-linux</td></tr>
+<tr><td><img class="build-status" title="Something new"></td><td><a href="https://hydra/build/2">2</a></td><td>world.x86_64-linux</td></tr>
+<tr><td><img class="build-status" title="Succeeded"></td><td><a href="https://hydra/build/3">3</a></td><td>other.x86_64-linux</td></tr>
+</tbody></table>"""
+        session = StubSession({"https://hydra/eval/10?full=1": [StubResponse(200, page)]})
+        writer = StubWriter()
+        done = []
+        async def on_done(build_id, error):
+            done.append(build_id)
+        handled = asyncio.run(ingest.ingest_eval_page(session, writer, "https://hydra", "nixpkgs/trunk", 10, 1000, [1, 2], on_done))
+        self.assertEqual(handled, 1)
+        self.assertEqual(writer.rows, [(1, "https://hydra", "nixpkgs/trunk", 10, 1000, 1, "hello", "x86_64-linux")])
+        self.assertEqual(done, [1])
+
+    def test_page_unavailable(self):
+        session = StubSession({"https://hydra/eval/10?full=1": [StubResponse(503)]})
+        handled = asyncio.run(ingest.ingest_eval_page(session, StubWriter(), "https://hydra", "nixpkgs/trunk", 10, 1000, [1]))
+        self.assertEqual(handled, 0)
+
+class TestFetchLatestSuccess(unittest.TestCase):
+    url = "https://hydra/job/nixpkgs/trunk/hello.x86_64-linux/latest"
+
+    def fetch(self, response):
+        session = StubSession({self.url: [response]})
+        return asyncio.run(ingest.fetch_latest_success(session, "https://hydra", "nixpkgs/trunk", "hello", "x86_64-linux"))
+
+    def test_never_succeeded(self):
+        self.assertIsNone(self.fetch(StubResponse(404, {"error": "no such build"})))
+
+    def test_server_error(self):
+        with self.assertRaises(ingest.FetchError):
+            self.fetch(StubResponse(500, {"error": "database is busy"}))
+        with self.assertRaises(ingest.FetchError):
+            self.fetch(StubResponse(429, b"<html>Too Many Requests</html>"))
+
+    def test_success(self):
+        self.assertEqual(self.fetch(StubResponse(200, {"id": 5, "timestamp": 100})), {"id": 5, "timestamp": 100})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import mark_broken_v2
+import os
+import tempfile
 import unittest
 
 class TestNumLeadingSpaces(unittest.TestCase):
@@ -13,6 +15,87 @@ class TestNumLeadingSpaces(unittest.TestCase):
     def test_leading_and_trailing_spaces(self):
         self.assertEqual(mark_broken_v2.numLeadingSpaces("  hello world  "), 2, "Has leading and trailing spaces")
 
+class TestBrokenTextFor(unittest.TestCase):
+    def test_single_platform(self):
+        self.assertEqual(mark_broken_v2.brokenTextFor(["x86_64-darwin"]), "stdenv.hostPlatform.isDarwin && stdenv.hostPlatform.isx86_64")
+    def test_combined_platforms(self):
+        self.assertEqual(mark_broken_v2.brokenTextFor(["x86_64-linux", "aarch64-linux"]), "stdenv.hostPlatform.isLinux")
+        self.assertEqual(mark_broken_v2.brokenTextFor(["x86_64-linux", "aarch64-linux", "x86_64-darwin"]), "stdenv.hostPlatform.isLinux || (stdenv.hostPlatform.isDarwin && stdenv.hostPlatform.isx86_64)")
+    def test_all_platforms(self):
+        self.assertEqual(mark_broken_v2.brokenTextFor(mark_broken_v2.supportedPlatforms), "true")
+
+class TestPlanMark(unittest.TestCase):
+    def attrInfo(self, brokenPlatforms=()):
+        return {
+            "position": {"file": "/nixpkgs/pkgs/hello/default.nix", "line": 12},
+            "broken": {platform: platform in brokenPlatforms for platform in mark_broken_v2.supportedPlatforms},
+        }
+    def test_includes_already_marked_platforms(self):
+        plan = mark_broken_v2.planMark("hello", ["x86_64-linux"], self.attrInfo(["aarch64-linux"]))
+        self.assertEqual(plan, ("/nixpkgs/pkgs/hello/default.nix", 12, ["aarch64-linux", "x86_64-linux"]))
+    def test_already_marked(self):
+        self.assertIsNone(mark_broken_v2.planMark("hello", ["x86_64-linux"], self.attrInfo(["x86_64-linux"])))
+    def test_unknown_attribute(self):
+        self.assertIsNone(mark_broken_v2.planMark("hello", ["x86_64-linux"], None))
+
+class TestInsertBrokenMarks(unittest.TestCase):
+    package = """{ stdenv }:
+{
+  a = stdenv.mkDerivation {
+    meta = {
+      description = "a";
+    };
+  };
+  b = stdenv.mkDerivation {
+    meta = { description = "b"; broken = stdenv.hostPlatform.isLinux; };
+  };
+  c = stdenv.mkDerivation {
+    meta = { description = "c"; broken = stdenv.hostPlatform.isStatic; };
+  };
+  d = stdenv.mkDerivation {
+    meta = { description = "d"; };
+  };
+}
+"""
+    def insert(self, marks):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "default.nix")
+            with open(path, "w") as nix_file:
+                nix_file.write(self.package)
+            applied = mark_broken_v2.insertBrokenMarks(path, marks)
+            with open(path) as nix_file:
+                return applied, nix_file.read()
+
+    def test_edits_several_meta_blocks(self):
+        applied, text = self.insert([("a", 5, "true", "never built"), ("b", 9, "stdenv.hostPlatform.isDarwin", ""), ("c", 12, "true", "")])
+        self.assertEqual([mark[0] for mark in applied], ["a", "b"], "The special broken expression of c is left alone")
+        self.assertIn('      description = "a";\n      # never built\n      broken = true;\n    };', text)
+        self.assertIn('meta = { description = "b"; broken = stdenv.hostPlatform.isDarwin; };', text)
+        self.assertIn('broken = stdenv.hostPlatform.isStatic;', text)
+
+    def test_comment_on_a_single_line(self):
+        applied, text = self.insert([("b", 9, "true", "never built on aarch64-linux"), ("d", 15, "true", "never built")])
+        self.assertEqual(len(applied), 2)
+        self.assertIn('meta = { description = "b"; /* never built on aarch64-linux */ broken = true; };', text)
+        self.assertIn('meta = { description = "d"; /* never built */ broken = true; };', text)
+
+    def test_needs_a_line_with_several_meta_blocks(self):
+        applied, text = self.insert([("a", None, "true", "")])
+        self.assertEqual(applied, [])
+        self.assertEqual(text, self.package)
+
+    def test_file_is_replaced(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "default.nix")
+            with open(path, "w") as nix_file:
+                nix_file.write(self.package)
+            os.chmod(path, 0o644)
+            inode = os.stat(path).st_ino
+            mark_broken_v2.insertBrokenMarks(path, [("a", 5, "true", "")])
+            self.assertNotEqual(os.stat(path).st_ino, inode, "A new file is renamed over the old one")
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+            self.assertEqual(sorted(os.listdir(directory)), ["default.nix", "default.nix.bak"])
+
 if __name__ == '__main__':
     unittest.main()
 
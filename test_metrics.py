@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+from nixpkgs_broken.metrics import Metrics
+import json
+import os
+import tempfile
+import unittest
+
+class TestMetrics(unittest.TestCase):
+    def test_counters_and_phases(self):
+        metrics = Metrics()
+        metrics.increment("builds_written", 3)
+        metrics.increment("builds_written")
+        for seconds in [0.002, 0.002, 0.2, 7]:
+            metrics.observe("http_fetch", seconds)
+        with metrics.timed("db_write"):
+            pass
+        summary = metrics.summary()
+        self.assertEqual(summary["counters"], {"builds_written": 4})
+        self.assertEqual(summary["phases"]["http_fetch"]["count"], 4)
+        self.assertEqual(summary["phases"]["http_fetch"]["p50"], 0.005)
+        self.assertEqual(summary["phases"]["http_fetch"]["p99"], 10)
+        self.assertEqual(summary["phases"]["db_write"]["count"], 1)
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.increment("builds_failed")
+        metrics.observe("nix_eval", 0.3)
+        text = metrics.prometheus()
+        self.assertIn("nixpkgs_broken_builds_failed_total 1\n", text)
+        self.assertIn('nixpkgs_broken_phase_seconds_bucket{phase="nix_eval",le="0.25"} 0\n', text)
+        self.assertIn('nixpkgs_broken_phase_seconds_bucket{phase="nix_eval",le="0.5"} 1\n', text)
+        self.assertIn('nixpkgs_broken_phase_seconds_count{phase="nix_eval"} 1\n', text)
+
+    def test_write_json(self):
+        metrics = Metrics()
+        metrics.increment("build_cache_hits", 2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.json")
+            metrics.write_json(path)
+            with open(path) as metrics_file:
+                self.assertEqual(json.load(metrics_file)["counters"], {"build_cache_hits": 2})
+            self.assertEqual(os.listdir(directory), ["metrics.json"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from nixpkgs_broken import nixindex
+import os
+import tempfile
+import unittest
+
+package = """{ lib, stdenv }:
+let
+  # meta = { broken = true; };
+  name = "${lib.concatStrings [ "}" ]}";
+  script = ''
+    echo ''${HOME} "{"
+  '';
+in
+stdenv.mkDerivation {
+  pname = "hello";
+  meta = with lib; {
+    description = "Says hello; politely";
+    broken = stdenv.hostPlatform.isDarwin
+      || stdenv.hostPlatform.isAarch64;
+  };
+  passthru.tests.simple = { meta = { description = "test"; }; };
+}
+"""
+
+class TestMetaBlocks(unittest.TestCase):
+    def test_ignores_strings_and_comments(self):
+        blocks = nixindex.parse_meta_blocks(package)
+        self.assertEqual([(block.start_line, block.end_line) for block in blocks], [(11, 15), (16, 16)])
+        self.assertEqual([binding.name for binding in blocks[0].bindings], ["description", "broken"])
+        self.assertEqual(blocks[0].binding("description").value(package), '"Says hello; politely"')
+
+    def test_multiline_broken(self):
+        broken = nixindex.parse_meta_blocks(package)[0].binding("broken")
+        self.assertEqual(broken.value(package), "stdenv.hostPlatform.isDarwin\n      || stdenv.hostPlatform.isAarch64")
+        self.assertEqual(package[broken.end - 1], ";")
+        self.assertEqual(nixindex.indentation(package, broken.start), "    ")
+
+    def test_find_block(self):
+        blocks = nixindex.parse_meta_blocks(package)
+        self.assertEqual(nixindex.find_block(blocks, 12), blocks[0])
+        self.assertEqual(nixindex.find_block(blocks, 16), blocks[1])
+        self.assertIsNone(nixindex.find_block(blocks, 3))
+
+    def test_unterminated_string(self):
+        self.assertRaises(nixindex.ParseError, nixindex.parse_meta_blocks, 'meta = { description = "; };')
+
+class TestMetaIndex(unittest.TestCase):
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "default.nix")
+            with open(path, "w") as nix_file:
+                nix_file.write(package)
+            index = nixindex.MetaIndex()
+            text, blocks = index.get(path)
+            self.assertIs(index.get(path)[1], blocks)
+            os.utime(path, ns=(0, 0))
+            self.assertIs(index.get(path)[1], blocks, "Same content after touching the file")
+            with open(path, "w") as nix_file:
+                nix_file.write("{ meta = { }; }")
+            self.assertEqual(len(index.get(path)[1]), 1)
+
+if __name__ == '__main__':
+    unittest.main()
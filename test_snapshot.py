@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+from nixpkgs_broken import broken
+from nixpkgs_broken import snapshot
+import gzip
+import os
+import tempfile
+import unittest
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.source = broken.Database(":memory:")
+        self.source.insert_or_update_build_results([
+            (1, "https://hydra", "nixpkgs/trunk", 10, 100, 0, "hello", "x86_64-linux"),
+            (2, "https://hydra", "nixpkgs/trunk", 11, 200, 1, "hello", "x86_64-linux"),
+            (3, "https://hydra", "nixpkgs/trunk", 12, 300, 1, "hello", "x86_64-linux"),
+            (4, "https://hydra", "nixpkgs/trunk", 12, 300, None, "world", "aarch64-linux"),
+        ])
+        self.source.mark_eval_ingested("https://hydra", "nixpkgs/trunk", 12, 300, 2)
+        self.source.insert_or_update_attr_files([("hello", "pkgs/hello/default.nix")], "abc")
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "snapshot.ndjson.gz")
+            snapshot.export_snapshot(self.source, path)
+            target = broken.Database(":memory:")
+            # IDs in the target differ from the ones in the snapshot.
+            target.insert_or_update_build_results([(5, "https://other", "nixpkgs/staging", 1, 50, 0, "zzz", "x86_64-darwin")])
+            header, counts = snapshot.import_snapshot(target, path)
+            self.assertEqual(counts["build"], 4)
+            self.assertEqual(list(target.get_broken_report()), list(self.source.get_broken_report()))
+            self.assertEqual(list(target.get_builds_to_recheck()), [(4, "https://hydra", "nixpkgs/trunk", None)])
+            self.assertEqual(target.get_last_ingested_eval("https://hydra", "nixpkgs/trunk"), 12)
+            self.assertEqual(target.get_attr_files(), {"hello": ("pkgs/hello/default.nix", "abc")})
+            indexes = target.cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = 'build_results'").fetchone()[0]
+            self.assertEqual(indexes, 3)
+
+    def test_compacted_builds(self):
+        self.source.compact_build_results(250)
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "snapshot.ndjson.gz")
+            snapshot.export_snapshot(self.source, path)
+            target = broken.Database(":memory:")
+            snapshot.import_snapshot(target, path)
+            self.assertEqual(target.cursor.execute("SELECT count(*) FROM build_intervals").fetchone()[0], 2)
+            self.assertEqual(target.get_unknown_builds([3, 5]), ([5], []))
+            self.assertEqual(list(target.get_broken_report()), list(self.source.get_broken_report()))
+
+    def test_eval_range(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "snapshot.ndjson.gz")
+            snapshot.export_snapshot(self.source, path, first_eval_id=11, last_eval_id=11)
+            header, counts = snapshot.import_snapshot(broken.Database(":memory:"), path)
+            self.assertEqual((header["first_eval_id"], header["last_eval_id"]), (11, 11))
+            self.assertEqual(counts["build"], 1)
+            self.assertNotIn("ingested_eval", counts)
+
+    def test_not_a_snapshot(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "snapshot.ndjson.gz")
+            with gzip.open(path, "wb") as snapshot_file:
+                snapshot_file.write(b'{"format": "something else"}\n')
+            with self.assertRaises(snapshot.SnapshotError):
+                snapshot.import_snapshot(broken.Database(":memory:"), path)
+
+if __name__ == '__main__':
+    unittest.main()